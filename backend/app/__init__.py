@@ -19,6 +19,25 @@
 from flask import Flask
 from flask_cors import CORS
 from flask_session import Session
+from urllib.parse import urlsplit
+
+from app.config import FRONTEND_URL, ORTHANC_NODES
+
+
+def viewer_origins():
+    """
+    Lists the origins allowed to fetch archives, manifests and WSI resources.
+
+    Returns:
+        list: The frontend origin and the origin of every Orthanc node hosting viewers.
+    """
+    origins = [FRONTEND_URL]
+    for node in ORTHANC_NODES:
+        parts = urlsplit(node["url"])
+        if parts.scheme and parts.netloc:
+            origins.append(f"{parts.scheme}://{parts.netloc}")
+    return list(dict.fromkeys(origins))
+
 
 def create_app():
     app = Flask(__name__)
@@ -30,7 +49,15 @@ def create_app():
     app.config["SESSION_COOKIE_HTTPONLY"] = True
     app.config["SESSION_COOKIE_SECURE"] = False
     Session(app)
-    CORS(app, origins=["http://localhost:5173"], supports_credentials=True)
+    # Archives and manifests are fetched by viewers hosted on the Orthanc servers,
+    # which need no session cookie
+    viewers = {"origins": viewer_origins(), "supports_credentials": False}
+    CORS(app, resources={
+        r"/(studies|series)/[^/]+/archive": viewers,
+        r"/studies/[^/]+/ohif-dicom-json": viewers,
+        r"/wsi/.*": viewers,
+        r"/*": {"origins": [FRONTEND_URL]}
+    }, supports_credentials=True)
 
 
     # Import Blueprints
@@ -41,4 +68,20 @@ def create_app():
     app.register_blueprint(orthanc)
     app.register_blueprint(lti)
 
+    # Admission control and priority queueing
+    from app.admission import init_admission
+    init_admission(app)
+
+    # Background warm-up of the studies referenced by saved sessions
+    from app.warmup import start_warmup_scheduler
+    start_warmup_scheduler()
+
+    # Study index mapped from the snapshot shared by the workers
+    from app.study_store import init_study_store
+    init_study_store()
+
+    # Write-behind usage event log
+    from app.events import start_event_log
+    start_event_log()
+
     return app
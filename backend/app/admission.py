@@ -0,0 +1,213 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, jsonify, request
+
+from app.config import (
+    ADMISSION_CAPACITY,
+    ADMISSION_RESERVED_LAUNCH,
+    ADMISSION_QUEUE_SIZE,
+    ADMISSION_QUEUE_TIMEOUT,
+    ADMISSION_RETRY_AFTER,
+    UPSTREAM_LIMITS,
+    UPSTREAM_WAIT_TIMEOUT
+)
+
+HIGH = 0
+LOW = 1
+
+# Admission priority of each endpoint; endpoints not listed are not admission-controlled.
+ENDPOINT_PRIORITIES = {
+    "lti.launch": HIGH,
+    "lti.oidc": HIGH,
+    "lti.validate_token": HIGH,
+    "lti.dl_request": LOW,
+    "lti.dl_submit": LOW,
+    "lti.nrps": LOW,
+    "orthanc.get_studies": LOW,
+    "orthanc.get_study_changes": LOW,
+    "orthanc.get_study_facets": LOW,
+    "orthanc.query_studies": LOW,
+    "orthanc.search_studies": LOW,
+    "orthanc.get_series": LOW,
+    "orthanc.get_series_batch": LOW,
+    "orthanc.get_thumbnails": LOW,
+}
+
+
+class Overloaded(Exception):
+    """
+    Raised when a request cannot be admitted or an upstream slot cannot be obtained in time.
+    """
+
+
+class AdmissionController:
+    """
+    Bounds the number of requests processed at once, with a priority queue.
+
+    High priority requests may use the whole capacity; low priority requests
+    leave `reserved` slots free for them and always yield to waiting high
+    priority requests. Requests that find the queue full, or wait longer than
+    `timeout` seconds, are rejected with Overloaded.
+    """
+
+    def __init__(self, capacity, reserved, queue_size, timeout):
+        self.capacity = capacity
+        self.reserved = reserved
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = [0, 0]
+        self.stats = {"admitted": [0, 0], "rejected": [0, 0], "wait_seconds": [0.0, 0.0]}
+        self._cond = threading.Condition()
+
+    def _can_enter(self, priority):
+        if priority == HIGH:
+            return self.in_flight < self.capacity
+        return self.waiting[HIGH] == 0 and self.in_flight < self.capacity - self.reserved
+
+    def acquire(self, priority):
+        """
+        Waits for a processing slot.
+
+        Args:
+            priority (int): HIGH or LOW.
+
+        Returns:
+            float: Seconds spent waiting.
+
+        Raises:
+            Overloaded: If the queue is full or the wait times out.
+        """
+        start = time.monotonic()
+        with self._cond:
+            if not self._can_enter(priority):
+                if sum(self.waiting) >= self.queue_size:
+                    self.stats["rejected"][priority] += 1
+                    raise Overloaded("Admission queue full")
+                self.waiting[priority] += 1
+                try:
+                    admitted = self._cond.wait_for(lambda: self._can_enter(priority), self.timeout)
+                finally:
+                    self.waiting[priority] -= 1
+                if not admitted:
+                    self.stats["rejected"][priority] += 1
+                    # A low priority request may now be able to enter
+                    self._cond.notify_all()
+                    raise Overloaded("Timed out waiting for admission")
+            self.in_flight += 1
+            waited = time.monotonic() - start
+            self.stats["admitted"][priority] += 1
+            self.stats["wait_seconds"][priority] += waited
+            return waited
+
+    def release(self):
+        """
+        Frees a processing slot.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Current load and cumulated admission statistics per priority.
+        """
+        with self._cond:
+            result = {"in_flight": self.in_flight, "capacity": self.capacity}
+            for priority, name in ((HIGH, "high"), (LOW, "low")):
+                admitted = self.stats["admitted"][priority]
+                result[name] = {
+                    "waiting": self.waiting[priority],
+                    "admitted": admitted,
+                    "rejected": self.stats["rejected"][priority],
+                    "mean_wait_ms": round(1000 * self.stats["wait_seconds"][priority] / admitted, 3) if admitted else 0.0
+                }
+            return result
+
+
+admission = AdmissionController(ADMISSION_CAPACITY, ADMISSION_RESERVED_LAUNCH,
+                                ADMISSION_QUEUE_SIZE, ADMISSION_QUEUE_TIMEOUT)
+_upstream_slots = {name: threading.BoundedSemaphore(limit) for name, limit in UPSTREAM_LIMITS.items()}
+
+
+@contextmanager
+def upstream_slot(name):
+    """
+    Limits the number of concurrent calls to an upstream service.
+
+    Args:
+        name (str): Upstream name, a key of UPSTREAM_LIMITS ("moodle", "couchdb").
+
+    Raises:
+        Overloaded: If no slot frees up within UPSTREAM_WAIT_TIMEOUT seconds.
+    """
+    slot = _upstream_slots[name]
+    if not slot.acquire(timeout=UPSTREAM_WAIT_TIMEOUT):
+        raise Overloaded(f"Too many concurrent calls to {name}")
+    try:
+        yield
+    finally:
+        slot.release()
+
+
+def init_admission(app):
+    """
+    Installs admission control on the application.
+
+    Requests to the endpoints of ENDPOINT_PRIORITIES wait for a slot before
+    being processed. The time spent waiting is reported in a Server-Timing
+    header, and overload is answered with 503 and Retry-After.
+
+    Args:
+        app (flask.Flask): The application.
+    """
+    @app.before_request
+    def admit():
+        priority = ENDPOINT_PRIORITIES.get(request.endpoint)
+        if priority is not None:
+            g.admission_wait = admission.acquire(priority)
+
+    @app.after_request
+    def report_wait(response):
+        if "admission_wait" in g:
+            response.headers.add("Server-Timing", f"admission;dur={1000 * g.admission_wait:.2f}")
+        return response
+
+    @app.teardown_request
+    def release(exc):
+        if g.pop("admission_wait", None) is not None:
+            admission.release()
+
+    @app.errorhandler(Overloaded)
+    def overloaded(e):
+        return jsonify({"Error": f"Server overloaded: {e}"}), 503, {"Retry-After": str(ADMISSION_RETRY_AFTER)}
+
+
+def admission_stats_logic():
+    """
+    Returns the admission control statistics.
+
+    Returns:
+        JSON: Load and admission statistics per priority.
+    """
+    return jsonify(admission.snapshot())
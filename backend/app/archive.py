@@ -0,0 +1,172 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import hashlib
+import os
+import threading
+import requests
+from flask import Response, jsonify, send_file, stream_with_context
+
+from app.config import ARCHIVE_CACHE_DIR, ARCHIVE_CACHE_MAX_BYTES, ARCHIVE_CHUNK_SIZE
+from app.nodes import is_orthanc_id, node_for
+
+# Headers of the Orthanc archive response forwarded to the client.
+FORWARDED_HEADERS = ("Content-Type", "Content-Length", "Content-Range", "Accept-Ranges", "Content-Disposition")
+
+# Cache files currently being written, to avoid several writers for the same archive.
+_writing = set()
+_writing_lock = threading.Lock()
+
+
+def archive_cache_path(level, resource_id):
+    """
+    Computes the cache file of an archive.
+
+    The name depends on the Orthanc LastUpdate of the resource, so a study
+    modified in Orthanc is never served from an outdated archive.
+
+    Args:
+        level (str): "studies" or "series".
+        resource_id (str): Internal Orthanc ID of the resource.
+
+    Returns:
+        str: Absolute path of the cache file.
+
+    Raises:
+        requests.exceptions.RequestException: If the resource cannot be read from Orthanc.
+    """
+    resource = node_for(level, resource_id).client.get(f"/{level}/{resource_id}")
+    version = hashlib.sha1(f"{resource_id}|{resource.get('LastUpdate', '')}".encode()).hexdigest()
+    os.makedirs(ARCHIVE_CACHE_DIR, exist_ok=True)
+    return os.path.join(ARCHIVE_CACHE_DIR, f"{level}-{version}.zip")
+
+
+def evict_archives():
+    """
+    Removes the least recently used archives until the cache fits in ARCHIVE_CACHE_MAX_BYTES.
+    """
+    entries = []
+    for name in os.listdir(ARCHIVE_CACHE_DIR):
+        if name.endswith(".zip"):
+            stat = os.stat(os.path.join(ARCHIVE_CACHE_DIR, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= ARCHIVE_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(os.path.join(ARCHIVE_CACHE_DIR, name))
+            total -= size
+        except FileNotFoundError:
+            pass
+
+
+def stream_archive(upstream, cache_path=None):
+    """
+    Yields the chunks of an Orthanc archive, optionally copying them to the cache.
+
+    The copy is written to a temporary file which is only moved into place once
+    the whole archive has been received, so interrupted downloads never leave a
+    truncated archive in the cache.
+
+    Args:
+        upstream (requests.Response): Streaming Orthanc response.
+        cache_path (str, optional): Cache file to fill while streaming.
+
+    Yields:
+        bytes: Archive chunks.
+    """
+    if cache_path:
+        with _writing_lock:
+            if cache_path in _writing:
+                cache_path = None
+            else:
+                _writing.add(cache_path)
+    tmp_path = f"{cache_path}.{threading.get_ident()}.part" if cache_path else None
+    cache_file = None
+    completed = False
+    try:
+        if tmp_path:
+            try:
+                cache_file = open(tmp_path, "wb")
+            except OSError as e:
+                print(f"Error caching archive {cache_path} : {e}")
+        for chunk in upstream.iter_content(chunk_size=ARCHIVE_CHUNK_SIZE):
+            if cache_file:
+                cache_file.write(chunk)
+            yield chunk
+        completed = True
+    finally:
+        try:
+            upstream.close()
+            if cache_file:
+                cache_file.close()
+                if completed:
+                    os.replace(tmp_path, cache_path)
+                    evict_archives()
+                else:
+                    os.remove(tmp_path)
+        finally:
+            if cache_path:
+                with _writing_lock:
+                    _writing.discard(cache_path)
+
+
+def archive_logic(level, resource_id, request):
+    """
+    Serves the ZIP archive of a study or a series.
+
+    Archives already in the disk cache are sent from disk (with Range support).
+    Otherwise the Orthanc archive is streamed chunk by chunk without being
+    buffered, forwarding any Range header, and copied to the cache when enabled.
+
+    Args:
+        level (str): "studies" or "series".
+        resource_id (str): Internal Orthanc ID of the resource.
+        request (flask.Request): Incoming HTTP request.
+
+    Returns:
+        flask.Response: The archive, or a JSON error (400 for a malformed ID).
+    """
+    if not is_orthanc_id(resource_id):
+        return jsonify({"Error": "Invalid resource ID"}), 400
+    try:
+        cache_path = None
+        if ARCHIVE_CACHE_DIR:
+            cache_path = archive_cache_path(level, resource_id)
+            try:
+                os.utime(cache_path)
+                return send_file(cache_path, mimetype="application/zip", conditional=True,
+                                 download_name=f"{resource_id}.zip")
+            except FileNotFoundError:
+                pass
+
+        headers = {}
+        if request.headers.get("Range"):
+            headers["Range"] = request.headers["Range"]
+        upstream = node_for(level, resource_id).client.stream(f"/{level}/{resource_id}/archive", headers=headers)
+
+        # Partial responses cannot be used to fill the cache.
+        if upstream.status_code != 200:
+            cache_path = None
+
+        response_headers = {name: upstream.headers[name] for name in FORWARDED_HEADERS if name in upstream.headers}
+        return Response(stream_with_context(stream_archive(upstream, cache_path)),
+                        status=upstream.status_code, headers=response_headers, direct_passthrough=True)
+    except requests.exceptions.RequestException as e:
+        return jsonify({"Error": str(e)}), 500
@@ -0,0 +1,291 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import requests
+from flask import jsonify
+
+from app.config import CHANGES_PAGE_SIZE, CHANGES_MAX_DELTA, SERIES_PREFETCH_COUNT
+from app.nodes import NODES, query_nodes, remember
+from app.orthanc import SERIES_INDEX, format_study, list_studies, with_series_details
+from app.resilience import payload_response, unavailable_response, with_last_known_good
+
+
+class TooManyChanges(Exception):
+    """
+    Raised when a node has more pending changes than CHANGES_MAX_DELTA.
+    """
+
+
+def parse_token(token):
+    """
+    Reads a sync token.
+
+    A token holds the last Orthanc change sequence seen on each node,
+    written as "name:seq" pairs separated by commas.
+
+    Args:
+        token (str): The sync token.
+
+    Returns:
+        dict: Change sequences keyed by node name.
+
+    Raises:
+        ValueError: If the token is malformed.
+    """
+    seqs = {}
+    for part in token.split(","):
+        name, _, seq = part.rpartition(":")
+        seqs[name] = int(seq)
+    return seqs
+
+
+def format_token(seqs):
+    """
+    Writes a sync token.
+
+    Args:
+        seqs (dict): Change sequences keyed by node name.
+
+    Returns:
+        str: The sync token, nodes in configuration order.
+    """
+    return ",".join(f"{node.name}:{seqs[node.name]}" for node in NODES if node.name in seqs)
+
+
+def read_study_changes(node, since):
+    """
+    Reads the study changes of a node since a change sequence.
+
+    Args:
+        node (OrthancNode): The node.
+        since (int): Last change sequence already seen.
+
+    Returns:
+        tuple: Whether each changed study was deleted, keyed by Orthanc study
+            ID, and the last change sequence read.
+
+    Raises:
+        TooManyChanges: If more than CHANGES_MAX_DELTA changes are pending.
+        requests.exceptions.RequestException: If Orthanc cannot be queried.
+    """
+    studies = {}
+    seq = since
+    count = 0
+    while True:
+        page = node.client.get("/changes", params={"since": seq, "limit": CHANGES_PAGE_SIZE})
+        for change in page.get("Changes", []):
+            if change.get("ResourceType") == "Study":
+                studies[change["ID"]] = change.get("ChangeType") == "Deleted"
+        count += len(page.get("Changes", []))
+        seq = max(seq, page.get("Last", seq))
+        if page.get("Done", True) or not page.get("Changes"):
+            return studies, seq
+        if count >= CHANGES_MAX_DELTA:
+            raise TooManyChanges(f"Too many changes on Orthanc node {node.name}")
+
+
+def node_delta(node, since):
+    """
+    Builds the delta of the study list of a node.
+
+    Args:
+        node (OrthancNode): The node.
+        since (int): Last change sequence known by the client.
+
+    Returns:
+        tuple: Updated studies formatted for the frontend, IDs of the deleted
+            studies, and the new change sequence of the node. None if more
+            than CHANGES_MAX_DELTA changes are pending.
+
+    Raises:
+        requests.exceptions.RequestException: If Orthanc cannot be queried.
+    """
+    try:
+        changes, seq = read_study_changes(node, since)
+    except TooManyChanges:
+        return None
+    updated, deleted = [], []
+    for study_id, is_deleted in changes.items():
+        SERIES_INDEX.pop(study_id, None)
+        if not is_deleted:
+            try:
+                study = node.source.get_study(study_id)
+            except requests.exceptions.HTTPError as e:
+                if e.response is None or e.response.status_code != 404:
+                    raise
+                is_deleted = True
+        if is_deleted:
+            deleted.append(study_id)
+            continue
+        remember(study_id, node)
+        for serie_id in study.get('Series', []):
+            remember(serie_id, node)
+        updated.append(format_study(study, 'SM' in study.get('ModalitiesInStudy', []), node))
+    return updated, deleted, seq
+
+
+def last_change(node):
+    """
+    Reads the current change sequence of a node.
+
+    Args:
+        node (OrthancNode): The node.
+
+    Returns:
+        int: The last change sequence.
+
+    Raises:
+        requests.exceptions.RequestException: If Orthanc cannot be queried.
+    """
+    return node.client.get("/changes", params={"last": ""}).get("Last", 0)
+
+
+def node_resync(node):
+    """
+    Lists all the studies of a single node, for a client that cannot catch it up.
+
+    The change sequence is read before the listing, so changes made during
+    the listing are sent again with the next delta rather than lost.
+
+    Args:
+        node (OrthancNode): The node.
+
+    Returns:
+        tuple: The studies of the node formatted for the frontend, and its change sequence.
+
+    Raises:
+        requests.exceptions.RequestException: If Orthanc cannot be queried.
+    """
+    seq = last_change(node)
+    studies = []
+    for study in node.source.list_studies():
+        SERIES_INDEX.pop(study.get('ID'), None)
+        remember(study.get('ID'), node)
+        for serie_id in study.get('Series', []):
+            remember(serie_id, node)
+        studies.append(format_study(study, 'SM' in study.get('ModalitiesInStudy', []), node))
+    return studies, seq
+
+
+def full_sync():
+    """
+    Returns the whole study list with a token for the following deltas.
+
+    The change sequences are read before the listing, so changes made during
+    the listing are sent again with the next delta rather than lost. Nodes
+    missing from the listing are missing from the token too, so the next
+    sync lists them again. If no node can be queried, the last successful
+    listing is returned without a token.
+
+    Returns:
+        tuple: The response body, the names of the unavailable nodes, and the
+            age of the listing in seconds (None when fresh).
+
+    Raises:
+        requests.exceptions.RequestException: If no node can be queried and no listing was ever built.
+    """
+    try:
+        seqs, _, _ = query_nodes(last_change)
+    except requests.exceptions.RequestException:
+        seqs = {}
+    listing, age = with_last_known_good(("studies", None, 0), list_studies)
+    # A node whose listing failed is left out of the token, so the next sync resyncs it
+    token = format_token({node.name: seq for node, seq in seqs.items()
+                          if node.name not in listing["Unavailable"]}) if age is None else ""
+    return {"Reset": True, "Studies": listing["Studies"], "Token": token or None}, listing["Unavailable"], age
+
+
+def sync_studies(since=None):
+    """
+    Computes the changes of the study list since a sync token.
+
+    Without a token, the whole list is returned with "Reset" set. A node that
+    cannot be caught up (missing from the token, too many changes) is listed
+    again on its own: its studies are sent in "Updated" and its name in
+    "ResetNodes", so the client replaces the studies it holds for that node.
+    Nodes that cannot be queried keep their previous sequence in the new
+    token, so their changes are sent once they are back.
+
+    Args:
+        since (str, optional): Sync token returned by the previous sync.
+
+    Returns:
+        tuple: The body, with "Token" for the next sync and either "Studies"
+            with "Reset", or "Updated" studies, "Deleted" study IDs and
+            "ResetNodes"; the names of the unavailable nodes; and the age of
+            the body in seconds (None when fresh).
+
+    Raises:
+        ValueError: If the token is malformed.
+        requests.exceptions.RequestException: If no node can be queried.
+    """
+    if not since:
+        return full_sync()
+    seqs = parse_token(since)
+
+    def catch_up(node):
+        if node.name in seqs:
+            delta = node_delta(node, seqs[node.name])
+            if delta is not None:
+                return delta + (False,)
+        studies, seq = node_resync(node)
+        return studies, [], seq, True
+
+    results, unavailable, _ = query_nodes(catch_up)
+    body = {"Updated": [], "Deleted": [], "ResetNodes": []}
+    for node, (updated, deleted, seq, reset) in results.items():
+        body["Updated"].extend(updated)
+        body["Deleted"].extend(deleted)
+        if reset:
+            body["ResetNodes"].append(node.name)
+        seqs[node.name] = seq
+    body["Token"] = format_token(seqs)
+    return body, unavailable, None
+
+
+def study_changes_logic(since=None, prefetch=SERIES_PREFETCH_COUNT):
+    """
+    Returns the studies added, updated or deleted since a sync token.
+
+    If Orthanc is unavailable when the whole list is requested, the last
+    successful listing is returned with staleness headers.
+
+    Args:
+        since (str, optional): Sync token returned by the previous call.
+        prefetch (int): Number of leading studies, among those sent, whose
+            series are embedded under the "seriesDetails" key (0 disables prefetching).
+
+    Returns:
+        JSON: "Token" for the next call, and either "Studies" with "Reset",
+            or "Updated" studies, "Deleted" study IDs and "ResetNodes"
+            (see sync_studies).
+    """
+    try:
+        try:
+            body, unavailable, age = sync_studies(since)
+        except ValueError:
+            return jsonify({"Error": "Invalid sync token"}), 400
+        key = "Studies" if body.get("Reset") else "Updated"
+        if age is None:
+            body[key] = with_series_details(body[key], prefetch)
+        response = payload_response(body, age)
+        if unavailable:
+            response.headers["X-Unavailable-Nodes"] = ",".join(unavailable)
+        return response
+    except requests.exceptions.RequestException as e:
+        return unavailable_response(e)
@@ -22,12 +22,20 @@ from cryptography.hazmat.primitives import serialization
 # Configuration CouchDB
 # --------------------
 SESSIONS_DB_NAME = ""  # Name of the CouchDB database for storing student sessions
+EVENTS_DB_NAME = "" # Name of the CouchDB database for storing usage events ("" = no event log)
 COUCHDB_URL = "" # URL of the CouchDB server
-couch = couchdb.Server(COUCHDB_URL)
+COUCHDB_TIMEOUT = 10 # Seconds a CouchDB request may take before failing
+couch = couchdb.Server(COUCHDB_URL, session=couchdb.http.Session(timeout=COUCHDB_TIMEOUT))
 if SESSIONS_DB_NAME not in couch:
     sessions_db = couch.create(SESSIONS_DB_NAME)
 else:
     sessions_db = couch[SESSIONS_DB_NAME]
+if not EVENTS_DB_NAME:
+    events_db = None
+elif EVENTS_DB_NAME not in couch:
+    events_db = couch.create(EVENTS_DB_NAME)
+else:
+    events_db = couch[EVENTS_DB_NAME]
 
 # --------------------
 # Configuration Orthanc
@@ -36,6 +44,63 @@ ORTHANC_URL = "" # URL of the Orthanc server
 ORTHANC_NAME = "" # Username for Orthanc authentication
 ORTHANC_PASSWORD = "" # Password for Orthanc authentication
 ORTHANC_AUTH = (ORTHANC_NAME, ORTHANC_PASSWORD)
+# Orthanc servers queried concurrently for study listings. Each node has a name,
+# a URL, credentials, a timeout (seconds) after which its results are left out,
+# and optionally its own "data_source".
+ORTHANC_NODES = [
+    {"name": "main", "url": ORTHANC_URL, "auth": ORTHANC_AUTH, "timeout": 10},
+]
+ORTHANC_NODE_CONCURRENCY = 4 # Federated queries allowed to run at once on each node
+ORTHANC_COALESCE_WINDOW = 1.0 # Seconds during which an identical Orthanc request reuses the previous result
+ORTHANC_TIMEOUT = (3.05, 30) # Connect and read timeouts of Orthanc requests, in seconds
+ORTHANC_BREAKER_FAILURES = 5 # Consecutive Orthanc errors before failing fast
+ORTHANC_BREAKER_RESET = 30 # Seconds before a new Orthanc request is attempted after failing fast
+STALE_REFRESH_ATTEMPTS = 10 # Background retries of a listing served stale during an Orthanc outage
+STALE_CACHE_SIZE = 1000 # Last successful listings kept in memory to be served stale
+DATA_SOURCE = "native" # Study and series listing API: "native" (Orthanc REST) or "dicomweb" (QIDO-RS)
+SERIES_PREFETCH_COUNT = 0 # Number of studies whose series are embedded in /studies (0 = disabled)
+CHANGES_PAGE_SIZE = 1000 # Orthanc changes read per request by /studies/changes
+CHANGES_MAX_DELTA = 20000 # Pending changes above which /studies/changes resends the whole list
+STUDY_STORE_TTL = 60 # Seconds between two catch-ups of the study store with the Orthanc change log
+STUDY_SNAPSHOT_DIR = "cache/snapshots" # Directory of the study index snapshots shared by the workers ("" = none)
+STUDY_SNAPSHOT_GRACE = 300 # Seconds a replaced snapshot is kept for the workers still mapping it
+
+# --------------------
+# Configuration Backend
+# --------------------
+BACKEND_URL = "http://localhost:5000" # Public URL of this backend, used in viewer links
+FRONTEND_URL = "http://localhost:5173" # Origin of the frontend allowed by CORS
+ARCHIVE_CACHE_DIR = "" # Directory where downloaded archives are cached ("" = no cache)
+ARCHIVE_CACHE_MAX_BYTES = 20 * 1024**3 # Maximum total size of the archive cache
+ARCHIVE_CHUNK_SIZE = 1024**2 # Size of the chunks streamed from Orthanc
+MANIFEST_CACHE_DIR = "cache/manifests" # Directory of the cached OHIF DICOM-JSON manifests
+MANIFEST_WORKERS = 2 # Number of background threads generating manifests
+TILE_CACHE_DIR = "cache/tiles" # Directory of the cached WSI tiles ("" = memory only)
+TILE_CACHE_MAX_BYTES = 5 * 1024**3 # Maximum total size of the tiles cached on disk
+TILE_MEMORY_CACHE_BYTES = 256 * 1024**2 # Maximum total size of the tiles cached in memory
+TILE_PREGENERATE_MAX_TILES = 64 # Tiles of the lowest WSI levels generated on warm-up (0 = disabled)
+THUMBNAIL_CACHE_DIR = "cache/thumbnails" # Directory of the cached series thumbnails ("" = memory only)
+THUMBNAIL_CACHE_MAX_BYTES = 512 * 1024**2 # Maximum total size of the thumbnails cached on disk
+THUMBNAIL_MEMORY_CACHE_BYTES = 32 * 1024**2 # Maximum total size of the thumbnails cached in memory
+THUMBNAIL_SIZE = 128 # Maximum width and height of the thumbnails, in pixels
+THUMBNAIL_QUALITY = 80 # JPEG quality of the thumbnails
+THUMBNAIL_MAX_BATCH = 500 # Maximum number of series per thumbnail request
+THUMBNAIL_WORKERS = 4 # Number of thumbnails rendered in parallel
+ADMISSION_CAPACITY = 32 # Requests processed at once by admission-controlled endpoints
+ADMISSION_RESERVED_LAUNCH = 8 # Slots kept free for launches when browsing requests arrive
+ADMISSION_QUEUE_SIZE = 200 # Requests allowed to wait for a slot before rejecting new ones
+ADMISSION_QUEUE_TIMEOUT = 5 # Seconds a request may wait for a slot
+ADMISSION_RETRY_AFTER = 2 # Retry-After (seconds) sent with overload responses
+UPSTREAM_LIMITS = {"moodle": 16, "couchdb": 16} # Concurrent calls allowed per upstream service
+UPSTREAM_WAIT_TIMEOUT = 5 # Seconds a request may wait for an upstream slot
+WARMUP_CONCURRENCY = 2 # Number of studies warmed up in parallel
+WARMUP_INTERVAL = 3600 # Seconds between two warm-ups of all saved sessions (0 = disabled)
+WARMUP_LOCK_FILE = "cache/warmup.lock" # Lock file electing the worker that runs the scheduled warm-ups
+WARMUP_ON_SAVE = True # Warm up the studies of a session as soon as it is saved
+WARMUP_WINDOWS = [("00:00", "23:59")] # Local time ranges (HH:MM) during which warm-ups may run
+EVENT_BUFFER_SIZE = 10000 # Usage events kept in memory while waiting to be written (extra events are dropped)
+EVENT_BATCH_SIZE = 500 # Usage events written to CouchDB per batch
+EVENT_FLUSH_INTERVAL = 5 # Seconds between two writes of the buffered usage events
 
 # --------------------
 # Configuration LTI
@@ -56,6 +121,7 @@ MOODLE_CERT_URL = ""
 # URL to exchange the client_assertion (JWT) for an OAuth2 access_token,
 # necessary for the NRPS (Names and Roles) service, for example.
 MOODLE_TOKEN_URL = ""
+MOODLE_TIMEOUT = (3.05, 10) # Connect and read timeouts of Moodle requests, in seconds
 
 # Unique identifier for your tool (Client ID) registered in Moodle.
 # Must correspond to the "aud" (audience) of the token and be authorised by your LMS.
@@ -74,3 +140,8 @@ def load_public_key(): # Load the public key from a PEM file
 PRIVATE_KEY = load_private_key()
 PUBLIC_KEY = load_public_key()
 
+STUDENT_TOKEN_ALGORITHM = "RS256" # Signature of the student page tokens: "RS256" (PRIVATE_KEY), "HS256" or "EdDSA"
+STUDENT_TOKEN_SECRET = "" # Secret signing HS256 student tokens, the same for every worker
+STUDENT_TOKEN_EDDSA_KEY = "" # PEM file of the Ed25519 private key signing EdDSA student tokens
+TOKEN_CACHE_SIZE = 10000 # Verified student tokens kept in memory (0 = no cache)
+
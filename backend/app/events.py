@@ -0,0 +1,234 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import threading
+import time
+import uuid
+from collections import deque
+from flask import jsonify
+
+from app.config import (
+    EVENT_BUFFER_SIZE,
+    EVENT_BATCH_SIZE,
+    EVENT_FLUSH_INTERVAL,
+    events_db
+)
+from app.admission import Overloaded, upstream_slot
+
+# Viewers recognised in viewer URLs, checked in order.
+VIEWERS = (
+    ("/wsi/app/", "wholeslide"),
+    ("/stone-webviewer/", "stone"),
+    ("/ohif/", "ohif"),
+    ("/volview/", "volview"),
+)
+
+# CouchDB view counting the events per resource, event and viewer.
+EVENTS_DESIGN = {
+    "_id": "_design/events",
+    "views": {
+        "by_resource": {
+            "map": "function (doc) { if (doc.res_id && doc.event) { emit([doc.res_id, doc.event, doc.viewer || null], 1); } }",
+            "reduce": "_count"
+        }
+    }
+}
+
+
+def viewer_name(viewer_url):
+    """
+    Identifies the viewer opened by a viewer URL.
+
+    Args:
+        viewer_url (str): URL saved with a session.
+
+    Returns:
+        str: "wholeslide", "stone", "ohif", "volview", or "other".
+    """
+    for marker, name in VIEWERS:
+        if marker in (viewer_url or ""):
+            return name
+    return "other"
+
+
+class EventLog:
+    """
+    Write-behind log of usage events.
+
+    Events are appended to a bounded in-memory buffer and written to CouchDB
+    by a background thread, in `_bulk_docs` batches of up to `batch_size`
+    events, as soon as a batch is full or every `interval` seconds. Recording
+    never waits for CouchDB: when the buffer is full the new event is dropped
+    and counted. A failed batch goes back to the front of the buffer, as far
+    as space allows.
+    """
+
+    def __init__(self, db, capacity, batch_size, interval):
+        self.db = db
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+        self.stats = {"recorded": 0, "written": 0, "dropped": 0, "failed_batches": 0}
+        self._buffer = deque()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def record(self, event, **fields):
+        """
+        Adds an event to the buffer.
+
+        Args:
+            event (str): Event type, e.g. "launch".
+            **fields: Event attributes, e.g. res_id, user, viewer.
+        """
+        if self.db is None:
+            return
+        doc = dict(fields, _id=uuid.uuid4().hex, type="event", event=event, time=time.time())
+        with self._cond:
+            if len(self._buffer) >= self.capacity:
+                self.stats["dropped"] += 1
+                return
+            self._buffer.append(doc)
+            self.stats["recorded"] += 1
+            if len(self._buffer) >= self.batch_size:
+                self._cond.notify()
+
+    def flush(self):
+        """
+        Writes one batch of buffered events to CouchDB.
+
+        Returns:
+            int: Number of events written, None if CouchDB could not be reached.
+        """
+        with self._cond:
+            batch = [self._buffer.popleft() for _ in range(min(self.batch_size, len(self._buffer)))]
+        if not batch:
+            return 0
+        try:
+            with upstream_slot("couchdb"):
+                results = self.db.update(batch)
+        except Exception as e:
+            print(f"Error writing events : {e}")
+            self._requeue(batch)
+            return None
+        written = sum(1 for success, _, _ in results if success)
+        with self._cond:
+            self.stats["written"] += written
+            # Documents have unique IDs, so a failed document will not succeed on retry
+            self.stats["dropped"] += len(batch) - written
+        return written
+
+    def _requeue(self, batch):
+        with self._cond:
+            self.stats["failed_batches"] += 1
+            room = max(0, self.capacity - len(self._buffer))
+            self.stats["dropped"] += max(0, len(batch) - room)
+            self._buffer.extendleft(reversed(batch[:room]))
+
+    def start(self):
+        """
+        Starts the daemon thread flushing the buffer.
+
+        Does nothing when no events database is configured.
+        """
+        if self.db is None or self._thread is not None:
+            return
+
+        def run():
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: len(self._buffer) >= self.batch_size, self.interval)
+                # Write every full batch, then whatever is left on timeout
+                while True:
+                    written = self.flush()
+                    if written is None:
+                        # Back off instead of retrying a full buffer in a loop
+                        time.sleep(self.interval)
+                    if written != self.batch_size:
+                        break
+
+        self._thread = threading.Thread(target=run, name="event-log", daemon=True)
+        self._thread.start()
+
+    def snapshot(self):
+        """
+        Returns:
+            dict: Number of buffered events and cumulated counters.
+        """
+        with self._cond:
+            return dict(self.stats, buffered=len(self._buffer), capacity=self.capacity)
+
+
+event_log = EventLog(events_db, EVENT_BUFFER_SIZE, EVENT_BATCH_SIZE, EVENT_FLUSH_INTERVAL)
+
+
+def start_event_log():
+    """
+    Creates the per-resource counts view if needed and starts writing events.
+    """
+    if events_db is None:
+        return
+    try:
+        if EVENTS_DESIGN["_id"] not in events_db:
+            events_db.save(dict(EVENTS_DESIGN))
+    except Exception as e:
+        print(f"Error creating the events view : {e}")
+    event_log.start()
+
+
+def event_stats_logic():
+    """
+    Returns the event log counters.
+
+    Returns:
+        JSON: Buffered, recorded, written and dropped events, and failed batches.
+    """
+    return jsonify(event_log.snapshot())
+
+
+def resource_usage_logic(res_id=None):
+    """
+    Returns the number of events per resource, event type and viewer.
+
+    Counts are read from the pre-aggregated CouchDB view, so they do not
+    include the events still buffered.
+
+    Args:
+        res_id (str, optional): Resource to report, every resource by default.
+
+    Returns:
+        JSON: Dictionary with key "Resources" mapping each res_id to its
+            counts per event type and viewer.
+    """
+    if events_db is None:
+        return jsonify({"Error": "Event log disabled"}), 404
+    options = {"group_level": 3}
+    if res_id:
+        options.update(startkey=[res_id], endkey=[res_id, {}])
+    try:
+        with upstream_slot("couchdb"):
+            rows = list(events_db.view("events/by_resource", **options))
+    except Overloaded:
+        raise
+    except Exception as e:
+        return jsonify({"Error": str(e)}), 500
+    resources = {}
+    for row in rows:
+        resource, event, viewer = row.key
+        resources.setdefault(resource, {}).setdefault(event, {})[viewer or "other"] = row.value
+    return jsonify({"Resources": resources})
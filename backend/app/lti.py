@@ -23,21 +23,58 @@ import requests
 import jwt
 import time
 from jwt.algorithms import RSAAlgorithm
+from cryptography.hazmat.primitives import serialization
 from flask import jsonify, session, redirect, make_response
 
+from app.admission import Overloaded, upstream_slot
+from app.events import event_log, viewer_name
+from app.token_cache import VerifiedTokenCache
+
 from app.config import (
     PLATFORM_ID,
     CLIENT_ID,
     MOODLE_AUTH_URL,
     MOODLE_CERT_URL,
     MOODLE_TOKEN_URL,
+    MOODLE_TIMEOUT,
     KID,
     PRIVATE_KEY,
     PUBLIC_KEY,
+    STUDENT_TOKEN_ALGORITHM,
+    STUDENT_TOKEN_SECRET,
+    STUDENT_TOKEN_EDDSA_KEY,
+    TOKEN_CACHE_SIZE,
     sessions_db,
     AFFICHAGE_MOODLE
 )
 
+
+def load_student_token_keys():
+    """
+    Loads the keys signing and verifying the student page tokens.
+
+    Returns:
+        tuple: The signing key and the verification key for STUDENT_TOKEN_ALGORITHM.
+
+    Raises:
+        ValueError: If the algorithm is unknown or its key is not configured.
+    """
+    if STUDENT_TOKEN_ALGORITHM == "RS256":
+        return PRIVATE_KEY, PUBLIC_KEY
+    if STUDENT_TOKEN_ALGORITHM == "HS256":
+        if not STUDENT_TOKEN_SECRET:
+            raise ValueError("STUDENT_TOKEN_SECRET is required for HS256 student tokens")
+        return STUDENT_TOKEN_SECRET, STUDENT_TOKEN_SECRET
+    if STUDENT_TOKEN_ALGORITHM == "EdDSA":
+        with open(STUDENT_TOKEN_EDDSA_KEY, "rb") as key_file:
+            key = serialization.load_pem_private_key(key_file.read(), password=None)
+        return key, key.public_key()
+    raise ValueError("STUDENT_TOKEN_ALGORITHM must be 'RS256', 'HS256' or 'EdDSA'")
+
+
+STUDENT_SIGNING_KEY, STUDENT_VERIFYING_KEY = load_student_token_keys()
+verified_tokens = VerifiedTokenCache(TOKEN_CACHE_SIZE)
+
 def get_moodle_pubkey(kid):
     """
     Retrieves the public key associated with a key ID (kid) from Moodle.
@@ -51,7 +88,8 @@ def get_moodle_pubkey(kid):
     Raises:
         ValueError: If no key matches the kid provided.
     """
-    response = requests.get(MOODLE_CERT_URL).json()
+    with upstream_slot("moodle"):
+        response = requests.get(MOODLE_CERT_URL, timeout=MOODLE_TIMEOUT).json()
     for k in response['keys']:
         if k['kid'] == kid:
             return RSAAlgorithm.from_jwk(json.dumps(k))
@@ -136,7 +174,8 @@ def get_nrps_access():
         "scope": "https://purl.imsglobal.org/spec/lti-nrps/scope/contextmembership.readonly"
     }
 
-    response = requests.post(MOODLE_TOKEN_URL, data=data)
+    with upstream_slot("moodle"):
+        response = requests.post(MOODLE_TOKEN_URL, data=data, timeout=MOODLE_TIMEOUT)
     if response.status_code == 200:
         return response.json().get("access_token")
     else:
@@ -161,7 +200,8 @@ def get_member_nrps(nrps_url):
         "Authorization": f"Bearer {access_token}",
         "Accept": "application/vnd.ims.lti-nrps.v2.membershipcontainer+json"
     }
-    response = requests.get(nrps_url, headers=headers)
+    with upstream_slot("moodle"):
+        response = requests.get(nrps_url, headers=headers, timeout=MOODLE_TIMEOUT)
     if response.status_code == 200:
         return response.json().get("members", [])
     else:
@@ -188,6 +228,8 @@ def enrolled(nrps_url, sub, authorized_roles):
                 authorized = True
                 return authorized
                 
+    except Overloaded:
+        raise
     except Exception as e:
         return (f"Error verifying user registration : {str(e)}")
 
@@ -305,7 +347,7 @@ def dl_request_logic(request):
                 ]
 
         authorized = enrolled(nrps_url, sub, authorized_roles)
-        if authorized:
+        if authorized is True:
             session['dl_aud'] = payload.get("iss")
             deep_link_settings = payload.get("https://purl.imsglobal.org/spec/lti-dl/claim/deep_linking_settings", {})
             session['dl_urlret'] = deep_link_settings.get("deep_link_return_url")
@@ -318,6 +360,8 @@ def dl_request_logic(request):
         else:
             
             return jsonify({"Error": "Access denied: only instructors or administrators can access the selection interface"}), 403
+    except Overloaded:
+        raise
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
@@ -403,7 +447,8 @@ def launch_logic(request):
             if not res_id:
                 raise ValueError("No res_id in the token")
 
-            viewer_url = sessions_db.get(res_id, {}).get('viewer_url')
+            with upstream_slot("couchdb"):
+                viewer_url = sessions_db.get(res_id, {}).get('viewer_url')
             if not viewer_url:
                 raise ValueError(f"No session found for res_id {res_id}")
 
@@ -411,6 +456,13 @@ def launch_logic(request):
             description = resource_link_claim.get("description", "")
 
             authorized = enrolled(nrps_url, sub, authorized_roles)
+            # enrolled() returns an error message when NRPS cannot be queried, which denies access
+            event = {"authorized": authorized is True}
+            if isinstance(authorized, str):
+                event["error"] = authorized
+                authorized = False
+            event_log.record("launch", res_id=res_id, user=sub, viewer=viewer_name(viewer_url),
+                             display=AFFICHAGE_MOODLE, **event)
             if authorized:
                 
                 
@@ -421,7 +473,7 @@ def launch_logic(request):
                         "description": description,
                         "exp": int(time.time()) + 600
                     }
-                    token = jwt.encode(token_payload, PRIVATE_KEY, algorithm="RS256")
+                    token = jwt.encode(token_payload, STUDENT_SIGNING_KEY, algorithm=STUDENT_TOKEN_ALGORITHM)
                     redirect_url = f"http://localhost:5173/student?token={token}"
                 elif( AFFICHAGE_MOODLE == "Viewer"):
                     redirect_url = f"{viewer_url}"
@@ -438,6 +490,8 @@ def launch_logic(request):
         return jsonify({"Error": "Token expired"}), 401
     except jwt.InvalidTokenError:
         return jsonify({"Error": "Token invalid"}), 401
+    except Overloaded:
+        raise
     except Exception as e:
         print(f"Error in /launch : {e}")
         raise
@@ -447,19 +501,27 @@ def validate_token_logic(request):
     """
     Validates a token generated for the student (JWT signed on the backend side).
 
+    Tokens already verified are answered from a cache until they expire,
+    without verifying their signature again.
+
     Args:
         request (flask.Request): POST request containing the token.
 
     Returns:
         flask.Response: Information contained in the token if valid.
     """
-    data = request.get_json()
-    token = data.get("token")
+    data = request.get_json(silent=True)
+    token = data.get("token") if isinstance(data, dict) else None
     if not token:
         return jsonify({"Error": "Token missing"}), 400
+    if not isinstance(token, str):
+        return jsonify({"Error": "Token invalid"}), 401
 
     try:
-        payload = jwt.decode(token, PUBLIC_KEY, algorithms=["RS256"])
+        payload = verified_tokens.get(token)
+        if payload is None:
+            payload = jwt.decode(token, STUDENT_VERIFYING_KEY, algorithms=[STUDENT_TOKEN_ALGORITHM])
+            verified_tokens.put(token, payload)
         return jsonify({
             "res_id": payload.get("res_id"),
             "viewer_url": payload.get("viewer_url"),
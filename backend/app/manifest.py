@@ -0,0 +1,261 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from flask import Response, jsonify, send_file
+
+from app.config import MANIFEST_CACHE_DIR, MANIFEST_WORKERS
+from app.nodes import node_for
+
+_executor = ThreadPoolExecutor(max_workers=MANIFEST_WORKERS, thread_name_prefix="manifest")
+_pending = {}  # cache path -> Future of the generation in progress
+_lock = threading.Lock()
+
+
+def manifest_cache_path(study_id):
+    """
+    Computes the content address of the manifest of a study.
+
+    Args:
+        study_id (str): Internal Orthanc ID of the study.
+
+    Returns:
+        str: Path of the compressed manifest for the current LastUpdate of the study.
+
+    Raises:
+        requests.exceptions.RequestException: If the study cannot be read from Orthanc.
+    """
+    study = node_for("studies", study_id).client.get(f"/studies/{study_id}")
+    digest = hashlib.sha256(f"{study_id}|{study.get('LastUpdate', '')}".encode()).hexdigest()
+    return os.path.join(MANIFEST_CACHE_DIR, f"{digest}.json.gz")
+
+
+def latest_pointer_path(study_id):
+    """
+    Computes the file recording the last manifest generated for a study.
+
+    The pointer lives next to the manifests, so it survives restarts and is
+    shared by every worker using the same cache directory.
+
+    Args:
+        study_id (str): Internal Orthanc ID of the study.
+
+    Returns:
+        str: Path of the pointer file.
+    """
+    digest = hashlib.sha256(study_id.encode()).hexdigest()
+    return os.path.join(MANIFEST_CACHE_DIR, f"{digest}.latest")
+
+
+def latest_manifest(study_id):
+    """
+    Finds the last manifest generated for a study, whatever its LastUpdate.
+
+    Args:
+        study_id (str): Internal Orthanc ID of the study.
+
+    Returns:
+        str: Path of the compressed manifest, or None if there is none on disk.
+    """
+    try:
+        with open(latest_pointer_path(study_id)) as f:
+            name = os.path.basename(f.read().strip())
+    except OSError:
+        return None
+    path = os.path.join(MANIFEST_CACHE_DIR, name)
+    return path if name and os.path.exists(path) else None
+
+
+def fetch_manifest(study_id):
+    """
+    Generates the OHIF DICOM-JSON manifest of a study with Orthanc.
+
+    Instance URLs are made absolute, since the manifest is no longer served
+    from the Orthanc location they were relative to.
+
+    Args:
+        study_id (str): Internal Orthanc ID of the study.
+
+    Returns:
+        dict: The manifest.
+
+    Raises:
+        requests.exceptions.RequestException: If the manifest cannot be read from Orthanc.
+    """
+    node = node_for("studies", study_id)
+    source_url = f"{node.url}/studies/{study_id}/ohif-dicom-json"
+    # Read through a private response: results of OrthancClient.get are shared and read-only.
+    response = node.client.stream(f"/studies/{study_id}/ohif-dicom-json")
+    try:
+        manifest = response.json()
+    finally:
+        response.close()
+    for study in manifest.get("studies", []):
+        for serie in study.get("series", []):
+            for instance in serie.get("instances", []):
+                url = instance.get("url", "")
+                if url.startswith("dicomweb:"):
+                    instance["url"] = "dicomweb:" + urllib.parse.urljoin(source_url, url[len("dicomweb:"):])
+    return manifest
+
+
+def build_manifest(study_id, cache_path):
+    """
+    Generates the OHIF DICOM-JSON manifest of a study and stores it compressed.
+
+    Args:
+        study_id (str): Internal Orthanc ID of the study.
+        cache_path (str): Destination of the compressed manifest.
+
+    Returns:
+        str: The cache path.
+    """
+    try:
+        return _write_manifest(study_id, cache_path)
+    finally:
+        with _lock:
+            _pending.pop(cache_path, None)
+
+
+def _write_manifest(study_id, cache_path):
+    if os.path.exists(cache_path):
+        return cache_path
+    manifest = fetch_manifest(study_id)
+
+    os.makedirs(MANIFEST_CACHE_DIR, exist_ok=True)
+    suffix = f"{os.getpid()}.{threading.get_ident()}.part"
+    write_atomically(f"{cache_path}.{suffix}", cache_path,
+                     lambda f: f.write(gzip.compress(json.dumps(manifest).encode())))
+
+    previous = latest_manifest(study_id)
+    pointer = latest_pointer_path(study_id)
+    write_atomically(f"{pointer}.{suffix}", pointer,
+                     lambda f: f.write(os.path.basename(cache_path).encode()))
+    if previous and previous != cache_path:
+        try:
+            os.remove(previous)
+        except FileNotFoundError:
+            pass
+    return cache_path
+
+
+def write_atomically(tmp_path, path, write):
+    """
+    Writes a file through a temporary file, so readers never see it half written.
+
+    Args:
+        tmp_path (str): Temporary file, removed if the write fails.
+        path (str): Final path of the file.
+        write (callable): Called with the binary file object to fill.
+
+    Raises:
+        OSError: If the file cannot be written.
+    """
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def schedule_manifest(study_id, cache_path):
+    """
+    Starts the generation of a manifest in the background, unless it is already running.
+
+    Args:
+        study_id (str): Internal Orthanc ID of the study.
+        cache_path (str): Destination of the compressed manifest.
+
+    Returns:
+        concurrent.futures.Future: The generation in progress.
+    """
+    with _lock:
+        future = _pending.get(cache_path)
+        if future is None:
+            future = _executor.submit(build_manifest, study_id, cache_path)
+            _pending[cache_path] = future
+    return future
+
+
+def manifest_logic(study_id, request):
+    """
+    Serves the OHIF DICOM-JSON manifest of a study from the local cache.
+
+    A manifest matching the current LastUpdate of the study is sent as is.
+    When the study changed, the previous manifest is served while a new one is
+    generated in the background. A study never seen before waits for its first
+    generation. If the cache cannot be written, the previous manifest is
+    served, or else the manifest is sent without being cached.
+
+    Args:
+        study_id (str): Internal Orthanc ID of the study.
+        request (flask.Request): Incoming HTTP request.
+
+    Returns:
+        flask.Response: The manifest as JSON, or a JSON error.
+    """
+    try:
+        cache_path = manifest_cache_path(study_id)
+        if not os.path.exists(cache_path):
+            future = schedule_manifest(study_id, cache_path)
+            stale_path = latest_manifest(study_id)
+            if stale_path:
+                cache_path = stale_path
+            else:
+                future.result()
+        return send_manifest(cache_path, request)
+    except requests.exceptions.RequestException as e:
+        return jsonify({"Error": str(e)}), 500
+    except OSError as e:
+        print(f"Error caching the manifest of study {study_id} : {e}")
+        try:
+            return jsonify(fetch_manifest(study_id))
+        except requests.exceptions.RequestException as e:
+            return jsonify({"Error": str(e)}), 500
+
+
+def send_manifest(cache_path, request):
+    """
+    Sends a compressed manifest, decompressing it for clients that do not accept gzip.
+
+    Args:
+        cache_path (str): Path of the compressed manifest.
+        request (flask.Request): Incoming HTTP request.
+
+    Returns:
+        flask.Response: The manifest.
+    """
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        response = send_file(cache_path, mimetype="application/json", conditional=True)
+        response.headers["Content-Encoding"] = "gzip"
+        response.headers["Vary"] = "Accept-Encoding"
+        return response
+    with gzip.open(cache_path, "rb") as f:
+        return Response(f.read(), mimetype="application/json")
@@ -0,0 +1,217 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+import requests
+
+from app.config import ORTHANC_NODES, ORTHANC_NODE_CONCURRENCY, DATA_SOURCE
+from app.orthanc_client import OrthancClient
+from app.sources import make_source
+
+# Orthanc identifiers are SHA-1 digests split in five dash-separated groups.
+ORTHANC_ID = r"[0-9a-f]{8}(?:-[0-9a-f]{8}){4}"
+
+
+class OrthancNode:
+    """
+    One Orthanc server of the federation, with its client and data source.
+
+    Federated queries run on a thread pool of the node, and at most
+    `concurrency` of them may be in flight at once: a slow node can only hold
+    its own threads, never those of the other nodes.
+    """
+
+    def __init__(self, name, url, auth, timeout, data_source=DATA_SOURCE, concurrency=ORTHANC_NODE_CONCURRENCY):
+        self.name = name
+        self.url = url
+        self.timeout = timeout
+        self.client = OrthancClient(url, auth)
+        self.source = make_source(data_source, self.client)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix=f"federation-{name}")
+        self.slots = threading.BoundedSemaphore(concurrency)
+
+    def submit(self, task):
+        """
+        Runs a federated task on the pool of the node.
+
+        Args:
+            task (callable): Function querying the node.
+
+        Returns:
+            concurrent.futures.Future: The running task.
+
+        Raises:
+            NodeBusy: If `concurrency` tasks are still running on the node.
+        """
+        if not self.slots.acquire(blocking=False):
+            raise NodeBusy(f"Orthanc node {self.name} is busy")
+
+        def run():
+            try:
+                return task()
+            finally:
+                self.slots.release()
+
+        try:
+            return self.executor.submit(run)
+        except Exception:
+            self.slots.release()
+            raise
+
+
+NODES = [OrthancNode(**node) for node in ORTHANC_NODES]
+
+_locations = {}  # Orthanc resource ID -> node holding it
+_lock = threading.Lock()
+
+
+def is_orthanc_id(value):
+    """
+    Checks that a value received from a client is an Orthanc identifier.
+
+    Args:
+        value: Value to check.
+
+    Returns:
+        bool: True if the value can safely be used in Orthanc paths and cache paths.
+    """
+    return isinstance(value, str) and re.fullmatch(ORTHANC_ID, value) is not None
+
+
+class NodeTimeout(requests.exceptions.Timeout):
+    """
+    Raised for a node that did not answer a federated query within its timeout.
+    """
+
+
+class NodeBusy(requests.exceptions.ConnectionError):
+    """
+    Raised for a node whose previous federated queries are all still running.
+    """
+
+
+def run_on_nodes(tasks):
+    """
+    Runs one task per node concurrently, each bounded by the timeout of its node.
+
+    The total duration is that of the slowest node, capped by the largest timeout.
+    Tasks still running after their timeout are reported as failed and their
+    result is discarded; they keep one of the slots of their node until they
+    finish, and a node without a free slot fails immediately with NodeBusy.
+
+    Args:
+        tasks (dict): Callables keyed by OrthancNode.
+
+    Returns:
+        tuple: Results keyed by node, errors keyed by node, and durations in
+            seconds keyed by node name.
+    """
+    start = time.monotonic()
+    futures, errors = {}, {}
+    for node, task in tasks.items():
+        try:
+            futures[node] = node.submit(task)
+        except NodeBusy as e:
+            errors[node] = e
+    durations = {}
+
+    def track(node):
+        return lambda _: durations.setdefault(node.name, time.monotonic() - start)
+
+    for node, future in futures.items():
+        future.add_done_callback(track(node))
+
+    results = {}
+    for node, future in futures.items():
+        remaining = node.timeout - (time.monotonic() - start)
+        wait([future], timeout=max(0, remaining))
+        if not future.done():
+            errors[node] = NodeTimeout(f"Orthanc node {node.name} timed out")
+        elif future.exception() is not None:
+            errors[node] = future.exception()
+        else:
+            results[node] = future.result()
+    return results, errors, dict(durations)
+
+
+def query_nodes(fn):
+    """
+    Runs a query on every node concurrently.
+
+    Args:
+        fn (callable): Function taking an OrthancNode and returning its result.
+
+    Returns:
+        tuple: Results keyed by node (in configuration order), names of the
+            nodes that failed, and durations in seconds keyed by node name.
+
+    Raises:
+        requests.exceptions.RequestException: If every node failed.
+    """
+    results, errors, durations = run_on_nodes({node: (lambda node=node: fn(node)) for node in NODES})
+    if errors and not results:
+        raise next(iter(errors.values()))
+    ordered = {node: results[node] for node in NODES if node in results}
+    return ordered, [node.name for node in errors], durations
+
+
+def remember(resource_id, node):
+    """
+    Records which node holds a study or series.
+
+    Args:
+        resource_id (str): Internal Orthanc ID of the resource.
+        node (OrthancNode): Node holding it.
+    """
+    with _lock:
+        _locations[resource_id] = node
+
+
+def node_for(level, resource_id):
+    """
+    Finds the node holding a study or series.
+
+    Resources seen in a listing are known; others are looked up on every node
+    concurrently, the first node in configuration order that has it winning.
+
+    Args:
+        level (str): "studies" or "series".
+        resource_id (str): Internal Orthanc ID of the resource.
+
+    Returns:
+        OrthancNode: The node holding the resource.
+
+    Raises:
+        requests.exceptions.RequestException: If no node has the resource.
+    """
+    with _lock:
+        node = _locations.get(resource_id)
+    if node is not None:
+        return node
+    if len(NODES) == 1:
+        return NODES[0]
+    results, errors, _ = run_on_nodes({node: (lambda node=node: node.client.get(f"/{level}/{resource_id}"))
+                                       for node in NODES})
+    for node in NODES:
+        if node in results:
+            remember(resource_id, node)
+            return node
+    raise next(iter(errors.values()))
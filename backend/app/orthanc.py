@@ -18,57 +18,303 @@
 
 import requests
 from flask import jsonify
-from app.config import ORTHANC_URL, ORTHANC_AUTH, sessions_db
+from app.config import ORTHANC_URL, BACKEND_URL, SERIES_PREFETCH_COUNT, sessions_db
+from app.admission import upstream_slot
+from app.events import event_log, viewer_name
+from app.nodes import NODES, node_for, query_nodes, remember, run_on_nodes
+from app.resilience import with_last_known_good, payload_response, unavailable_response
 
-def get_studies_logic():
+
+class SeriesIndex:
+    """
+    Local index of expanded Orthanc series, keyed by Orthanc study ID.
+
+    Entries not set locally are read from `base`, a read-only mapping such as
+    the series of a memory-mapped snapshot. Removing an entry also hides it
+    in the base.
+    """
+
+    def __init__(self):
+        self.base = {}
+        self._local = {}
+        self._hidden = set()
+
+    def get(self, study_id, default=None):
+        if study_id in self._local:
+            return self._local[study_id]
+        if study_id in self._hidden:
+            return default
+        return self.base.get(study_id, default)
+
+    def __contains__(self, study_id):
+        return self.get(study_id) is not None
+
+    def __setitem__(self, study_id, series):
+        self._local[study_id] = series
+
+    def update(self, entries):
+        self._local.update(entries)
+
+    def pop(self, study_id, default=None):
+        value = self.get(study_id, default)
+        self._local.pop(study_id, None)
+        self._hidden.add(study_id)
+        return value
+
+    def clear_local(self):
+        """
+        Forgets the entries set locally.
+
+        The base is kept, with the entries hidden in it, so the series of a
+        mapped snapshot survive a reload of the study list.
+        """
+        self._local = {}
+
+    def clear(self, base=None):
+        """
+        Empties the index.
+
+        Args:
+            base (Mapping, optional): New read-only base, none by default.
+        """
+        self.base = base if base is not None else {}
+        self._local = {}
+        self._hidden = set()
+
+
+# Local entries are reset each time the study list is reloaded from Orthanc.
+SERIES_INDEX = SeriesIndex()
+
+
+def format_study(study, is_wsi, node=None):
+    """
+    Builds the frontend representation of an Orthanc study.
+
+    Args:
+        study (dict): Expanded study resource returned by Orthanc.
+        is_wsi (bool): Whether the study contains Whole Slide Imaging data.
+        node (OrthancNode, optional): Node holding the study, the first node by default.
+
+    Returns:
+        dict: Study metadata and viewer links.
+    """
+    node = node or NODES[0]
+    return {
+        "is_study": True,
+        "_id": study.get('ID', 'N/A'),
+        "date": study.get('MainDicomTags', {}).get('StudyDate', 'N/A'),
+        "institutionName": study.get('MainDicomTags', {}).get('InstitutionName', 'N/A'),
+        "referringPhysicianName": study.get('MainDicomTags', {}).get('ReferringPhysicianName', 'N/A'),
+        "requestedProcedureDescription": study.get('MainDicomTags', {}).get('RequestedProcedureDescription', 'N/A'),
+        "description": study.get('MainDicomTags', {}).get('StudyDescription', 'N/A'),
+        "studyUID": study.get('MainDicomTags', {}).get('StudyInstanceUID', 'N/A'),
+        "PatientName": study.get('PatientMainDicomTags', {}).get('PatientName', 'N/A'),
+        "series": study.get('Series', []),
+        "modalities": study.get('ModalitiesInStudy', []),
+        "is_wsi": is_wsi,
+        "node": node.name,
+        "links": generate_study_link(
+            study.get('ID', 'N/A'),
+            study.get('MainDicomTags', {}).get('StudyInstanceUID', 'N/A'),
+            is_wsi,
+            node.url
+        )
+    }
+
+
+def list_studies(limit=None, offset=0):
     """
-    Retrieves all available DICOM studies from the Orthanc server.
+    Retrieves the available DICOM studies from every Orthanc node.
+
+    Nodes are queried concurrently, so the listing takes as long as the slowest
+    node. Studies present on several nodes (same StudyInstanceUID) are listed
+    once, for the first node in configuration order. Nodes that fail or exceed
+    their timeout are left out and reported.
+
+    Paging applies to the merged listing: each node returns its first
+    `offset + limit` studies, and the page is cut from their merge, so pages
+    follow one another without gaps or overlaps whatever the number of nodes.
 
     For each study:
     - Checks if it contains Whole Slide Imaging (WSI) data (based on modality 'SM').
     - Adds study and series metadata for frontend display.
     - Generates appropriate viewer links based on study type (WSI or classic).
 
+    Args:
+        limit (int, optional): Maximum number of studies to return.
+        offset (int): Number of merged studies to skip.
+
+    Returns:
+        dict: "Studies" formatted for the frontend, "Unavailable" node names and
+            listing "Durations" in seconds per node.
+
+    Raises:
+        requests.exceptions.RequestException: If no node can be queried.
+    """
+    offset = max(offset, 0)
+    per_node = offset + limit if limit else None
+    results, unavailable, durations = query_nodes(lambda node: node.source.list_studies(per_node))
+    SERIES_INDEX.clear_local()
+    studies_to_front = []
+    seen = set()
+    for node, studies_data in results.items():
+        for study in studies_data:
+            study_uid = study.get('MainDicomTags', {}).get('StudyInstanceUID')
+            if study_uid in seen:
+                continue
+            seen.add(study_uid)
+            remember(study.get('ID'), node)
+            for serie_id in study.get('Series', []):
+                remember(serie_id, node)
+            studies_to_front.append(format_study(study, 'SM' in study.get('ModalitiesInStudy', []), node))
+    if limit:
+        studies_to_front = studies_to_front[offset:offset + limit]
+    return {"Studies": studies_to_front, "Unavailable": unavailable, "Durations": durations}
+
+
+def listing_response(listing, age, studies=None):
+    """
+    Builds the response of a study listing.
+
+    Args:
+        listing (dict): Result of list_studies.
+        age (float): Age of the listing in seconds, None when fresh.
+        studies (list, optional): Studies to send instead of the whole listing.
+
+    Returns:
+        flask.Response: JSON with key "Studies". Nodes missing from the listing
+            are named in an X-Unavailable-Nodes header, and the listing time of
+            each node is reported in a Server-Timing header.
+    """
+    response = payload_response({"Studies": listing["Studies"] if studies is None else studies}, age)
+    if listing["Unavailable"]:
+        response.headers["X-Unavailable-Nodes"] = ",".join(listing["Unavailable"])
+    if age is None:
+        sources = {node.name: node.source.name for node in NODES}
+        response.headers["Server-Timing"] = ", ".join(
+            f'{name};desc="{sources.get(name)}";dur={1000 * duration:.2f}'
+            for name, duration in listing["Durations"].items())
+    return response
+
+
+def get_studies_logic(prefetch=SERIES_PREFETCH_COUNT, limit=None, offset=0):
+    """
+    Returns the available DICOM studies.
+
+    If Orthanc is unavailable, the last successful listing is returned with
+    staleness headers while it is refreshed in the background.
+
+    Args:
+        prefetch (int): Number of leading studies whose series are embedded
+            in the response under the "seriesDetails" key (0 disables prefetching).
+        limit (int, optional): Maximum number of studies to return (paging).
+        offset (int): Number of studies to skip (paging).
+
     Returns:
         JSON: Dictionary with key "Studies" containing a list of studies.
     """
     try:
-        response = requests.get(f"{ORTHANC_URL}/studies", auth=ORTHANC_AUTH,
-                                params={"expand": "true", "includeField": "All"})
-        response.raise_for_status()
-        studies_data = response.json()
-        studies_to_front = []
-
-        for study in studies_data:
-            is_wsi = False
-            for serie in study.get('Series', []):
-                serie_response = requests.get(f"{ORTHANC_URL}/series/{serie}", auth=ORTHANC_AUTH)
-                serie_response.raise_for_status()
-                serie_data = serie_response.json()
-                if serie_data.get('MainDicomTags', {}).get('Modality') == 'SM':
-                    is_wsi = True
-                    break
-            studies_to_front.append({
-                "is_study": True,
-                "_id": study.get('ID', 'N/A'),
-                "date": study.get('MainDicomTags', {}).get('StudyDate', 'N/A'),
-                "institutionName": study.get('MainDicomTags', {}).get('InstitutionName', 'N/A'),
-                "referringPhysicianName": study.get('MainDicomTags', {}).get('ReferringPhysicianName', 'N/A'),
-                "requestedProcedureDescription": study.get('MainDicomTags', {}).get('RequestedProcedureDescription', 'N/A'),
-                "description": study.get('MainDicomTags', {}).get('StudyDescription', 'N/A'),
-                "studyUID": study.get('MainDicomTags', {}).get('StudyInstanceUID', 'N/A'),
-                "PatientName": study.get('PatientMainDicomTags', {}).get('PatientName', 'N/A'),
-                "series": study.get('Series', []),
-                "is_wsi": is_wsi,
-                "links": generate_study_link(
-                    study.get('ID', 'N/A'),
-                    study.get('MainDicomTags', {}).get('StudyInstanceUID', 'N/A'),
-                    is_wsi
-                )
-            })
-        return jsonify({"Studies": studies_to_front})
+        listing, age = with_last_known_good(("studies", limit, offset), lambda: list_studies(limit, offset))
+        studies = listing["Studies"]
+        if age is None:
+            studies = with_series_details(studies, prefetch)
+        return listing_response(listing, age, studies)
     except requests.exceptions.RequestException as e:
-        return jsonify({"Error": str(e)}), 500
+        return unavailable_response(e)
+
+
+def with_series_details(studies, prefetch):
+    """
+    Embeds the series of the leading studies of a list under the "seriesDetails" key.
+
+    Prefetching is an optimisation: if the series cannot be read, the studies
+    are returned unchanged.
+
+    Args:
+        studies (list): Studies formatted for the frontend.
+        prefetch (int): Number of leading studies whose series are embedded (0 disables prefetching).
+
+    Returns:
+        list: A copy of the studies, the first `prefetch` ones with their series.
+    """
+    studies = list(studies)
+    if prefetch <= 0:
+        return studies
+    try:
+        series_by_study = fetch_series_batch(studies[:prefetch])
+    except requests.exceptions.RequestException:
+        return studies
+    for i, study in enumerate(studies[:prefetch]):
+        if study["_id"] in series_by_study:
+            studies[i] = dict(study, seriesDetails=[
+                format_series(serie, study["studyUID"], study["is_wsi"], node_for("studies", study["_id"]))
+                for serie in series_by_study[study["_id"]]])
+    return studies
+
+
+def format_series(serie, study_uid, is_wsi, node=None):
+    """
+    Builds the frontend representation of an Orthanc series.
+
+    Args:
+        serie (dict): Expanded series resource returned by Orthanc.
+        study_uid (str): DICOM UID of the parent study.
+        is_wsi (bool): Indicates whether the parent study is Whole Slide Imaging.
+        node (OrthancNode, optional): Node holding the series, the first node by default.
+
+    Returns:
+        dict: Series metadata and viewer links.
+    """
+    node = node or NODES[0]
+    return {
+        "is_study": False,
+        "serieID": serie.get('ID', 'N/A'),
+        "modality": serie.get('MainDicomTags', {}).get('Modality', 'N/A'),
+        "bodyPart": serie.get('MainDicomTags', {}).get('BodyPartExamined', 'N/A'),
+        "operator": serie.get('MainDicomTags', {}).get('OperatorsName', 'N/A'),
+        "protocol": serie.get('MainDicomTags', {}).get('ProtocolName', 'N/A'),
+        "descriptionProcedure": serie.get('MainDicomTags', {}).get('PerformedProcedureStepDescription', 'N/A'),
+        "description": serie.get('MainDicomTags', {}).get('SeriesDescription', 'N/A'),
+        "seriesUID": serie.get('MainDicomTags', {}).get('SeriesInstanceUID', 'N/A'),
+        "links": generate_series_link(study_uid, serie.get('ID', 'N/A'),
+                                       serie.get('MainDicomTags', {}).get('SeriesInstanceUID', 'N/A'),
+                                       is_wsi, node.url)
+    }
+
+
+def fetch_series_batch(studies):
+    """
+    Loads the series of several studies into the local series index.
+
+    Studies already indexed are answered locally; the others are resolved with
+    a single query per node, matching on the list of StudyInstanceUIDs. Nodes
+    are queried concurrently. Studies without a UID ("N/A" placeholder) are
+    returned without series.
+
+    Args:
+        studies (list): Dictionaries with "_id" and "studyUID" keys.
+
+    Returns:
+        dict: Expanded Orthanc series lists keyed by Orthanc study ID.
+
+    Raises:
+        requests.exceptions.RequestException: If the Orthanc query fails.
+    """
+    missing = {}
+    for study in studies:
+        if study.get("_id") not in SERIES_INDEX and study.get("studyUID") not in (None, "", "N/A"):
+            missing.setdefault(node_for("studies", study["_id"]), []).append(study)
+    if missing:
+        results, errors, _ = run_on_nodes({node: (lambda node=node, group=group: node.source.find_series(group))
+                                           for node, group in missing.items()})
+        for node, found in results.items():
+            for study_id, series in found.items():
+                for serie in series:
+                    remember(serie.get("ID"), node)
+            SERIES_INDEX.update(found)
+        if errors and not results:
+            raise next(iter(errors.values()))
+    return {s.get("_id"): SERIES_INDEX.get(s.get("_id"), []) for s in studies}
 
 
 def get_series_logic(study_id, study_uid=None, is_wsi=False):
@@ -83,30 +329,46 @@ def get_series_logic(study_id, study_uid=None, is_wsi=False):
     Returns:
         JSON: Dictionary with key "Series" containing a list of series.
     """
-    try:
-        response = requests.get(f"{ORTHANC_URL}/studies/{study_id}/series", auth=ORTHANC_AUTH,
-                                params={"expand": "true", "includeField": "All"})
-        response.raise_for_status()
-        series_data = response.json()
-        series_list = []
+    def build():
+        node = node_for("studies", study_id)
+        series_data = SERIES_INDEX.get(study_id)
+        if series_data is None:
+            series_data = node.source.list_series(study_id, study_uid)
+            SERIES_INDEX[study_id] = series_data
         for serie in series_data:
-            series_list.append({
-                "is_study": False,
-                "serieID": serie.get('ID', 'N/A'),
-                "modality": serie.get('MainDicomTags', {}).get('Modality', 'N/A'),
-                "bodyPart": serie.get('MainDicomTags', {}).get('BodyPartExamined', 'N/A'),
-                "operator": serie.get('MainDicomTags', {}).get('OperatorsName', 'N/A'),
-                "protocol": serie.get('MainDicomTags', {}).get('ProtocolName', 'N/A'),
-                "descriptionProcedure": serie.get('MainDicomTags', {}).get('PerformedProcedureStepDescription', 'N/A'),
-                "description": serie.get('MainDicomTags', {}).get('SeriesDescription', 'N/A'),
-                "seriesUID": serie.get('MainDicomTags', {}).get('SeriesInstanceUID', 'N/A'),
-                "links": generate_series_link(study_uid, serie.get('ID', 'N/A'),
-                                               serie.get('MainDicomTags', {}).get('SeriesInstanceUID', 'N/A'),
-                                               is_wsi)
-            })
-        return jsonify({"Series": series_list})
+            remember(serie.get("ID"), node)
+        return [format_series(serie, study_uid, is_wsi, node) for serie in series_data]
+
+    try:
+        series_list, age = with_last_known_good(("series", study_id, study_uid, is_wsi), build)
+        return payload_response({"Series": series_list}, age)
+    except requests.exceptions.RequestException as e:
+        return unavailable_response(e)
+
+
+def get_series_batch_logic(data):
+    """
+    Retrieves the series of several studies in one call.
+
+    Args:
+        data (dict): Contains a "Studies" list of {"_id", "studyUID", "is_wsi"} dictionaries.
+
+    Returns:
+        JSON: Dictionary with key "Series" mapping each study ID to its list of series.
+    """
+    studies = (data or {}).get("Studies")
+    if not isinstance(studies, list) or not studies:
+        return jsonify({"Error": "A non-empty list of studies is required"}), 400
+    try:
+        series_by_study = fetch_series_batch(studies)
+        return jsonify({"Series": {
+            study.get("_id"): [format_series(serie, study.get("studyUID"), bool(study.get("is_wsi")),
+                                             node_for("studies", study.get("_id")))
+                               for serie in series_by_study.get(study.get("_id"), [])]
+            for study in studies
+        }})
     except requests.exceptions.RequestException as e:
-        return jsonify({"Error": str(e)}), 500
+        return unavailable_response(e)
 
 def search_studies_logic(term, study_type):
     """
@@ -122,39 +384,11 @@ def search_studies_logic(term, study_type):
     if not term:
         return jsonify({"Error": "A search term is required"}), 400
     try:
-        response = requests.get(f"{ORTHANC_URL}/studies", auth=ORTHANC_AUTH,
-                                params={"expand": "true", "includeField": "All"})
-        response.raise_for_status()
-        studies_data = response.json()
+        listing, age = with_last_known_good(("studies", None, 0), list_studies)
         results = []
 
-        for study in studies_data:
-           
-            is_wsi = False
-            for serie_id in study.get('Series', []):
-                serie_response = requests.get(f"{ORTHANC_URL}/series/{serie_id}", auth=ORTHANC_AUTH)
-                serie_response.raise_for_status()
-                serie_data = serie_response.json()
-                if serie_data.get('MainDicomTags', {}).get('Modality') == 'SM':
-                    is_wsi = True
-                    break
-
-            study_info = {
-                "_id": study.get('ID', 'N/A'),
-                "date": study.get('MainDicomTags', {}).get('StudyDate', 'N/A'),
-                "institutionName": study.get('MainDicomTags', {}).get('InstitutionName', 'N/A'),
-                "referringPhysicianName": study.get('MainDicomTags', {}).get('ReferringPhysicianName', 'N/A'),
-                "requestedProcedureDescription": study.get('MainDicomTags', {}).get('RequestedProcedureDescription', 'N/A'),
-                "description": study.get('MainDicomTags', {}).get('StudyDescription', 'N/A'),
-                "studyUID": study.get('MainDicomTags', {}).get('StudyInstanceUID', 'N/A'),
-                "PatientName": study.get('PatientMainDicomTags', {}).get('PatientName', 'N/A'),
-                "series": study.get('Series', []),
-                "is_wsi": is_wsi,
-                "links": generate_study_link(study.get('ID', 'N/A'),
-                                             study.get('MainDicomTags', {}).get('StudyInstanceUID', 'N/A'),
-                                             is_wsi)
-            }
-
+        for study_info in listing["Studies"]:
+            is_wsi = study_info["is_wsi"]
             if any(term.lower() in str(value).lower() for value in study_info.values() if isinstance(value, str)):
                 if study_type == "classic" and is_wsi:
                     continue
@@ -162,11 +396,11 @@ def search_studies_logic(term, study_type):
                     continue
                 results.append(study_info)
 
-        return jsonify({"Studies": results})
+        return listing_response(listing, age, results)
     except requests.exceptions.RequestException as e:
-        return jsonify({"Error": str(e)}), 500
-    
-def generate_study_link(study_id, study_uid, is_wsi):
+        return unavailable_response(e)
+
+def generate_study_link(study_id, study_uid, is_wsi, orthanc_url=ORTHANC_URL):
     """
     Generates viewer URLs for a given study.
 
@@ -174,6 +408,7 @@ def generate_study_link(study_id, study_uid, is_wsi):
         study_id (str): Internal Orthanc ID.
         study_uid (str): DICOM UID.
         is_wsi (bool): Whether the study is WSI.
+        orthanc_url (str): URL of the Orthanc node hosting the viewers.
 
     Returns:
         list: Viewer link dictionaries.
@@ -183,34 +418,34 @@ def generate_study_link(study_id, study_uid, is_wsi):
         links.extend([
         {
             'label': 'Stone',
-            'url': f"{ORTHANC_URL}/stone-webviewer/index.html?study={study_uid}"
+            'url': f"{orthanc_url}/stone-webviewer/index.html?study={study_uid}"
         },
         {
             'label': 'VolView',
-            'url': f"{ORTHANC_URL}/volview/index.html?names=[archive.zip]&urls=[../studies/{study_id}/archive]"
+            'url': f"{orthanc_url}/volview/index.html?names=[archive.zip]&urls=[{BACKEND_URL}/studies/{study_id}/archive]"
         }])
     else:
         links.extend([
             {
                 'label': 'Stone',
-                'url': f"{ORTHANC_URL}/stone-webviewer/index.html?study={study_uid}"
+                'url': f"{orthanc_url}/stone-webviewer/index.html?study={study_uid}"
             },
             {
                 'label': 'OHIF',
-                'url': f"{ORTHANC_URL}/ohif/viewer?url=../studies/{study_id}/ohif-dicom-json"
+                'url': f"{orthanc_url}/ohif/viewer?url={BACKEND_URL}/studies/{study_id}/ohif-dicom-json"
             },
             {
                 'label': 'OHIF VR',
-                'url': f"{ORTHANC_URL}/ohif/viewer?hangingprotocolId=mprAnd3DVolumeViewport&url=../studies/{study_id}/ohif-dicom-json"
+                'url': f"{orthanc_url}/ohif/viewer?hangingprotocolId=mprAnd3DVolumeViewport&url={BACKEND_URL}/studies/{study_id}/ohif-dicom-json"
             },
             {
                 'label': 'VolView',
-                'url': f"{ORTHANC_URL}/volview/index.html?names=[archive.zip]&urls=[../studies/{study_id}/archive]"
+                'url': f"{orthanc_url}/volview/index.html?names=[archive.zip]&urls=[{BACKEND_URL}/studies/{study_id}/archive]"
             }
         ])
     return links
 
-def generate_series_link(study_uid, serie_id, series_uid, is_wsi):
+def generate_series_link(study_uid, serie_id, series_uid, is_wsi, orthanc_url=ORTHANC_URL):
     """
     Generates viewer URLs for a given series.
 
@@ -219,6 +454,7 @@ def generate_series_link(study_uid, serie_id, series_uid, is_wsi):
         serie_id (str): Internal Orthanc ID.
         series_uid (str): DICOM Series UID.
         is_wsi (bool): Whether the series is WSI.
+        orthanc_url (str): URL of the Orthanc node hosting the viewers.
 
     Returns:
         list: Viewer link dictionaries.
@@ -228,22 +464,22 @@ def generate_series_link(study_uid, serie_id, series_uid, is_wsi):
         links.extend([
             {
                 'label': 'VolView',
-                'url': f"{ORTHANC_URL}/volview/index.html?names=[archive.zip]&urls=[../series/{serie_id}/archive]"
+                'url': f"{orthanc_url}/volview/index.html?names=[archive.zip]&urls=[{BACKEND_URL}/series/{serie_id}/archive]"
             },
             {
                 'label': 'WholeSlide',
-                'url': f"{ORTHANC_URL}/wsi/app/viewer.html?series={serie_id}"
+                'url': f"{BACKEND_URL}/wsi/app/viewer.html?series={serie_id}"
             }
         ])
     else:
         links.extend([
             {
                 'label': 'Stone',
-                'url': f"{ORTHANC_URL}/stone-webviewer/index.html?study={study_uid}&series={series_uid}"
+                'url': f"{orthanc_url}/stone-webviewer/index.html?study={study_uid}&series={series_uid}"
             },
             {
                 'label': 'VolView',
-                'url': f"{ORTHANC_URL}/volview/index.html?names=[archive.zip]&urls=[../series/{serie_id}/archive]"
+                'url': f"{orthanc_url}/volview/index.html?names=[archive.zip]&urls=[{BACKEND_URL}/series/{serie_id}/archive]"
             }
         ])
     return links
@@ -262,5 +498,10 @@ def save_session_logic(data):
     viewer_url = data.get("viewer_url")
     if not session_id or not viewer_url:
         return jsonify({"Error": "Missing session_id or viewer_url"}), 400
-    sessions_db[session_id] = {"session": session_id, "viewer_url": viewer_url}
+    with upstream_slot("couchdb"):
+        sessions_db[session_id] = {"session": session_id, "viewer_url": viewer_url}
+    event_log.record("session_saved", res_id=session_id, viewer=viewer_name(viewer_url))
+
+    from app.warmup import schedule_session_warmup
+    schedule_session_warmup(viewer_url)
     return jsonify({"Message": "Session successfully recorded", "session": session_id})
@@ -0,0 +1,197 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import json
+import threading
+import time
+import requests
+
+from app.config import ORTHANC_COALESCE_WINDOW, ORTHANC_TIMEOUT
+from app.resilience import CircuitBreaker
+
+
+class _Call:
+    """
+    A single upstream call shared by every thread asking for the same resource.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished_at = 0.0
+
+
+class OrthancClient:
+    """
+    JSON client for the Orthanc REST API with request coalescing.
+
+    Concurrent identical requests (same method, path, parameters and body) share
+    one upstream call and its parsed result. A finished result is reused by
+    identical requests for `window` seconds. Failures are shared with the threads
+    already waiting but are never reused afterwards.
+
+    Every upstream call has a timeout and goes through a circuit breaker, so an
+    unreachable Orthanc makes calls fail fast instead of holding workers.
+    Orthanc answers 5xx for instances it cannot render (unsupported transfer
+    syntax, corrupt file), so these do not count against the breaker for the
+    raw content calls of get_bytes.
+
+    Results are shared between callers and must be treated as read-only.
+    """
+
+    def __init__(self, url, auth, window=ORTHANC_COALESCE_WINDOW, timeout=ORTHANC_TIMEOUT):
+        self.url = url
+        self.auth = auth
+        self.window = window
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(f"Orthanc {url}")
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def get(self, path, params=None):
+        """
+        Sends a GET request to Orthanc and returns the decoded JSON.
+
+        Args:
+            path (str): Path relative to the Orthanc root, e.g. "/studies".
+            params (dict, optional): Query string parameters.
+
+        Returns:
+            The decoded JSON response.
+
+        Raises:
+            requests.exceptions.RequestException: If the request fails.
+        """
+        key = ("GET", path, json.dumps(params, sort_keys=True))
+        return self._single_flight(key, lambda: self._request("GET", path, params=params))
+
+    def post(self, path, payload):
+        """
+        Sends a POST request with a JSON body to Orthanc and returns the decoded JSON.
+
+        Args:
+            path (str): Path relative to the Orthanc root, e.g. "/tools/find".
+            payload (dict): JSON body of the request.
+
+        Returns:
+            The decoded JSON response.
+
+        Raises:
+            requests.exceptions.RequestException: If the request fails.
+        """
+        key = ("POST", path, json.dumps(payload, sort_keys=True))
+        return self._single_flight(key, lambda: self._request("POST", path, json=payload))
+
+    def get_bytes(self, path, params=None, headers=None):
+        """
+        Sends a GET request to Orthanc and returns the raw body, with coalescing.
+
+        Args:
+            path (str): Path relative to the Orthanc root, e.g. "/wsi/tiles/{id}/0/0/0".
+            params (dict, optional): Query string parameters.
+            headers (dict, optional): Request headers, e.g. "Accept".
+
+        Returns:
+            tuple: The Content-Type header and the body as bytes.
+
+        Raises:
+            requests.exceptions.RequestException: If the request fails.
+        """
+        def fetch():
+            response = requests.get(f"{self.url}{path}", params=params, headers=headers,
+                                    auth=self.auth, timeout=self.timeout)
+            response.raise_for_status()
+            return response.headers.get("Content-Type", "application/octet-stream"), response.content
+
+        key = ("GET", path, "bytes", json.dumps(params, sort_keys=True), json.dumps(headers, sort_keys=True))
+        return self._single_flight(key, lambda: self.breaker.call(fetch, server_errors=False))
+
+    def stream(self, path, headers=None):
+        """
+        Opens a streaming GET request to Orthanc, bypassing coalescing.
+
+        Args:
+            path (str): Path relative to the Orthanc root, e.g. "/studies/{id}/archive".
+            headers (dict, optional): Extra request headers such as "Range".
+
+        Returns:
+            requests.Response: The open response; the caller must close it.
+
+        Raises:
+            requests.exceptions.RequestException: If the request fails.
+        """
+        def fetch():
+            response = requests.get(f"{self.url}{path}", auth=self.auth, headers=headers,
+                                    stream=True, timeout=self.timeout)
+            try:
+                response.raise_for_status()
+            except requests.exceptions.HTTPError:
+                response.close()
+                raise
+            return response
+
+        return self.breaker.call(fetch)
+
+    def _request(self, method, path, **kwargs):
+        def fetch():
+            response = requests.request(method, f"{self.url}{path}", auth=self.auth,
+                                        timeout=self.timeout, **kwargs)
+            response.raise_for_status()
+            return response.json()
+
+        return self.breaker.call(fetch)
+
+    def _single_flight(self, key, fetch):
+        now = time.monotonic()
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and call.done.is_set() and now - call.finished_at >= self.window:
+                call = None
+            leader = call is None
+            if leader:
+                self._prune(now)
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fetch()
+        except Exception as e:
+            call.error = e
+        call.finished_at = time.monotonic()
+        with self._lock:
+            if call.error is not None or self.window <= 0:
+                self._calls.pop(key, None)
+        call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def _prune(self, now):
+        # Drops finished calls whose micro-cache window has elapsed.
+        expired = [key for key, call in self._calls.items()
+                   if call.done.is_set() and now - call.finished_at >= self.window]
+        for key in expired:
+            del self._calls[key]
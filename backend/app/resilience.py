@@ -0,0 +1,234 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import threading
+import time
+from collections import OrderedDict
+import requests
+from flask import jsonify
+
+from app.config import (
+    ORTHANC_BREAKER_FAILURES,
+    ORTHANC_BREAKER_RESET,
+    STALE_CACHE_SIZE,
+    STALE_REFRESH_ATTEMPTS
+)
+
+
+class UpstreamUnavailable(requests.exceptions.ConnectionError):
+    """
+    Raised without contacting the upstream server while its circuit breaker is open.
+
+    `retry_after` holds the number of seconds before the next trial call.
+    """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Fails fast after repeated upstream errors.
+
+    After `failures` consecutive errors the breaker opens and every call raises
+    UpstreamUnavailable immediately. Once `reset` seconds have elapsed, a single
+    trial call is let through: its success closes the breaker, its failure
+    opens it again.
+
+    Connection errors, timeouts, 5xx responses and unexpected exceptions count
+    as failures; other HTTP errors do not. Calls made with `server_errors`
+    False do not count 5xx responses either, for content the upstream may
+    fail to render while being healthy.
+    """
+
+    def __init__(self, name, failures=ORTHANC_BREAKER_FAILURES, reset=ORTHANC_BREAKER_RESET):
+        self.name = name
+        self.failures = failures
+        self.reset = reset
+        self._consecutive = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def call(self, fn, server_errors=True):
+        """
+        Runs an upstream call through the breaker.
+
+        Args:
+            fn (callable): Function performing the call.
+            server_errors (bool): Whether 5xx responses count as failures.
+
+        Returns:
+            The result of `fn`.
+
+        Raises:
+            UpstreamUnavailable: If the breaker is open.
+            requests.exceptions.RequestException: If the call fails.
+        """
+        with self._lock:
+            if self._opened_at is not None:
+                elapsed = time.monotonic() - self._opened_at
+                if self._trial or elapsed < self.reset:
+                    raise UpstreamUnavailable(f"{self.name} unavailable, retry later",
+                                              max(1, int(self.reset - elapsed)))
+                self._trial = True
+        # Every outcome is recorded, so an unexpected exception never leaves a trial pending.
+        failed = True
+        try:
+            result = fn()
+            failed = False
+            return result
+        except requests.exceptions.RequestException as e:
+            failed = self._is_failure(e, server_errors)
+            raise
+        finally:
+            self._record(failed)
+
+    def _is_failure(self, error, server_errors=True):
+        response = getattr(error, "response", None)
+        return response is None or (server_errors and response.status_code >= 500)
+
+    def _record(self, failed):
+        with self._lock:
+            if self._trial or failed:
+                self._trial = False
+            if not failed:
+                self._consecutive = 0
+                self._opened_at = None
+                return
+            self._consecutive += 1
+            if self._opened_at is not None or self._consecutive >= self.failures:
+                self._opened_at = time.monotonic()
+
+
+# Last successful payloads of the listing endpoints, least recently used first:
+# key -> (timestamp, payload)
+_last_good = OrderedDict()
+_refreshing = set()
+_lock = threading.Lock()
+
+
+def with_last_known_good(key, build):
+    """
+    Builds a payload, falling back to the last successful one if the upstream fails.
+
+    On fallback a background thread keeps retrying `build` so that the next
+    requests get fresh data as soon as the upstream recovers.
+
+    Args:
+        key (tuple): Identifies the payload (endpoint and parameters).
+        build (callable): Function building the payload from the upstream.
+
+    Returns:
+        tuple: The payload and its age in seconds (None when fresh).
+
+    Raises:
+        requests.exceptions.RequestException: If the upstream fails and no payload was ever built.
+    """
+    try:
+        payload = build()
+    except requests.exceptions.RequestException:
+        with _lock:
+            entry = _last_good.get(key)
+            if entry is not None:
+                _last_good.move_to_end(key)
+        if entry is None:
+            raise
+        schedule_refresh(key, build)
+        return entry[1], time.time() - entry[0]
+    remember_good(key, payload)
+    return payload, None
+
+
+def remember_good(key, payload):
+    """
+    Records a successful payload, evicting the least recently used ones beyond STALE_CACHE_SIZE.
+
+    Args:
+        key (tuple): Identifies the payload.
+        payload (dict): The payload.
+    """
+    with _lock:
+        _last_good[key] = (time.time(), payload)
+        _last_good.move_to_end(key)
+        while len(_last_good) > STALE_CACHE_SIZE:
+            _last_good.popitem(last=False)
+
+
+def schedule_refresh(key, build):
+    """
+    Retries a failed payload build in the background, once per key at a time.
+
+    Args:
+        key (tuple): Identifies the payload.
+        build (callable): Function building the payload from the upstream.
+    """
+    with _lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+
+    def run():
+        try:
+            for _ in range(STALE_REFRESH_ATTEMPTS):
+                time.sleep(ORTHANC_BREAKER_RESET)
+                try:
+                    payload = build()
+                except requests.exceptions.RequestException:
+                    continue
+                remember_good(key, payload)
+                return
+        finally:
+            with _lock:
+                _refreshing.discard(key)
+
+    threading.Thread(target=run, name="stale-refresh", daemon=True).start()
+
+
+def payload_response(payload, age):
+    """
+    Wraps a payload in a JSON response, flagging it when it is stale.
+
+    Args:
+        payload (dict): Response body.
+        age (float): Age of the payload in seconds, None when fresh.
+
+    Returns:
+        flask.Response: The JSON response, with `X-Stale-Age` and `Warning` headers if stale.
+    """
+    response = jsonify(payload)
+    if age is not None:
+        response.headers["X-Stale-Age"] = str(int(age))
+        response.headers["Warning"] = '110 - "Response is Stale"'
+    return response
+
+
+def unavailable_response(error):
+    """
+    Builds the error response of a failed upstream call.
+
+    Args:
+        error (requests.exceptions.RequestException): The upstream error.
+
+    Returns:
+        tuple: JSON error and status, 503 with Retry-After while a breaker is open, 500 otherwise.
+    """
+    if isinstance(error, UpstreamUnavailable):
+        return jsonify({"Error": str(error)}), 503, {"Retry-After": str(error.retry_after)}
+    return jsonify({"Error": str(error)}), 500
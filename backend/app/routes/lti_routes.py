@@ -17,6 +17,8 @@
 
 
 from flask import Blueprint, request
+from app.admission import admission_stats_logic
+from app.events import event_stats_logic, resource_usage_logic
 from app.lti import (
     jwks_logic,
     oidc_logic,
@@ -78,4 +80,27 @@ def validate_token():
     """
     Validates a JWT token and returns selected claims.
     """
-    return validate_token_logic(request)
\ No newline at end of file
+    return validate_token_logic(request)
+
+@lti.route("/admission/stats", methods=["GET"])
+def admission_stats():
+    """
+    Returns the admission control load and the time requests spent waiting for a slot.
+    """
+    return admission_stats_logic()
+
+@lti.route("/events/stats", methods=["GET"])
+def event_stats():
+    """
+    Returns the usage event log counters (buffered, written and dropped events).
+    """
+    return event_stats_logic()
+
+@lti.route("/events/resources", methods=["GET"])
+def resource_usage():
+    """
+    Returns launch and session counts per resource and viewer.
+    Args:
+        res_id (str): Resource to report (all resources by default).
+    """
+    return resource_usage_logic(request.args.get("res_id"))
@@ -17,9 +17,18 @@
 
 
 from flask import Blueprint, request
+from app.config import SERIES_PREFETCH_COUNT
+from app.archive import archive_logic
+from app.changes import study_changes_logic
+from app.study_store import facets_logic
+from app.study_query import query_studies_logic
+from app.manifest import manifest_logic
+from app.tiles import tile_logic, pyramid_logic, wsi_app_logic
+from app.thumbnails import thumbnails_logic
 from app.orthanc import (
     get_studies_logic,
     get_series_logic,
+    get_series_batch_logic,
     search_studies_logic,
     save_session_logic
 )
@@ -30,8 +39,57 @@ orthanc = Blueprint('orthanc', __name__)
 def get_studies():
     """
     Returns a list of studies from Orthanc with metadata for frontend display.
+    Args:
+        prefetch (int): Number of leading studies whose series are embedded in the response.
+        limit (int): Maximum number of studies to return (all by default).
+        offset (int): Number of studies to skip.
     """
-    return get_studies_logic()
+    prefetch = request.args.get("prefetch", SERIES_PREFETCH_COUNT, type=int)
+    limit = request.args.get("limit", None, type=int)
+    offset = request.args.get("offset", 0, type=int)
+    return get_studies_logic(prefetch, limit, offset)
+
+@orthanc.route("/studies/changes", methods=["GET"])
+def get_study_changes():
+    """
+    Returns the studies added, updated or deleted since the client's last sync.
+    Args:
+        since (str): Sync token returned by the previous call (whole list if missing).
+        prefetch (int): Number of leading studies sent whose series are embedded in the response.
+    Returns:
+        JSON: "Token" for the next call, and either "Studies" with "Reset", or "Updated", "Deleted" and "ResetNodes".
+    """
+    prefetch = request.args.get("prefetch", SERIES_PREFETCH_COUNT, type=int)
+    return study_changes_logic(request.args.get("since"), prefetch)
+
+@orthanc.route("/studies/facets", methods=["GET"])
+def get_study_facets():
+    """
+    Returns study counts per modality, institution, year, month and type for a set of filters.
+    Args:
+        modality (str): Modality to match, repeatable (any matches).
+        institution (str): Institution to match, repeatable (any matches).
+        date_from (str): First StudyDate, as YYYYMMDD.
+        date_to (str): Last StudyDate, as YYYYMMDD.
+        type (str): "wsi" or "classic".
+    Returns:
+        JSON: "Total" matching studies and "Facets" counts.
+    """
+    return facets_logic(request.args)
+
+@orthanc.route("/studies/query", methods=["POST"])
+def query_studies():
+    """
+    Returns the studies matching a structured query.
+    Args:
+        where (dict): Condition on the studies, combining field conditions with "and" / "or".
+        sort (list): Sort keys, each with "field" and "order" ("asc" or "desc").
+        limit (int): Maximum number of studies to return.
+        offset (int): Number of matching studies to skip.
+    Returns:
+        JSON: "Total" number of matching studies and the requested page of "Studies".
+    """
+    return query_studies_logic(request.get_json(silent=True))
 
 @orthanc.route("/studies/<study_id>/series", methods=["GET"])
 def get_series(study_id):
@@ -46,6 +104,87 @@ def get_series(study_id):
     is_wsi = request.args.get("is_wsi", "false").lower() == "true"
     return get_series_logic(study_id, study_uid, is_wsi)
 
+@orthanc.route("/series/batch", methods=["POST"])
+def get_series_batch():
+    """
+    Returns the series of several studies in a single request.
+    Args:
+        Studies (list): The studies to retrieve series for, each with "_id", "studyUID" and "is_wsi".
+    Returns:
+        JSON: Dictionary with key "Series" mapping each study ID to its list of series.
+    """
+    data = request.get_json(silent=True)
+    return get_series_batch_logic(data)
+
+@orthanc.route("/series/thumbnails", methods=["POST"])
+def get_thumbnails():
+    """
+    Returns the thumbnails of several series in a single request.
+    Args:
+        Series (list): Orthanc IDs of the series.
+    Returns:
+        JSON: Dictionary with key "Thumbnails" mapping each series ID to a data URI (null if unavailable).
+    """
+    data = request.get_json(silent=True)
+    return thumbnails_logic(data)
+
+@orthanc.route("/studies/<study_id>/archive", methods=["GET"])
+def get_study_archive(study_id):
+    """
+    Streams the ZIP archive of a study, served from the local archive cache when possible.
+    Args:
+        study_id (str): The ID of the study to download.
+    """
+    return archive_logic("studies", study_id, request)
+
+@orthanc.route("/studies/<study_id>/ohif-dicom-json", methods=["GET"])
+def get_ohif_manifest(study_id):
+    """
+    Returns the OHIF DICOM-JSON manifest of a study from the local manifest cache.
+    Args:
+        study_id (str): The ID of the study to open in OHIF.
+    """
+    return manifest_logic(study_id, request)
+
+@orthanc.route("/series/<serie_id>/archive", methods=["GET"])
+def get_series_archive(serie_id):
+    """
+    Streams the ZIP archive of a series, served from the local archive cache when possible.
+    Args:
+        serie_id (str): The ID of the series to download.
+    """
+    return archive_logic("series", serie_id, request)
+
+@orthanc.route("/wsi/tiles/<series_id>/<int:level>/<int:x>/<int:y>", methods=["GET"])
+def get_wsi_tile(series_id, level, x, y):
+    """
+    Returns a tile of a WSI pyramid through the memory and disk tile cache.
+    Args:
+        series_id (str): The ID of the WSI series.
+        level (int): The pyramid level.
+        x (int): The tile column.
+        y (int): The tile row.
+    """
+    return tile_logic(series_id, level, x, y)
+
+@orthanc.route("/wsi/pyramids/<series_id>", methods=["GET"])
+def get_wsi_pyramid(series_id):
+    """
+    Returns the pyramid description of a WSI series.
+    Args:
+        series_id (str): The ID of the WSI series.
+    """
+    return pyramid_logic(series_id)
+
+@orthanc.route("/wsi/app/<path:filename>", methods=["GET"])
+def get_wsi_app(filename):
+    """
+    Serves the WholeSlide viewer application so that its tile requests reach the backend.
+    Args:
+        filename (str): The file of the viewer application.
+    """
+    return wsi_app_logic(filename)
+
 @orthanc.route("/search_studies", methods=["GET"])
 def search_studies():
     """
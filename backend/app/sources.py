@@ -0,0 +1,328 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import hashlib
+
+
+# DICOM tags returned by QIDO-RS, mapped to their Orthanc MainDicomTags names.
+QIDO_STUDY_TAGS = {
+    "00080020": "StudyDate",
+    "00080080": "InstitutionName",
+    "00080090": "ReferringPhysicianName",
+    "00321060": "RequestedProcedureDescription",
+    "00081030": "StudyDescription",
+    "0020000D": "StudyInstanceUID",
+}
+QIDO_PATIENT_TAGS = {
+    "00100010": "PatientName",
+    "00100020": "PatientID",
+}
+QIDO_SERIES_TAGS = {
+    "00080060": "Modality",
+    "00180015": "BodyPartExamined",
+    "00081070": "OperatorsName",
+    "00181030": "ProtocolName",
+    "00400254": "PerformedProcedureStepDescription",
+    "0008103E": "SeriesDescription",
+    "0020000E": "SeriesInstanceUID",
+}
+QIDO_MODALITIES_IN_STUDY = "00080061"
+
+
+def orthanc_id(*uids):
+    """
+    Computes an Orthanc resource identifier from DICOM identifiers.
+
+    Orthanc identifies a study by the SHA-1 of "PatientID|StudyInstanceUID"
+    and a series by the SHA-1 of "PatientID|StudyInstanceUID|SeriesInstanceUID",
+    written as five dash-separated groups of eight hexadecimal digits.
+
+    Args:
+        *uids (str): PatientID followed by the UIDs down to the resource level.
+
+    Returns:
+        str: The Orthanc identifier.
+    """
+    digest = hashlib.sha1("|".join(uids).encode()).hexdigest()
+    return "-".join(digest[i:i + 8] for i in range(0, 40, 8))
+
+
+def qido_value(dataset, tag):
+    """
+    Reads the first value of an attribute of a DICOM JSON dataset as a string.
+
+    Args:
+        dataset (dict): DICOM JSON dataset.
+        tag (str): Attribute tag, e.g. "0020000D".
+
+    Returns:
+        str: The value (the alphabetic form for person names), or None if absent.
+    """
+    values = dataset.get(tag, {}).get("Value", [])
+    if not values:
+        return None
+    value = values[0]
+    if isinstance(value, dict):
+        return value.get("Alphabetic")
+    return str(value)
+
+
+def qido_tags(dataset, tags):
+    """
+    Converts the attributes of a DICOM JSON dataset to a dictionary of named tags.
+
+    Args:
+        dataset (dict): DICOM JSON dataset.
+        tags (dict): Attribute tags mapped to their names.
+
+    Returns:
+        dict: Values of the attributes present in the dataset, keyed by name.
+    """
+    return {name: value for tag, name in tags.items()
+            if (value := qido_value(dataset, tag)) is not None}
+
+
+class NativeSource:
+    """
+    Lists studies and series through the Orthanc REST API.
+
+    The modalities of a study are not part of the study resource, so they are
+    read from the expanded series of each study, with one request per study.
+
+    Resources are returned in the Orthanc expanded format, with the modalities
+    of each study under "ModalitiesInStudy".
+    """
+
+    name = "native"
+
+    def __init__(self, client):
+        self.client = client
+
+    def list_studies(self, limit=None, offset=0):
+        """
+        Args:
+            limit (int, optional): Maximum number of studies to return.
+            offset (int): Number of studies to skip.
+
+        Returns:
+            list: Expanded Orthanc studies.
+
+        Raises:
+            requests.exceptions.RequestException: If Orthanc cannot be queried.
+        """
+        params = {"expand": "true", "includeField": "All"}
+        if limit:
+            params.update({"limit": limit, "since": offset})
+        studies = self.client.get("/studies", params=params)
+        return [self._with_modalities(study) for study in studies]
+
+    def get_study(self, study_id):
+        """
+        Args:
+            study_id (str): Internal Orthanc ID of the study.
+
+        Returns:
+            dict: Expanded Orthanc study.
+
+        Raises:
+            requests.exceptions.RequestException: If Orthanc cannot be queried.
+        """
+        return self._with_modalities(self.client.get(f"/studies/{study_id}"))
+
+    def _with_modalities(self, study):
+        modalities = []
+        if study.get('Series'):
+            for serie in self.list_series(study.get('ID')):
+                modality = serie.get('MainDicomTags', {}).get('Modality')
+                if modality and modality not in modalities:
+                    modalities.append(modality)
+        return dict(study, ModalitiesInStudy=modalities)
+
+    def list_series(self, study_id, study_uid=None):
+        """
+        Args:
+            study_id (str): Internal Orthanc ID of the study.
+            study_uid (str, optional): DICOM UID of the study (unused).
+
+        Returns:
+            list: Expanded Orthanc series.
+
+        Raises:
+            requests.exceptions.RequestException: If Orthanc cannot be queried.
+        """
+        return self.client.get(f"/studies/{study_id}/series", params={"expand": "true", "includeField": "All"})
+
+    def find_series(self, studies):
+        """
+        Lists the series of several studies with a single `/tools/find` query.
+
+        Args:
+            studies (list): Dictionaries with "_id" and "studyUID" keys.
+
+        Returns:
+            dict: Expanded Orthanc series lists keyed by Orthanc study ID.
+
+        Raises:
+            requests.exceptions.RequestException: If Orthanc cannot be queried.
+        """
+        matches = self.client.post("/tools/find", {
+            "Level": "Series",
+            "Expand": True,
+            "Query": {"StudyInstanceUID": "\\".join(s["studyUID"] for s in studies)}
+        })
+        found = {s["_id"]: [] for s in studies}
+        for serie in matches:
+            found.setdefault(serie.get("ParentStudy"), []).append(serie)
+        return found
+
+
+class DicomWebSource:
+    """
+    Lists studies and series through the QIDO-RS API of the Orthanc DICOMweb plugin.
+
+    QIDO-RS returns ModalitiesInStudy with each study and pages on the server
+    side, so a listing costs one request. Results are converted to the Orthanc
+    expanded format, Orthanc identifiers being derived from the DICOM UIDs.
+
+    QIDO-RS does not list the series of a study nor the instances of a series:
+    "Series" is only filled by get_study, and series carry no "Instances".
+    Callers needing instances read the series from the Orthanc REST API.
+    """
+
+    name = "dicomweb"
+
+    def __init__(self, client, root="/dicom-web"):
+        self.client = client
+        self.root = root
+
+    def list_studies(self, limit=None, offset=0):
+        """
+        Args:
+            limit (int, optional): Maximum number of studies to return.
+            offset (int): Number of studies to skip.
+
+        Returns:
+            list: Studies in the Orthanc expanded format.
+
+        Raises:
+            requests.exceptions.RequestException: If Orthanc cannot be queried.
+        """
+        params = {"includefield": ",".join(list(QIDO_STUDY_TAGS) + list(QIDO_PATIENT_TAGS) + [QIDO_MODALITIES_IN_STUDY])}
+        if limit:
+            params.update({"limit": limit, "offset": offset})
+        return [self._study(dataset) for dataset in self.client.get(f"{self.root}/studies", params=params)]
+
+    def get_study(self, study_id):
+        """
+        Args:
+            study_id (str): Internal Orthanc ID of the study.
+
+        Returns:
+            dict: The study in the Orthanc expanded format.
+
+        Raises:
+            requests.exceptions.RequestException: If Orthanc cannot be queried.
+        """
+        study_uid = self.client.get(f"/studies/{study_id}").get("MainDicomTags", {}).get("StudyInstanceUID")
+        datasets = self.client.get(f"{self.root}/studies", params={
+            "StudyInstanceUID": study_uid,
+            "includefield": ",".join(list(QIDO_STUDY_TAGS) + list(QIDO_PATIENT_TAGS) + [QIDO_MODALITIES_IN_STUDY])
+        })
+        if not datasets:
+            return {"ID": study_id, "Series": []}
+        series = self.find_series([{"_id": study_id, "studyUID": study_uid}])[study_id]
+        return dict(self._study(datasets[0]), ID=study_id, Series=[serie["ID"] for serie in series])
+
+    def _study(self, dataset):
+        patient = qido_tags(dataset, QIDO_PATIENT_TAGS)
+        main_tags = qido_tags(dataset, QIDO_STUDY_TAGS)
+        return {
+            "ID": orthanc_id(patient.get("PatientID", ""), main_tags.get("StudyInstanceUID", "")),
+            "MainDicomTags": main_tags,
+            "PatientMainDicomTags": patient,
+            "Series": [],
+            "ModalitiesInStudy": dataset.get(QIDO_MODALITIES_IN_STUDY, {}).get("Value", []),
+        }
+
+    def list_series(self, study_id, study_uid=None):
+        """
+        Args:
+            study_id (str): Internal Orthanc ID of the study.
+            study_uid (str, optional): DICOM UID of the study, read from Orthanc if missing.
+
+        Returns:
+            list: Series in the Orthanc expanded format.
+
+        Raises:
+            requests.exceptions.RequestException: If Orthanc cannot be queried.
+        """
+        if not study_uid:
+            study_uid = self.client.get(f"/studies/{study_id}").get("MainDicomTags", {}).get("StudyInstanceUID")
+        return self.find_series([{"_id": study_id, "studyUID": study_uid}])[study_id]
+
+    def find_series(self, studies):
+        """
+        Lists the series of several studies with a single QIDO-RS query (UID list matching).
+
+        Args:
+            studies (list): Dictionaries with "_id" and "studyUID" keys.
+
+        Returns:
+            dict: Series in the Orthanc expanded format, keyed by Orthanc study ID.
+
+        Raises:
+            requests.exceptions.RequestException: If Orthanc cannot be queried.
+        """
+        ids_by_uid = {s["studyUID"]: s["_id"] for s in studies}
+        datasets = self.client.get(f"{self.root}/series", params={
+            "StudyInstanceUID": ",".join(ids_by_uid),
+            "includefield": ",".join(list(QIDO_SERIES_TAGS) + list(QIDO_PATIENT_TAGS) + ["0020000D"])
+        })
+        found = {s["_id"]: [] for s in studies}
+        for dataset in datasets:
+            study_uid = qido_value(dataset, "0020000D")
+            main_tags = qido_tags(dataset, QIDO_SERIES_TAGS)
+            patient_id = qido_value(dataset, "00100020") or ""
+            study_id = ids_by_uid.get(study_uid)
+            found.setdefault(study_id, []).append({
+                "ID": orthanc_id(patient_id, study_uid or "", main_tags.get("SeriesInstanceUID", "")),
+                "ParentStudy": study_id,
+                "MainDicomTags": main_tags,
+            })
+        return found
+
+
+def make_source(kind, client):
+    """
+    Creates a data source of the kind selected in the configuration.
+
+    Args:
+        kind (str): "native" or "dicomweb".
+        client (OrthancClient): Client of the Orthanc server to query.
+
+    Returns:
+        NativeSource or DicomWebSource: The data source.
+
+    Raises:
+        ValueError: If the kind is unknown.
+    """
+    if kind == "native":
+        return NativeSource(client)
+    if kind == "dicomweb":
+        return DicomWebSource(client)
+    raise ValueError("DATA_SOURCE must be 'native' or 'dicomweb'")
@@ -0,0 +1,351 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import json
+from abc import ABC, abstractmethod
+from functools import lru_cache
+import numpy as np
+import requests
+from flask import jsonify
+
+from app.resilience import payload_response, unavailable_response
+from app.study_store import get_study_store, parse_date
+
+# Text fields that can be queried, mapped to their key in the frontend study representation.
+TEXT_FIELDS = {
+    "studyUID": "studyUID",
+    "description": "description",
+    "patientName": "PatientName",
+    "institution": "institutionName",
+    "referringPhysician": "referringPhysicianName",
+    "requestedProcedure": "requestedProcedureDescription",
+    "node": "node",
+}
+SORT_FIELDS = dict(TEXT_FIELDS, date="date")
+MAX_LIMIT = 1000
+
+
+class QueryError(ValueError):
+    """
+    Raised for a malformed structured query.
+    """
+
+
+class Predicate(ABC):
+    """
+    A compiled condition on studies.
+
+    `indexed` predicates are answered from the columns and indexes of the
+    store; the others read the studies one by one and are only evaluated on
+    the rows selected by the indexed predicates of the same conjunction.
+    """
+
+    indexed = True
+
+    @abstractmethod
+    def evaluate(self, store, candidates):
+        """
+        Args:
+            store (StudyStore): The studies.
+            candidates (numpy.ndarray): Rows still to decide, as a boolean array.
+
+        Returns:
+            numpy.ndarray: Boolean array, True for the candidate rows matching the condition.
+        """
+
+
+class DateRange(Predicate):
+    """
+    StudyDate within a range, from the date index.
+    """
+
+    def __init__(self, date_from, date_to):
+        self.date_from = date_from
+        self.date_to = date_to
+
+    def evaluate(self, store, candidates):
+        return candidates & store.date_range(self.date_from, self.date_to)
+
+
+class UidIn(Predicate):
+    """
+    StudyInstanceUID in a set, from the UID hash index.
+    """
+
+    def __init__(self, uids):
+        self.uids = uids
+
+    def evaluate(self, store, candidates):
+        mask = np.zeros(len(store.studies), dtype=bool)
+        for uid in self.uids:
+            mask[store.uid_rows.get(uid, [])] = True
+        return candidates & mask
+
+
+class ModalityIn(Predicate):
+    """
+    At least one modality of the study in a set, from the modality matrix.
+    """
+
+    def __init__(self, modalities):
+        self.modalities = modalities
+
+    def evaluate(self, store, candidates):
+        columns = [i for i, modality in enumerate(store.modalities) if modality in self.modalities]
+        return candidates & store.modality_matrix[:, columns].any(axis=1)
+
+
+class InstitutionIn(Predicate):
+    """
+    Institution in a set, from the dictionary-encoded column.
+    """
+
+    def __init__(self, institutions):
+        self.institutions = institutions
+
+    def evaluate(self, store, candidates):
+        codes = [i for i, name in enumerate(store.institutions) if name in self.institutions]
+        return candidates & np.isin(store.institution_codes, codes)
+
+
+class TypeIs(Predicate):
+    """
+    WSI or classic study, from the type column.
+    """
+
+    def __init__(self, is_wsi):
+        self.is_wsi = is_wsi
+
+    def evaluate(self, store, candidates):
+        return candidates & (store.is_wsi == self.is_wsi)
+
+
+class TextMatch(Predicate):
+    """
+    Text field equal to one of the values, or containing one of them (case-insensitive).
+    """
+
+    indexed = False
+
+    def __init__(self, key, values, contains):
+        self.key = key
+        self.values = [value.lower() for value in values] if contains else set(values)
+        self.contains = contains
+
+    def matches(self, value):
+        if self.contains:
+            value = str(value).lower()
+            return any(term in value for term in self.values)
+        return value in self.values
+
+    def evaluate(self, store, candidates):
+        mask = np.zeros(len(store.studies), dtype=bool)
+        for row in np.flatnonzero(candidates):
+            mask[row] = self.matches(store.studies[row].get(self.key))
+        return mask
+
+
+class And(Predicate):
+    """
+    Every predicate matches.
+    """
+
+    def __init__(self, predicates):
+        # Indexed predicates first, so the others only see the rows they kept
+        self.predicates = sorted(predicates, key=lambda p: not p.indexed)
+        self.indexed = all(p.indexed for p in predicates)
+
+    def evaluate(self, store, candidates):
+        for predicate in self.predicates:
+            if not candidates.any():
+                break
+            candidates = predicate.evaluate(store, candidates)
+        return candidates
+
+
+class Or(Predicate):
+    """
+    At least one predicate matches.
+    """
+
+    def __init__(self, predicates):
+        self.predicates = predicates
+        self.indexed = all(p.indexed for p in predicates)
+
+    def evaluate(self, store, candidates):
+        result = np.zeros(len(store.studies), dtype=bool)
+        for predicate in self.predicates:
+            # Rows already matched need not be evaluated again
+            result |= predicate.evaluate(store, candidates & ~result)
+        return result
+
+
+def _values(condition):
+    if "in" in condition:
+        values = condition["in"]
+        if not isinstance(values, list) or not all(isinstance(v, str) for v in values):
+            raise QueryError("'in' must be a list of strings")
+        return values
+    if "equals" in condition and isinstance(condition["equals"], str):
+        return [condition["equals"]]
+    raise QueryError(f"Condition on {condition.get('field')} needs 'equals' or 'in'")
+
+
+def compile_condition(condition):
+    """
+    Compiles a query condition into a predicate.
+
+    A condition is either {"and": [...]}, {"or": [...]} or a field condition:
+    {"field": "date", "from": "YYYYMMDD", "to": "YYYYMMDD"},
+    {"field": "modality", "in": [...]}, {"field": "type", "equals": "wsi"},
+    or {"field": <text field>, "equals" | "in" | "contains": ...}.
+
+    Args:
+        condition (dict): The condition.
+
+    Returns:
+        Predicate: The compiled predicate.
+
+    Raises:
+        QueryError: If the condition is malformed.
+    """
+    if not isinstance(condition, dict):
+        raise QueryError("A condition must be an object")
+    for operator, combine in (("and", And), ("or", Or)):
+        if operator in condition:
+            if not isinstance(condition[operator], list) or not condition[operator]:
+                raise QueryError(f"'{operator}' must be a non-empty list of conditions")
+            return combine([compile_condition(c) for c in condition[operator]])
+
+    field = condition.get("field")
+    if field == "date":
+        bounds = []
+        for name in ("from", "to"):
+            value = condition.get(name)
+            if value is not None and not parse_date(value):
+                raise QueryError(f"Date '{name}' must be formatted as YYYYMMDD")
+            bounds.append(parse_date(value) or None)
+        return DateRange(*bounds)
+    if field == "modality":
+        return ModalityIn(set(_values(condition)))
+    if field == "type":
+        if condition.get("equals") not in ("wsi", "classic"):
+            raise QueryError("type must equal 'wsi' or 'classic'")
+        return TypeIs(condition["equals"] == "wsi")
+    if field == "studyUID" and "contains" not in condition:
+        return UidIn(_values(condition))
+    if field == "institution" and "contains" not in condition:
+        return InstitutionIn(set(_values(condition)))
+    if field in TEXT_FIELDS:
+        if "contains" in condition:
+            contains = condition["contains"]
+            terms = contains if isinstance(contains, list) else [contains]
+            if not terms or not all(isinstance(t, str) for t in terms):
+                raise QueryError("'contains' must be a string or a list of strings")
+            return TextMatch(TEXT_FIELDS[field], terms, True)
+        return TextMatch(TEXT_FIELDS[field], _values(condition), False)
+    raise QueryError(f"Unknown field: {field}")
+
+
+@lru_cache(maxsize=256)
+def compile_query(text):
+    """
+    Compiles a query, once per distinct query.
+
+    Args:
+        text (str): Canonical JSON of the query (sorted keys).
+
+    Returns:
+        tuple: The predicate (None when the query has no "where") and the sort
+            keys as (field, descending) pairs.
+
+    Raises:
+        QueryError: If the query is malformed.
+    """
+    query = json.loads(text)
+    predicate = compile_condition(query["where"]) if query.get("where") else None
+    if not isinstance(query.get("sort", []), list):
+        raise QueryError("sort must be a list of {field, order} objects")
+    sort = []
+    for key in query.get("sort", []):
+        if not isinstance(key, dict) or key.get("field") not in SORT_FIELDS:
+            raise QueryError(f"Cannot sort on {key}")
+        if key.get("order", "asc") not in ("asc", "desc"):
+            raise QueryError("Sort order must be 'asc' or 'desc'")
+        sort.append((key["field"], key.get("order") == "desc"))
+    return predicate, tuple(sort)
+
+
+def run_query(store, predicate, sort):
+    """
+    Runs a compiled query on the study store.
+
+    Args:
+        store (StudyStore): The studies.
+        predicate (Predicate): Condition to match, None to match every study.
+        sort (tuple): (field, descending) pairs, most significant first.
+
+    Returns:
+        list: Matching row numbers, sorted.
+    """
+    mask = np.ones(len(store.studies), dtype=bool)
+    if predicate is not None:
+        mask = predicate.evaluate(store, mask)
+    if len(sort) == 1 and sort[0][0] == "date":
+        # The date index is already sorted: keep its order, reversed if descending
+        rows = store.date_order[mask[store.date_order]]
+        return (rows[::-1] if sort[0][1] else rows).tolist()
+    rows = np.flatnonzero(mask).tolist()
+    for field, descending in reversed(sort):
+        if field == "date":
+            rows.sort(key=lambda row: store.dates[row], reverse=descending)
+        else:
+            rows.sort(key=lambda row: str(store.studies[row].get(SORT_FIELDS[field], "")), reverse=descending)
+    return rows
+
+
+def query_studies_logic(query):
+    """
+    Runs a structured query on the study listing.
+
+    Args:
+        query (dict): Request body with optional "where" (condition, see
+            compile_condition), "sort" (list of {"field", "order"}), "limit"
+            and "offset".
+
+    Returns:
+        JSON: "Total" number of matching studies and the requested page of "Studies".
+    """
+    if not isinstance(query, dict):
+        return jsonify({"Error": "A JSON query is required"}), 400
+    limit = query.get("limit", 100)
+    offset = query.get("offset", 0)
+    if not isinstance(limit, int) or not isinstance(offset, int) or not 0 <= limit <= MAX_LIMIT or offset < 0:
+        return jsonify({"Error": f"limit must be between 0 and {MAX_LIMIT} and offset positive"}), 400
+    try:
+        predicate, sort = compile_query(json.dumps({"where": query.get("where"), "sort": query.get("sort", [])},
+                                                   sort_keys=True))
+    except QueryError as e:
+        return jsonify({"Error": str(e)}), 400
+    try:
+        store, age = get_study_store()
+        rows = run_query(store, predicate, sort)
+        return payload_response({"Total": len(rows),
+                                 "Studies": [store.studies[row] for row in rows[offset:offset + limit]]}, age)
+    except requests.exceptions.RequestException as e:
+        return unavailable_response(e)
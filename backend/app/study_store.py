@@ -0,0 +1,673 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+import numpy as np
+import requests
+from flask import jsonify
+
+from app.config import STUDY_STORE_TTL, STUDY_SNAPSHOT_DIR, STUDY_SNAPSHOT_GRACE
+from app.changes import sync_studies
+from app.orthanc import SERIES_INDEX
+from app.resilience import payload_response, unavailable_response
+
+# Filters accepted by the facet endpoint, each also naming the facet it restricts.
+FILTERS = ("modality", "institution", "date", "type")
+
+# Version of the snapshot layout; snapshots of another version are ignored.
+SNAPSHOT_VERSION = 1
+# Columns of a StudyStore saved in a snapshot, one .npy file each.
+SNAPSHOT_COLUMNS = ("dates", "is_wsi", "institution_codes", "modality_matrix", "date_order", "ids", "uids")
+
+
+def parse_date(value):
+    """
+    Converts a DICOM date to an integer.
+
+    Args:
+        value (str): Date in the DICOM format YYYYMMDD.
+
+    Returns:
+        int: The date as YYYYMMDD, or 0 if it is missing or malformed.
+    """
+    value = str(value or "").strip()
+    return int(value) if len(value) == 8 and value.isdigit() else 0
+
+
+def pack(items):
+    """
+    Serializes JSON values into one byte array.
+
+    Args:
+        items (list): JSON-serializable values.
+
+    Returns:
+        tuple: The concatenated JSON encodings as a uint8 array, and the
+            offsets of each item (item i spans offsets[i]:offsets[i + 1]).
+    """
+    chunks = [json.dumps(item).encode() for item in items]
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(chunk) for chunk in chunks])
+    return np.frombuffer(b"".join(chunks), dtype=np.uint8), offsets
+
+
+class PackedRecords:
+    """
+    Read-only sequence of JSON values stored by pack, decoded on access.
+
+    Backed by memory-mapped arrays, it shares its pages with every worker
+    mapping the same snapshot.
+    """
+
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        return json.loads(self.data[self.offsets[row]:self.offsets[row + 1]].tobytes())
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+
+class PackedSeries:
+    """
+    Read-only mapping of the series lists of a snapshot, keyed by Orthanc study ID.
+    """
+
+    def __init__(self, id_rows, records, present):
+        self.id_rows = id_rows
+        self.records = records
+        self.present = present
+
+    def get(self, study_id, default=None):
+        row = self.id_rows.get(study_id)
+        if row is None or not self.present[row]:
+            return default
+        return self.records[row]
+
+
+def encode(values):
+    """
+    Dictionary-encodes a categorical column.
+
+    Args:
+        values (list): Value of each row.
+
+    Returns:
+        tuple: Sorted distinct values, and the code of each row as an array of indexes into them.
+    """
+    categories, codes = np.unique(np.asarray(values, dtype=str), return_inverse=True)
+    return categories.tolist(), codes.astype(np.int32)
+
+
+class StudyStore:
+    """
+    Columnar copy of the study list for vectorized filtering and facet counts.
+
+    Each study is a row: StudyDate as an integer column, institution as a
+    dictionary-encoded column, type as a boolean column, and the modalities
+    as a boolean matrix with one column per modality, since a study may have
+    several.
+
+    Rows are also indexed by date (rows sorted by StudyDate) and by
+    Orthanc ID and StudyInstanceUID (hash indexes).
+
+    A store can be saved as a snapshot and loaded back memory-mapped.
+    """
+
+    def __init__(self, studies):
+        # One row per Orthanc ID, the first occurrence winning, so that row
+        # numbers and the ID index always agree.
+        seen = set()
+        unique = []
+        for study in studies:
+            if study.get("_id") not in seen:
+                seen.add(study.get("_id"))
+                unique.append(study)
+        studies = unique
+        self.studies = studies
+        self.dates = np.array([parse_date(s.get("date")) for s in studies], dtype=np.int32)
+        self.is_wsi = np.array([bool(s.get("is_wsi")) for s in studies], dtype=bool)
+        self.institutions, self.institution_codes = encode([s.get("institutionName", "N/A") for s in studies])
+        self.modalities = sorted({m for s in studies for m in s.get("modalities", []) if m})
+        column = {modality: i for i, modality in enumerate(self.modalities)}
+        self.modality_matrix = np.zeros((len(studies), len(self.modalities)), dtype=bool)
+        for row, study in enumerate(studies):
+            for modality in study.get("modalities", []):
+                if modality in column:
+                    self.modality_matrix[row, column[modality]] = True
+        self.date_order = np.argsort(self.dates, kind="stable")
+        self.ids = np.array([str(s.get("_id", "")) for s in studies], dtype=np.bytes_)
+        self.uids = np.array([str(s.get("studyUID", "")) for s in studies], dtype=np.bytes_)
+        self._index()
+
+    def _index(self):
+        self.sorted_dates = self.dates[self.date_order]
+        self.id_rows = {study_id.decode(): row for row, study_id in enumerate(self.ids.tolist())}
+        self.uid_rows = {}
+        for row, uid in enumerate(self.uids.tolist()):
+            self.uid_rows.setdefault(uid.decode(), []).append(row)
+
+    def save(self, path, series_index):
+        """
+        Writes the store and the indexed series of its studies to a snapshot directory.
+
+        Args:
+            path (str): Directory to create.
+            series_index (SeriesIndex): Series lists keyed by Orthanc study ID.
+        """
+        os.makedirs(path)
+        for name in SNAPSHOT_COLUMNS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        records, offsets = pack(list(self.studies))
+        np.save(os.path.join(path, "records.npy"), records)
+        np.save(os.path.join(path, "record_offsets.npy"), offsets)
+        series = [series_index.get(study_id.decode()) for study_id in self.ids.tolist()]
+        records, offsets = pack(series)
+        np.save(os.path.join(path, "series.npy"), records)
+        np.save(os.path.join(path, "series_offsets.npy"), offsets)
+        np.save(os.path.join(path, "has_series.npy"), np.array([s is not None for s in series], dtype=bool))
+        with open(os.path.join(path, "categories.json"), "w") as f:
+            json.dump({"institutions": self.institutions, "modalities": self.modalities}, f)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Maps a snapshot directory read-only.
+
+        Args:
+            path (str): Directory written by save.
+
+        Returns:
+            tuple: The store and the read-only mapping of its series.
+        """
+        def column(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        store = cls.__new__(cls)
+        for name in SNAPSHOT_COLUMNS:
+            setattr(store, name, column(name))
+        with open(os.path.join(path, "categories.json")) as f:
+            categories = json.load(f)
+        store.institutions = categories["institutions"]
+        store.modalities = categories["modalities"]
+        store.studies = PackedRecords(column("records"), column("record_offsets"))
+        store._index()
+        series = PackedSeries(store.id_rows, PackedRecords(column("series"), column("series_offsets")),
+                              column("has_series"))
+        return store, series
+
+    def date_range(self, date_from=None, date_to=None):
+        """
+        Selects the studies dated within a range using the date index.
+
+        Args:
+            date_from (int, optional): First date as YYYYMMDD.
+            date_to (int, optional): Last date as YYYYMMDD.
+
+        Returns:
+            numpy.ndarray: Boolean array, True for the studies in the range.
+        """
+        low = np.searchsorted(self.sorted_dates, date_from or 1, side="left")
+        high = np.searchsorted(self.sorted_dates, date_to, side="right") if date_to else len(self.dates)
+        mask = np.zeros(len(self.studies), dtype=bool)
+        mask[self.date_order[low:high]] = True
+        return mask
+
+    def mask(self, filters, skip=None):
+        """
+        Selects the studies matching a set of filters.
+
+        Args:
+            filters (dict): Optional "modality" and "institution" sets (any value
+                matches), "date" as a (from, to) pair of YYYYMMDD integers (either
+                may be None), and "type" ("wsi" or "classic").
+            skip (str, optional): Filter to ignore.
+
+        Returns:
+            numpy.ndarray: Boolean array, True for the matching studies.
+        """
+        mask = np.ones(len(self.studies), dtype=bool)
+        if filters.get("modality") and skip != "modality":
+            columns = [i for i, modality in enumerate(self.modalities) if modality in filters["modality"]]
+            mask &= self.modality_matrix[:, columns].any(axis=1)
+        if filters.get("institution") and skip != "institution":
+            codes = [i for i, name in enumerate(self.institutions) if name in filters["institution"]]
+            mask &= np.isin(self.institution_codes, codes)
+        if filters.get("date") and skip != "date" and any(filters["date"]):
+            mask &= self.date_range(*filters["date"])
+        if filters.get("type") and skip != "type":
+            mask &= self.is_wsi == (filters["type"] == "wsi")
+        return mask
+
+    def facets(self, filters):
+        """
+        Counts the matching studies per modality, institution, year, month and type.
+
+        The counts of a facet apply every filter except the one on that facet,
+        so the other values of a filtered facet keep their counts.
+
+        Args:
+            filters (dict): Filters, as accepted by mask.
+
+        Returns:
+            dict: "Total" matching studies and "Facets" counts, values without studies omitted.
+        """
+        by_modality = self.modality_matrix[self.mask(filters, skip="modality")].sum(axis=0)
+        by_institution = np.bincount(self.institution_codes[self.mask(filters, skip="institution")],
+                                     minlength=len(self.institutions))
+        dates = self.dates[self.mask(filters, skip="date")]
+        dates = dates[dates > 0]
+        years, year_counts = np.unique(dates // 10000, return_counts=True)
+        months, month_counts = np.unique(dates // 100, return_counts=True)
+        type_mask = self.mask(filters, skip="type")
+        wsi = int(np.count_nonzero(self.is_wsi & type_mask))
+        return {
+            "Total": int(np.count_nonzero(self.mask(filters))),
+            "Facets": {
+                "Modality": {m: int(c) for m, c in zip(self.modalities, by_modality) if c},
+                "Institution": {i: int(c) for i, c in zip(self.institutions, by_institution) if c},
+                "Year": {str(y): int(c) for y, c in zip(years, year_counts)},
+                "Month": {f"{m // 100}-{m % 100:02d}": int(c) for m, c in zip(months, month_counts)},
+                "Type": {"wsi": wsi, "classic": int(np.count_nonzero(type_mask)) - wsi},
+            }
+        }
+
+
+def apply_changes(store, changes):
+    """
+    Builds a new store from an existing one and the changes of the study list.
+
+    Args:
+        store (StudyStore): The current store.
+        changes (dict): Body returned by sync_studies.
+
+    Returns:
+        StudyStore: The updated store.
+    """
+    if changes.get("Reset"):
+        return StudyStore(changes["Studies"])
+    deleted = set(changes["Deleted"])
+    reset_nodes = set(changes.get("ResetNodes", []))
+    updated = {study["_id"]: study for study in changes["Updated"]}
+    studies = [updated.pop(study["_id"], study) for study in store.studies
+               if study["_id"] not in deleted and study.get("node") not in reset_nodes]
+    uids = {study.get("studyUID") for study in studies}
+    studies.extend(study for study in updated.values() if study.get("studyUID") not in uids)
+    return StudyStore(studies)
+
+
+def snapshot_generation():
+    """
+    Returns:
+        str: Name of the current snapshot directory, or None if there is none.
+    """
+    try:
+        with open(os.path.join(STUDY_SNAPSHOT_DIR, "CURRENT")) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def snapshot_lock(blocking=True):
+    """
+    Takes the lock of the snapshot directory, shared by every worker.
+
+    The holder is the only worker catching up with Orthanc and writing or
+    pruning snapshots; the others map what it writes. Without flock (Windows),
+    the server is assumed to run a single process, whose refreshes are
+    already serialised by _refresh_lock, and the lock is always granted.
+
+    Args:
+        blocking (bool): Whether to wait for the lock.
+
+    Yields:
+        bool: True if the lock is held.
+    """
+    os.makedirs(STUDY_SNAPSHOT_DIR, exist_ok=True)
+    if fcntl is None:
+        yield True
+        return
+    with open(os.path.join(STUDY_SNAPSHOT_DIR, "LOCK"), "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def load_snapshot():
+    """
+    Maps the current study snapshot, written by any worker.
+
+    Returns:
+        tuple: The store, the read-only series mapping, the sync token, the
+            snapshot time and the snapshot directory name; or None if there
+            is no usable snapshot.
+    """
+    generation = snapshot_generation() if STUDY_SNAPSHOT_DIR else None
+    if generation is None:
+        return None
+    path = os.path.join(STUDY_SNAPSHOT_DIR, generation)
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+        if meta.get("version") != SNAPSHOT_VERSION:
+            return None
+        store, series = StudyStore.load(path)
+    except (OSError, ValueError, KeyError):
+        return None
+    return store, series, meta["token"], meta["created"], generation
+
+
+def save_snapshot(store, token):
+    """
+    Writes a new study snapshot and makes it current.
+
+    Must be called with the snapshot lock held. The snapshot is written to a
+    new directory, then the CURRENT pointer is replaced atomically, so
+    workers never map a partial snapshot. Snapshots replaced more than
+    STUDY_SNAPSHOT_GRACE seconds ago are removed; pages already mapped by a
+    worker stay valid after removal.
+
+    Args:
+        store (StudyStore): The store to save.
+        token (str): Sync token of the store.
+
+    Returns:
+        str: Name of the new snapshot directory, or None if it was not written.
+    """
+    generation = f"{time.time_ns()}-{os.getpid()}"
+    path = os.path.join(STUDY_SNAPSHOT_DIR, generation)
+    try:
+        store.save(path, SERIES_INDEX)
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({"version": SNAPSHOT_VERSION, "token": token, "created": time.time()}, f)
+        pointer = os.path.join(STUDY_SNAPSHOT_DIR, f"CURRENT.{os.getpid()}.part")
+        with open(pointer, "w") as f:
+            f.write(generation)
+        os.replace(pointer, os.path.join(STUDY_SNAPSHOT_DIR, "CURRENT"))
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+    prune_snapshots(generation)
+    return generation
+
+
+def prune_snapshots(current):
+    """
+    Removes the snapshots replaced more than STUDY_SNAPSHOT_GRACE seconds ago.
+
+    A snapshot stops being current when the next one is written, which is the
+    modification time of the CURRENT pointer for the last one replaced and of
+    the following snapshot directory for the older ones. The grace period lets
+    workers that just read the old pointer finish mapping it.
+
+    Args:
+        current (str): Name of the current snapshot directory, never removed.
+    """
+    generations = sorted(name for name in os.listdir(STUDY_SNAPSHOT_DIR)
+                         if os.path.isdir(os.path.join(STUDY_SNAPSHOT_DIR, name)))
+    now = time.time()
+    for name, following in zip(generations, generations[1:] + [None]):
+        if name == current:
+            continue
+        replaced = following or current
+        try:
+            replaced_at = os.path.getmtime(os.path.join(STUDY_SNAPSHOT_DIR, replaced))
+        except OSError:
+            continue
+        if now - replaced_at > STUDY_SNAPSHOT_GRACE:
+            shutil.rmtree(os.path.join(STUDY_SNAPSHOT_DIR, name), ignore_errors=True)
+
+
+_state = {"store": None, "token": None, "synced_at": None, "fresh": False, "checked_at": 0.0, "generation": None}
+_store_lock = threading.Lock()    # guards _state, held only to read or swap it
+_refresh_lock = threading.Lock()  # held by the thread bringing the store up to date
+
+
+def store_age():
+    """
+    Returns:
+        float: Age of the data of the current store in seconds, None when fresh.
+    """
+    return None if _state["fresh"] else time.time() - _state["synced_at"]
+
+
+def init_study_store():
+    """
+    Maps the current study snapshot when the worker starts, without contacting Orthanc.
+
+    The first request then only catches up with the changes made since the
+    snapshot. Does nothing if there is no usable snapshot.
+    """
+    snapshot = load_snapshot()
+    if snapshot is None:
+        return
+    store, series, token, created, generation = snapshot
+    with _store_lock:
+        if _state["store"] is None:
+            SERIES_INDEX.clear(base=series)
+            _state.update(store=store, token=token, synced_at=created, generation=generation)
+
+
+def adopt_snapshot(state):
+    """
+    Switches a state to the current snapshot if another worker wrote a newer one.
+
+    Args:
+        state (dict): Copy of the store state, updated in place.
+
+    Returns:
+        PackedSeries: The series of the adopted snapshot, or None if it was not replaced.
+    """
+    generation = snapshot_generation()
+    if generation is None or generation == state["generation"]:
+        return None
+    snapshot = load_snapshot()
+    if snapshot is None:
+        return None
+    store, series, token, created, generation = snapshot
+    state.update(store=store, token=token, synced_at=created, generation=generation, fresh=True)
+    return series
+
+
+def catch_up(state):
+    """
+    Applies the changes of the Orthanc change log to a state.
+
+    With a snapshot directory, an updated store is written as a new snapshot
+    and mapped back, so the worker keeps no decoded copy of the studies.
+    Must then be called with the snapshot lock held.
+
+    Args:
+        state (dict): Copy of the store state, updated in place.
+
+    Returns:
+        PackedSeries: The series of the snapshot written, or None if none was.
+
+    Raises:
+        requests.exceptions.RequestException: If Orthanc fails and no store was ever built.
+    """
+    try:
+        try:
+            changes, _, age = sync_studies(state["token"])
+        except ValueError:
+            # Token of an unreadable snapshot: start over
+            changes, _, age = sync_studies()
+    except requests.exceptions.RequestException:
+        if state["store"] is None:
+            raise
+        state["fresh"] = False
+        return None
+    if age is not None:
+        # Orthanc is down and only the last successful listing is available
+        state["fresh"] = False
+        if state["store"] is None:
+            state.update(store=apply_changes(None, changes), synced_at=time.time() - age)
+        return None
+    series = None
+    if changes.get("Reset") or changes["Updated"] or changes["Deleted"] or state["store"] is None:
+        state["store"] = apply_changes(state["store"], changes)
+        if STUDY_SNAPSHOT_DIR and save_snapshot(state["store"], changes["Token"]):
+            snapshot = load_snapshot()
+            if snapshot is not None:
+                state["store"], series, _, _, state["generation"] = snapshot
+    state.update(token=changes["Token"], synced_at=time.time(), fresh=True)
+    return series
+
+
+def refresh_study_store():
+    """
+    Brings the study store up to date, without blocking the readers of the current one.
+
+    Only the worker holding the snapshot lock catches up with the Orthanc
+    change log and writes the new snapshot; the others adopt the snapshots
+    it writes, so a change is fetched and saved once for all the workers.
+    The new store is built outside _store_lock and swapped in, so requests
+    keep using the previous store meanwhile.
+
+    Raises:
+        requests.exceptions.RequestException: If Orthanc fails and no store was ever built.
+    """
+    with _store_lock:
+        state = dict(_state)
+    state["checked_at"] = time.monotonic()
+    if not STUDY_SNAPSHOT_DIR:
+        catch_up(state)
+    else:
+        # Without a store, wait for the worker building the first snapshot.
+        with snapshot_lock(blocking=state["store"] is None) as locked:
+            series = adopt_snapshot(state)
+            if series is not None:
+                # Series are keyed by study, so they can be swapped ahead of the store
+                SERIES_INDEX.clear(base=series)
+            if locked:
+                series = catch_up(state)
+                if series is not None:
+                    SERIES_INDEX.clear(base=series)
+    with _store_lock:
+        _state.update(state)
+
+
+def get_study_store():
+    """
+    Returns the study store, kept up to date from the Orthanc change log.
+
+    A worker starts from the current snapshot, mapped by init_study_store;
+    without a snapshot the study list is read once. Every STUDY_STORE_TTL
+    seconds one request brings the store up to date (see refresh_study_store)
+    while the others keep using the current store; only the very first build
+    is waited for.
+
+    Returns:
+        tuple: The store and the age of its data in seconds (None when fresh).
+
+    Raises:
+        requests.exceptions.RequestException: If Orthanc fails and no store was ever built.
+    """
+    with _store_lock:
+        store = _state["store"]
+        if store is not None and time.monotonic() - _state["checked_at"] < STUDY_STORE_TTL:
+            return store, store_age()
+    if store is not None and not _refresh_lock.acquire(blocking=False):
+        with _store_lock:
+            return _state["store"], store_age()
+    if store is None:
+        _refresh_lock.acquire()
+    try:
+        with _store_lock:
+            built = _state["store"] is not None and _state["store"] is not store
+        if not built:
+            refresh_study_store()
+    finally:
+        _refresh_lock.release()
+    with _store_lock:
+        return _state["store"], store_age()
+
+
+def parse_filters(args):
+    """
+    Reads study filters from query string arguments.
+
+    Args:
+        args (werkzeug.datastructures.MultiDict): Arguments "modality" and
+            "institution" (repeatable), "date_from" and "date_to" (YYYYMMDD), "type".
+
+    Returns:
+        dict: Filters, as accepted by StudyStore.mask.
+
+    Raises:
+        ValueError: If a date or the type is malformed.
+    """
+    filters = {
+        "modality": set(args.getlist("modality")),
+        "institution": set(args.getlist("institution")),
+        "type": args.get("type"),
+    }
+    dates = []
+    for name in ("date_from", "date_to"):
+        value = args.get(name)
+        if value and not parse_date(value):
+            raise ValueError(f"{name} must be a date formatted as YYYYMMDD")
+        dates.append(parse_date(value) or None)
+    filters["date"] = tuple(dates)
+    if filters["type"] not in (None, "", "wsi", "classic"):
+        raise ValueError("type must be 'wsi' or 'classic'")
+    return filters
+
+
+def facets_logic(args):
+    """
+    Returns the facet counts of the studies matching a set of filters.
+
+    Args:
+        args (werkzeug.datastructures.MultiDict): Filters, as accepted by parse_filters.
+
+    Returns:
+        JSON: "Total" matching studies and "Facets" counts per modality,
+            institution, year, month and type.
+    """
+    try:
+        filters = parse_filters(args)
+    except ValueError as e:
+        return jsonify({"Error": str(e)}), 400
+    try:
+        store, age = get_study_store()
+        return payload_response(store.facets(filters), age)
+    except requests.exceptions.RequestException as e:
+        return unavailable_response(e)
@@ -0,0 +1,151 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import base64
+import io
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from flask import jsonify
+from PIL import Image
+
+from app.config import (
+    THUMBNAIL_CACHE_DIR,
+    THUMBNAIL_CACHE_MAX_BYTES,
+    THUMBNAIL_MEMORY_CACHE_BYTES,
+    THUMBNAIL_SIZE,
+    THUMBNAIL_QUALITY,
+    THUMBNAIL_MAX_BATCH,
+    THUMBNAIL_WORKERS
+)
+from app.nodes import is_orthanc_id, node_for
+from app.tiles import TileCache, fetch_tile
+
+thumbnail_cache = TileCache(THUMBNAIL_CACHE_DIR, THUMBNAIL_CACHE_MAX_BYTES, THUMBNAIL_MEMORY_CACHE_BYTES)
+_executor = ThreadPoolExecutor(max_workers=THUMBNAIL_WORKERS, thread_name_prefix="thumbnails")
+
+
+def downscale(image, size=THUMBNAIL_SIZE, quality=THUMBNAIL_QUALITY):
+    """
+    Shrinks an image to fit a square, keeping its aspect ratio.
+
+    Args:
+        image (bytes): Encoded image (JPEG, PNG...).
+        size (int): Side of the square, in pixels.
+        quality (int): JPEG quality of the result.
+
+    Returns:
+        tuple: (Content-Type, bytes) of the JPEG thumbnail.
+
+    Raises:
+        OSError: If the image cannot be decoded.
+    """
+    with Image.open(io.BytesIO(image)) as img:
+        img.thumbnail((size, size))
+        output = io.BytesIO()
+        img.convert("RGB").save(output, format="JPEG", quality=quality)
+    return "image/jpeg", output.getvalue()
+
+
+def render_thumbnail(serie, client):
+    """
+    Renders the thumbnail of a series with Orthanc.
+
+    The middle instance of the series is rendered as a JPEG downscaled to fit
+    THUMBNAIL_SIZE. For WSI series, the lowest resolution tile of the pyramid
+    is used instead, since it shows the whole slide, and downscaled locally.
+
+    Args:
+        serie (dict): Orthanc series resource.
+        client (OrthancClient): Client of the node holding the series.
+
+    Returns:
+        tuple: (Content-Type, bytes).
+
+    Raises:
+        requests.exceptions.RequestException: If Orthanc cannot render the series.
+        OSError: If the WSI tile cannot be decoded.
+    """
+    series_id = serie.get("ID")
+    if serie.get("MainDicomTags", {}).get("Modality") == "SM":
+        pyramid = client.get(f"/wsi/pyramids/{series_id}")
+        _, tile = fetch_tile(series_id, len(pyramid.get("TilesCount", [])) - 1, 0, 0)
+        return downscale(tile)
+    instances = serie.get("Instances", [])
+    if not instances:
+        raise requests.exceptions.RequestException(f"Series {series_id} has no instance")
+    return client.get_bytes(f"/instances/{instances[len(instances) // 2]}/rendered",
+                            params={"width": THUMBNAIL_SIZE, "height": THUMBNAIL_SIZE, "quality": THUMBNAIL_QUALITY},
+                            headers={"Accept": "image/jpeg"})
+
+
+def fetch_thumbnail(series_id):
+    """
+    Returns the thumbnail of a series from the cache, rendering it on a miss.
+
+    Thumbnails are cached per LastUpdate of the series, so a series modified
+    in Orthanc gets a new thumbnail.
+
+    Args:
+        series_id (str): Internal Orthanc ID of the series.
+
+    Returns:
+        tuple: (Content-Type, bytes).
+
+    Raises:
+        ValueError: If the series ID is not an Orthanc identifier.
+        requests.exceptions.RequestException: If Orthanc cannot render the series.
+        OSError: If the WSI tile cannot be decoded.
+    """
+    if not is_orthanc_id(series_id):
+        raise ValueError(f"Invalid series ID: {series_id!r}")
+    client = node_for("series", series_id).client
+    serie = client.get(f"/series/{series_id}")
+    key = (series_id, "thumbnail", THUMBNAIL_SIZE, serie.get("LastUpdate", ""))
+    thumbnail = thumbnail_cache.get(key)
+    if thumbnail is None:
+        thumbnail = render_thumbnail(serie, client)
+        thumbnail_cache.put(key, thumbnail)
+    return thumbnail
+
+
+def thumbnails_logic(data):
+    """
+    Returns the thumbnails of several series in a single response.
+
+    Thumbnails cached for the current version of a series are answered
+    without rendering; the others are rendered concurrently by Orthanc. Series that cannot be rendered, or whose ID is
+    not an Orthanc identifier, are returned as null.
+
+    Args:
+        data (dict): Request body with key "Series", a list of Orthanc series IDs.
+
+    Returns:
+        JSON: Dictionary with key "Thumbnails" mapping each series ID to a data URI.
+    """
+    series_ids = list(dict.fromkeys((data or {}).get("Series", [])))
+    if len(series_ids) > THUMBNAIL_MAX_BATCH:
+        return jsonify({"Error": f"At most {THUMBNAIL_MAX_BATCH} series per request"}), 400
+
+    def encode(series_id):
+        try:
+            content_type, content = fetch_thumbnail(series_id)
+        except (requests.exceptions.RequestException, OSError, ValueError):
+            return None
+        return f"data:{content_type};base64,{base64.b64encode(content).decode()}"
+
+    return jsonify({"Thumbnails": dict(zip(series_ids, _executor.map(encode, series_ids)))})
@@ -0,0 +1,297 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import os
+import re
+import threading
+from collections import OrderedDict
+import requests
+from flask import Response, jsonify
+
+from app.config import (
+    TILE_CACHE_DIR,
+    TILE_CACHE_MAX_BYTES,
+    TILE_MEMORY_CACHE_BYTES,
+    TILE_PREGENERATE_MAX_TILES
+)
+from app.nodes import NODES, is_orthanc_id, node_for
+
+# Tiles of a series never change, so browsers may keep them.
+TILE_CACHE_CONTROL = "public, max-age=86400"
+
+# Files of the WholeSlide viewer application: relative paths whose segments never
+# start with a dot, so ".." and absolute paths cannot leave /wsi/app.
+WSI_APP_FILE = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]*(?:/[A-Za-z0-9_-][A-Za-z0-9_.-]*)*"
+                          r"\.(?:html|js|css|map|json|png|svg|ico|gif|woff2?|ttf)")
+
+
+class TileCache:
+    """
+    Two-level LRU cache of WSI tiles: a bounded in-memory dictionary in front
+    of a size-bounded directory.
+
+    Keys are tuples starting with the series ID, (series ID, level, x, y) for
+    tiles. Disk entries hold the Content-Type on their first line, followed by
+    the tile bytes.
+    """
+
+    def __init__(self, directory, disk_max_bytes, memory_max_bytes):
+        self.directory = directory
+        self.disk_max_bytes = disk_max_bytes
+        self.memory_max_bytes = memory_max_bytes
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None  # computed on first write
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        series_id, *position = key
+        if not is_orthanc_id(series_id):
+            raise ValueError(f"Invalid series ID: {series_id!r}")
+        return os.path.join(self.directory, series_id, "-".join(str(p) for p in position) + ".tile")
+
+    def get(self, key):
+        """
+        Looks a tile up in memory, then on disk.
+
+        Args:
+            key (tuple): (series ID, level, x, y).
+
+        Returns:
+            tuple: (Content-Type, bytes), or None if the tile is not cached.
+        """
+        with self._lock:
+            tile = self._memory.get(key)
+            if tile is not None:
+                self._memory.move_to_end(key)
+                return tile
+        if not self.directory:
+            return None
+        try:
+            path = self.path(key)
+            with open(path, "rb") as f:
+                content_type, content = f.read().split(b"\n", 1)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        tile = (content_type.decode(), content)
+        self._remember(key, tile)
+        return tile
+
+    def put(self, key, tile):
+        """
+        Stores a tile in memory and on disk.
+
+        Args:
+            key (tuple): (series ID, level, x, y).
+            tile (tuple): (Content-Type, bytes).
+
+        Raises:
+            OSError: If the tile cannot be written to disk; it is still cached in memory.
+        """
+        self._remember(key, tile)
+        if not self.directory:
+            return
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.part"
+        data = tile[0].encode() + b"\n" + tile[1]
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Do not leave a partial file behind, e.g. when the disk is full
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+            else:
+                self._disk_bytes += len(data)
+            over = self._disk_bytes > self.disk_max_bytes
+        if over:
+            self._evict_disk()
+
+    def _remember(self, key, tile):
+        size = len(tile[1])
+        if size > self.memory_max_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(key, None)
+            if previous is not None:
+                self._memory_bytes -= len(previous[1])
+            self._memory[key] = tile
+            self._memory_bytes += size
+            while self._memory_bytes > self.memory_max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted[1])
+
+    def _disk_entries(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith(".tile"):
+                    path = os.path.join(root, name)
+                    stat = os.stat(path)
+                    yield stat.st_mtime, stat.st_size, path
+
+    def _evict_disk(self):
+        # Removes the least recently used tiles down to 90% of the budget,
+        # so that eviction does not run again on the next write.
+        entries = sorted(self._disk_entries())
+        total = sum(size for _, size, _ in entries)
+        target = self.disk_max_bytes * 0.9
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
+        with self._lock:
+            self._disk_bytes = total
+
+
+tile_cache = TileCache(TILE_CACHE_DIR, TILE_CACHE_MAX_BYTES, TILE_MEMORY_CACHE_BYTES)
+
+
+def fetch_tile(series_id, level, x, y):
+    """
+    Returns a tile from the cache, asking Orthanc for it on a miss.
+
+    Concurrent misses on the same tile share a single Orthanc request.
+
+    Args:
+        series_id (str): Internal Orthanc ID of the WSI series.
+        level (int): Pyramid level (0 is the full resolution).
+        x (int): Tile column.
+        y (int): Tile row.
+
+    Returns:
+        tuple: (Content-Type, bytes).
+
+    Raises:
+        ValueError: If the series ID is not an Orthanc identifier.
+        requests.exceptions.RequestException: If Orthanc cannot render the tile.
+    """
+    if not is_orthanc_id(series_id):
+        raise ValueError(f"Invalid series ID: {series_id!r}")
+    key = (series_id, level, x, y)
+    tile = tile_cache.get(key)
+    if tile is None:
+        tile = node_for("series", series_id).client.get_bytes(f"/wsi/tiles/{series_id}/{level}/{x}/{y}")
+        try:
+            tile_cache.put(key, tile)
+        except OSError as e:
+            # The tile was rendered: serve it even if the disk cache cannot keep it
+            print(f"Error caching tile {key} : {e}")
+    return tile
+
+
+def tile_logic(series_id, level, x, y):
+    """
+    Serves a WSI tile through the tile cache.
+
+    Args:
+        series_id (str): Internal Orthanc ID of the WSI series.
+        level (int): Pyramid level.
+        x (int): Tile column.
+        y (int): Tile row.
+
+    Returns:
+        flask.Response: The tile image, or a JSON error.
+    """
+    if not is_orthanc_id(series_id):
+        return jsonify({"Error": "Invalid series ID"}), 400
+    try:
+        content_type, content = fetch_tile(series_id, level, x, y)
+        return Response(content, mimetype=content_type, headers={"Cache-Control": TILE_CACHE_CONTROL})
+    except requests.exceptions.RequestException as e:
+        return jsonify({"Error": str(e)}), 500
+
+
+def pyramid_logic(series_id):
+    """
+    Returns the pyramid description of a WSI series, as the WholeSlide viewer expects it.
+
+    Args:
+        series_id (str): Internal Orthanc ID of the WSI series.
+
+    Returns:
+        JSON: The Orthanc pyramid description.
+    """
+    if not is_orthanc_id(series_id):
+        return jsonify({"Error": "Invalid series ID"}), 400
+    try:
+        return jsonify(node_for("series", series_id).client.get(f"/wsi/pyramids/{series_id}"))
+    except requests.exceptions.RequestException as e:
+        return jsonify({"Error": str(e)}), 500
+
+
+def wsi_app_logic(filename):
+    """
+    Serves a static file of the Orthanc WholeSlide viewer.
+
+    Serving the viewer from the backend makes its relative `../pyramids` and
+    `../tiles` requests go through the tile cache. The file is taken from the
+    first node able to serve it. Only paths matching WSI_APP_FILE are
+    forwarded, so the route cannot reach other Orthanc resources.
+
+    Args:
+        filename (str): Path of the file inside the viewer application.
+
+    Returns:
+        flask.Response: The file, or a JSON error.
+    """
+    if not WSI_APP_FILE.fullmatch(filename):
+        return jsonify({"Error": "File not found"}), 404
+    error = None
+    for node in NODES:
+        try:
+            content_type, content = node.client.get_bytes(f"/wsi/app/{filename}")
+            return Response(content, mimetype=content_type)
+        except requests.exceptions.RequestException as e:
+            error = e
+    return jsonify({"Error": str(error)}), 500
+
+
+def pregenerate_low_levels(series_id):
+    """
+    Fills the tile cache with the lowest resolution levels of a WSI series.
+
+    Levels are taken from the smallest upwards while the total number of tiles
+    stays within TILE_PREGENERATE_MAX_TILES.
+
+    Args:
+        series_id (str): Internal Orthanc ID of the WSI series.
+
+    Raises:
+        requests.exceptions.RequestException: If Orthanc cannot render a tile.
+    """
+    pyramid = node_for("series", series_id).client.get(f"/wsi/pyramids/{series_id}")
+    budget = TILE_PREGENERATE_MAX_TILES
+    for level in reversed(range(len(pyramid.get("TilesCount", [])))):
+        tiles_x, tiles_y = pyramid["TilesCount"][level]
+        budget -= tiles_x * tiles_y
+        if budget < 0:
+            break
+        for x in range(tiles_x):
+            for y in range(tiles_y):
+                fetch_tile(series_id, level, x, y)
@@ -0,0 +1,83 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class VerifiedTokenCache:
+    """
+    Bounded LRU cache of the payloads of tokens whose signature was verified.
+
+    Entries are keyed by the SHA-256 digest of the token, so the tokens
+    themselves are not kept, and expire at the "exp" claim of the token.
+    Tokens without expiration are never cached.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode()).digest()
+
+    def get(self, token):
+        """
+        Looks a token up.
+
+        Args:
+            token (str): The encoded token.
+
+        Returns:
+            dict: The verified payload, or None if the token is unknown, expired
+                or not a string.
+        """
+        if not isinstance(token, str):
+            return None
+        key = self._key(token)
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is None:
+                return None
+            if payload["exp"] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def put(self, token, payload):
+        """
+        Records a verified token.
+
+        Args:
+            token (str): The encoded token.
+            payload (dict): Its decoded payload.
+        """
+        if (self.max_size <= 0 or not isinstance(token, str)
+                or not isinstance(payload.get("exp"), (int, float))):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
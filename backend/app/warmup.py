@@ -0,0 +1,277 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+import os
+import re
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from app.config import (
+    WARMUP_CONCURRENCY,
+    WARMUP_INTERVAL,
+    WARMUP_LOCK_FILE,
+    WARMUP_ON_SAVE,
+    WARMUP_WINDOWS,
+    sessions_db
+)
+from app.manifest import manifest_cache_path, schedule_manifest
+from app.nodes import ORTHANC_ID, node_for, query_nodes, remember
+from app.orthanc import fetch_series_batch
+from app.tiles import pregenerate_low_levels
+
+_executor = ThreadPoolExecutor(max_workers=WARMUP_CONCURRENCY, thread_name_prefix="warmup")
+_warmed = {}  # study ID -> LastUpdate at the time of the last warm-up
+_pending = set()  # viewer URLs of the sessions queued or being warmed
+_lock = threading.Lock()
+_scheduler_lock = None  # Open lock file while this process runs the scheduled warm-ups
+
+
+def in_warmup_window(now=None):
+    """
+    Checks whether warm-up jobs are allowed to run at a given time.
+
+    Args:
+        now (datetime, optional): Time to check, the current local time by default.
+
+    Returns:
+        bool: True if the time falls in one of the WARMUP_WINDOWS.
+    """
+    current = (now or datetime.now()).strftime("%H:%M")
+    for start, end in WARMUP_WINDOWS:
+        if start <= end and start <= current <= end:
+            return True
+        if start > end and (current >= start or current <= end):
+            return True
+    return False
+
+
+def studies_from_viewer_url(viewer_url):
+    """
+    Finds the Orthanc studies referenced by a saved viewer URL.
+
+    Handles backend and Orthanc study routes, Stone links (StudyInstanceUID)
+    and series-level links (WholeSlide viewer, series archives).
+
+    Args:
+        viewer_url (str): URL saved with the session.
+
+    Returns:
+        set: Internal Orthanc IDs of the referenced studies.
+
+    Raises:
+        requests.exceptions.RequestException: If Orthanc cannot resolve an identifier.
+    """
+    url = urllib.parse.unquote(viewer_url)
+    study_ids = set(re.findall(rf"/studies/({ORTHANC_ID})", url))
+
+    series_ids = set(re.findall(rf"/series/({ORTHANC_ID})", url))
+    series_ids.update(re.findall(rf"[?&]series=({ORTHANC_ID})", url))
+    for serie_id in series_ids:
+        node = node_for("series", serie_id)
+        study_id = node.client.get(f"/series/{serie_id}").get("ParentStudy")
+        remember(study_id, node)
+        study_ids.add(study_id)
+
+    for study_uid in re.findall(r"[?&]study=([0-9.]+)", url):
+        results, _, _ = query_nodes(lambda node: node.client.post("/tools/find", {
+            "Level": "Study",
+            "Query": {"StudyInstanceUID": study_uid}
+        }))
+        for node, found in results.items():
+            for study_id in found:
+                remember(study_id, node)
+            study_ids.update(found)
+    study_ids.discard(None)
+    return study_ids
+
+
+def warm_series(serie):
+    """
+    Makes Orthanc decode the first frame of a series (or the lowest pyramid levels for WSI).
+
+    Args:
+        serie (dict): Expanded Orthanc series, or a series listed through QIDO-RS.
+    """
+    if serie.get("MainDicomTags", {}).get("Modality") == "SM":
+        pregenerate_low_levels(serie.get("ID"))
+        return
+    client = node_for("series", serie.get("ID")).client
+    if "Instances" not in serie:
+        # Series listed through QIDO-RS do not carry their instances.
+        serie = client.get(f"/series/{serie.get('ID')}")
+    instances = serie.get("Instances", [])
+    if instances:
+        response = client.stream(f"/instances/{instances[0]}/frames/0/rendered")
+        response.close()
+
+
+def warm_study(study_id):
+    """
+    Pre-loads everything a launch of a study needs.
+
+    Loads the study classification and series metadata into the local series
+    index, generates the OHIF manifest and renders the first frame of each
+    series, or the lowest pyramid levels of WSI series. A study is skipped if
+    it was already warmed since its last update.
+
+    Args:
+        study_id (str): Internal Orthanc ID of the study.
+    """
+    try:
+        study = node_for("studies", study_id).client.get(f"/studies/{study_id}")
+        last_update = study.get("LastUpdate")
+        with _lock:
+            if _warmed.get(study_id) == last_update:
+                return
+        study_uid = study.get("MainDicomTags", {}).get("StudyInstanceUID")
+        series = fetch_series_batch([{"_id": study_id, "studyUID": study_uid}]).get(study_id, [])
+        if not any(s.get("MainDicomTags", {}).get("Modality") == "SM" for s in series):
+            schedule_manifest(study_id, manifest_cache_path(study_id)).result()
+        for serie in series:
+            warm_series(serie)
+        with _lock:
+            _warmed[study_id] = last_update
+    except Exception as e:
+        print(f"Error warming up study {study_id} : {e}")
+
+
+def warm_session(viewer_url):
+    """
+    Warms every study referenced by a saved session.
+
+    Args:
+        viewer_url (str): URL saved with the session.
+    """
+    if not in_warmup_window():
+        return
+    try:
+        study_ids = studies_from_viewer_url(viewer_url)
+    except Exception as e:
+        print(f"Error resolving studies of {viewer_url} : {e}")
+        return
+    for study_id in study_ids:
+        warm_study(study_id)
+
+
+def queue_session_warmup(viewer_url):
+    """
+    Queues the warm-up of a session, unless it is already pending.
+
+    A session stays pending until its warm-up has run, so a slow Orthanc
+    never lets the same session pile up in the executor queue.
+
+    Args:
+        viewer_url (str): URL saved with the session.
+
+    Returns:
+        bool: True if the warm-up was queued.
+    """
+    with _lock:
+        if viewer_url in _pending:
+            return False
+        _pending.add(viewer_url)
+
+    def run():
+        try:
+            warm_session(viewer_url)
+        finally:
+            with _lock:
+                _pending.discard(viewer_url)
+
+    _executor.submit(run)
+    return True
+
+
+def schedule_session_warmup(viewer_url):
+    """
+    Queues the warm-up of a session that has just been saved.
+
+    Args:
+        viewer_url (str): URL saved with the session.
+    """
+    if WARMUP_ON_SAVE:
+        queue_session_warmup(viewer_url)
+
+
+def warm_all_sessions():
+    """
+    Queues the warm-up of every session stored in CouchDB, skipping those still pending.
+    """
+    for doc_id in sessions_db:
+        viewer_url = sessions_db[doc_id].get("viewer_url")
+        if viewer_url:
+            queue_session_warmup(viewer_url)
+
+
+def acquire_scheduler_lock():
+    """
+    Makes this process the one running the scheduled warm-ups, if no other does.
+
+    The lock is an exclusive flock on WARMUP_LOCK_FILE, held until the process
+    exits, so a single worker of the server warms the sessions and another one
+    takes over if it dies. Without flock (Windows), the server is assumed to
+    run a single process, which always runs them.
+
+    Returns:
+        bool: True if this process holds the lock.
+    """
+    global _scheduler_lock
+    if _scheduler_lock is not None or fcntl is None:
+        return True
+    directory = os.path.dirname(WARMUP_LOCK_FILE)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    lock_file = open(WARMUP_LOCK_FILE, "a")
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock_file.close()
+        return False
+    _scheduler_lock = lock_file
+    return True
+
+
+def start_warmup_scheduler():
+    """
+    Starts the daemon thread that periodically warms the saved sessions.
+
+    Every worker starts the thread, but only the one holding the scheduler
+    lock runs the warm-ups; the others keep trying to take it over.
+    Does nothing when WARMUP_INTERVAL is 0.
+    """
+    if WARMUP_INTERVAL <= 0:
+        return
+
+    def run():
+        while True:
+            try:
+                if acquire_scheduler_lock() and in_warmup_window():
+                    warm_all_sessions()
+            except Exception as e:
+                print(f"Error scheduling warm-up : {e}")
+            time.sleep(WARMUP_INTERVAL)
+
+    threading.Thread(target=run, name="warmup-scheduler", daemon=True).start()
@@ -0,0 +1,199 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+"""
+Test configuration.
+
+app.config connects to CouchDB and reads the key files when imported, so the
+tests replace it with the module below before anything from the application
+is imported. Orthanc is replaced per test by FakeOrthanc.
+"""
+
+import os
+import sys
+import tempfile
+import types
+import pytest
+import requests
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+class FakeDatabase(dict):
+    """
+    In-memory stand-in for a couchdb.Database.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def save(self, doc):
+        self[doc["_id"]] = doc
+
+    def update(self, docs):
+        self.batches.append(list(docs))
+        for doc in docs:
+            self[doc["_id"]] = doc
+        return [(True, doc["_id"], "1-0") for doc in docs]
+
+
+CACHE_ROOT = tempfile.mkdtemp(prefix="orthanflow-tests-")
+_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+
+config = types.ModuleType("app.config")
+config.__dict__.update(
+    sessions_db=FakeDatabase(),
+    events_db=FakeDatabase(),
+    ORTHANC_URL="http://orthanc",
+    ORTHANC_AUTH=None,
+    ORTHANC_NODES=[{"name": "main", "url": "http://orthanc", "auth": None, "timeout": 2}],
+    ORTHANC_NODE_CONCURRENCY=2,
+    ORTHANC_COALESCE_WINDOW=0.5,
+    ORTHANC_TIMEOUT=(1, 2),
+    ORTHANC_BREAKER_FAILURES=2,
+    ORTHANC_BREAKER_RESET=0.2,
+    STALE_REFRESH_ATTEMPTS=0,
+    STALE_CACHE_SIZE=3,
+    DATA_SOURCE="native",
+    SERIES_PREFETCH_COUNT=0,
+    CHANGES_PAGE_SIZE=2,
+    CHANGES_MAX_DELTA=10,
+    STUDY_STORE_TTL=0,
+    STUDY_SNAPSHOT_DIR=os.path.join(CACHE_ROOT, "snapshots"),
+    STUDY_SNAPSHOT_GRACE=60,
+    BACKEND_URL="http://backend",
+    FRONTEND_URL="http://frontend",
+    ARCHIVE_CACHE_DIR=os.path.join(CACHE_ROOT, "archives"),
+    ARCHIVE_CACHE_MAX_BYTES=1024,
+    ARCHIVE_CHUNK_SIZE=4,
+    MANIFEST_CACHE_DIR=os.path.join(CACHE_ROOT, "manifests"),
+    MANIFEST_WORKERS=2,
+    TILE_CACHE_DIR=os.path.join(CACHE_ROOT, "tiles"),
+    TILE_CACHE_MAX_BYTES=1024,
+    TILE_MEMORY_CACHE_BYTES=64,
+    TILE_PREGENERATE_MAX_TILES=5,
+    THUMBNAIL_CACHE_DIR=os.path.join(CACHE_ROOT, "thumbnails"),
+    THUMBNAIL_CACHE_MAX_BYTES=1024,
+    THUMBNAIL_MEMORY_CACHE_BYTES=64,
+    THUMBNAIL_SIZE=64,
+    THUMBNAIL_QUALITY=80,
+    THUMBNAIL_MAX_BATCH=3,
+    THUMBNAIL_WORKERS=2,
+    ADMISSION_CAPACITY=2,
+    ADMISSION_RESERVED_LAUNCH=1,
+    ADMISSION_QUEUE_SIZE=2,
+    ADMISSION_QUEUE_TIMEOUT=0.2,
+    ADMISSION_RETRY_AFTER=2,
+    UPSTREAM_LIMITS={"moodle": 1, "couchdb": 1},
+    UPSTREAM_WAIT_TIMEOUT=0.1,
+    WARMUP_CONCURRENCY=1,
+    WARMUP_INTERVAL=0,
+    WARMUP_LOCK_FILE=os.path.join(CACHE_ROOT, "warmup.lock"),
+    WARMUP_ON_SAVE=False,
+    WARMUP_WINDOWS=[("00:00", "23:59")],
+    EVENT_BUFFER_SIZE=5,
+    EVENT_BATCH_SIZE=2,
+    EVENT_FLUSH_INTERVAL=0.1,
+    PLATFORM_ID="http://moodle",
+    CLIENT_ID="client",
+    MOODLE_AUTH_URL="http://moodle/auth",
+    MOODLE_CERT_URL="http://moodle/certs",
+    MOODLE_TOKEN_URL="http://moodle/token",
+    MOODLE_TIMEOUT=(1, 2),
+    AFFICHAGE_MOODLE="OrthanFlow",
+    KID="kid",
+    PRIVATE_KEY=_key,
+    PUBLIC_KEY=_key.public_key(),
+    STUDENT_TOKEN_ALGORITHM="RS256",
+    STUDENT_TOKEN_SECRET="",
+    STUDENT_TOKEN_EDDSA_KEY="",
+    TOKEN_CACHE_SIZE=4,
+)
+sys.modules["app.config"] = config
+
+
+def http_error(status):
+    """
+    Builds the error raised by raise_for_status for an HTTP status.
+    """
+    response = requests.Response()
+    response.status_code = status
+    return requests.exceptions.HTTPError(f"{status} Error", response=response)
+
+
+class FakeOrthanc:
+    """
+    Answers the calls of an OrthancClient from a dictionary of paths.
+
+    Values are returned as is, called with the query parameters if callable,
+    or raised if they are exceptions. Unknown paths answer 404.
+    """
+
+    def __init__(self, responses=None):
+        self.responses = responses or {}
+        self.calls = []
+
+    def _answer(self, path, params=None):
+        self.calls.append(path)
+        value = self.responses.get(path)
+        if value is None:
+            raise http_error(404)
+        if isinstance(value, Exception):
+            raise value
+        return value(params) if callable(value) else value
+
+    def get(self, path, params=None):
+        return self._answer(path, params)
+
+    def post(self, path, payload):
+        return self._answer(path, payload)
+
+    def get_bytes(self, path, params=None, headers=None):
+        return self._answer(path, params)
+
+
+@pytest.fixture
+def orthanc(monkeypatch):
+    """
+    Replaces the Orthanc client of the only node with a FakeOrthanc.
+    """
+    from app import nodes, orthanc as orthanc_module
+    fake = FakeOrthanc()
+    client = nodes.NODES[0].client
+    for method in ("get", "post", "get_bytes"):
+        monkeypatch.setattr(client, method, getattr(fake, method))
+    orthanc_module.SERIES_INDEX.clear()
+    nodes._locations.clear()
+    return fake
+
+
+@pytest.fixture
+def app():
+    from flask import Flask
+    flask_app = Flask("tests")
+    with flask_app.test_request_context():
+        yield flask_app
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    """
+    Test client of the full application, with its session files in a temporary directory.
+    """
+    from app import create_app
+    monkeypatch.chdir(tmp_path)
+    return create_app().test_client()
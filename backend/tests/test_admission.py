@@ -0,0 +1,109 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import threading
+import time
+
+import pytest
+import requests
+
+from app import admission as admission_module
+from app import lti
+from app.admission import HIGH, LOW, AdmissionController, Overloaded, upstream_slot
+
+
+def test_low_priority_leaves_reserved_slots_for_high():
+    controller = AdmissionController(capacity=2, reserved=1, queue_size=0, timeout=0.05)
+    controller.acquire(LOW)
+    with pytest.raises(Overloaded):
+        controller.acquire(LOW)
+    controller.acquire(HIGH)
+    assert controller.snapshot()["in_flight"] == 2
+
+
+def test_full_queue_rejects_immediately():
+    controller = AdmissionController(capacity=1, reserved=0, queue_size=0, timeout=5)
+    controller.acquire(HIGH)
+    start = time.monotonic()
+    with pytest.raises(Overloaded, match="queue full"):
+        controller.acquire(HIGH)
+    assert time.monotonic() - start < 1
+    assert controller.snapshot()["high"]["rejected"] == 1
+
+
+def test_waiting_request_enters_when_a_slot_frees_up():
+    controller = AdmissionController(capacity=1, reserved=0, queue_size=1, timeout=2)
+    controller.acquire(HIGH)
+    threading.Timer(0.05, controller.release).start()
+    assert controller.acquire(HIGH) >= 0.04
+
+
+def test_low_priority_yields_to_waiting_high():
+    controller = AdmissionController(capacity=2, reserved=0, queue_size=2, timeout=0.5)
+    controller.acquire(LOW)
+    controller.acquire(LOW)
+    order = []
+
+    def enter(priority):
+        controller.acquire(priority)
+        order.append(priority)
+
+    high = threading.Thread(target=enter, args=(HIGH,))
+    high.start()
+    time.sleep(0.05)
+    low = threading.Thread(target=enter, args=(LOW,))
+    low.start()
+    time.sleep(0.05)
+    controller.release()
+    high.join()
+    controller.release()
+    low.join()
+    assert order == [HIGH, LOW]
+
+
+def test_upstream_slot_limits_concurrent_calls():
+    with upstream_slot("moodle"):
+        with pytest.raises(Overloaded):
+            with upstream_slot("moodle"):
+                pass
+    with upstream_slot("moodle"):
+        pass
+
+
+def test_hanging_moodle_releases_its_slot(monkeypatch):
+    timeouts = []
+
+    def get(url, **kwargs):
+        timeouts.append(kwargs.get("timeout"))
+        raise requests.exceptions.ReadTimeout()
+
+    monkeypatch.setattr(lti.requests, "get", get)
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        lti.get_moodle_pubkey("kid")
+    assert timeouts == [lti.MOODLE_TIMEOUT]
+    with upstream_slot("moodle"):
+        pass
+
+
+def test_overload_answers_503_with_retry_after(client, monkeypatch):
+    def refuse(priority):
+        raise Overloaded("Admission queue full")
+
+    monkeypatch.setattr(admission_module.admission, "acquire", refuse)
+    response = client.get("/studies")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "2"
@@ -0,0 +1,95 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import os
+
+import pytest
+
+from app import viewer_origins
+from app.archive import _writing, stream_archive
+from app.nodes import NODES
+
+STUDY_ID = "0a1b2c3d-4e5f6a7b-8c9d0e1f-2a3b4c5d-6e7f8a9b"
+
+
+class FakeStream:
+    def __init__(self, chunks, fail_after=None, status_code=200):
+        self.chunks = chunks
+        self.fail_after = fail_after
+        self.status_code = status_code
+        self.headers = {"Content-Type": "application/zip"}
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for index, chunk in enumerate(self.chunks):
+            if index == self.fail_after:
+                raise IOError("connection lost")
+            yield chunk
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def archive_client(client, monkeypatch):
+    monkeypatch.setattr("app.archive.ARCHIVE_CACHE_DIR", "")
+    monkeypatch.setattr(NODES[0].client, "stream", lambda path, headers=None: FakeStream([b"zip"]))
+    return client
+
+
+def test_viewer_origins_are_the_frontend_and_the_nodes():
+    assert viewer_origins() == ["http://frontend", "http://orthanc"]
+
+
+def test_archive_is_shared_with_viewer_origins_without_credentials(archive_client):
+    response = archive_client.get(f"/studies/{STUDY_ID}/archive", headers={"Origin": "http://orthanc"})
+    assert response.data == b"zip"
+    assert response.headers["Access-Control-Allow-Origin"] == "http://orthanc"
+    assert "Access-Control-Allow-Credentials" not in response.headers
+
+
+def test_archive_is_not_shared_with_other_origins(archive_client):
+    response = archive_client.get(f"/studies/{STUDY_ID}/archive", headers={"Origin": "http://evil.example"})
+    assert "Access-Control-Allow-Origin" not in response.headers
+
+
+def test_completed_archive_fills_the_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr("app.archive.ARCHIVE_CACHE_DIR", str(tmp_path))
+    cache_path = str(tmp_path / "studies-a.zip")
+    upstream = FakeStream([b"ab", b"cd"])
+    assert b"".join(stream_archive(upstream, cache_path)) == b"abcd"
+    assert upstream.closed
+    with open(cache_path, "rb") as f:
+        assert f.read() == b"abcd"
+
+
+def test_interrupted_archive_leaves_no_cache_file(tmp_path):
+    cache_path = str(tmp_path / "studies-b.zip")
+    with pytest.raises(IOError):
+        b"".join(stream_archive(FakeStream([b"ab", b"cd"], fail_after=1), cache_path))
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("resource_id", ["st1", "..%5c..%5cpatients"])
+def test_malformed_archive_id_is_rejected(archive_client, resource_id):
+    assert archive_client.get(f"/studies/{resource_id}/archive").status_code == 400
+
+
+def test_archive_is_streamed_when_the_cache_file_cannot_be_opened(tmp_path):
+    cache_path = str(tmp_path / "missing" / "studies-c.zip")
+    assert b"".join(stream_archive(FakeStream([b"ab", b"cd"]), cache_path)) == b"abcd"
+    assert cache_path not in _writing
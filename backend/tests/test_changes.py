@@ -0,0 +1,157 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import pytest
+import requests
+
+from conftest import FakeOrthanc
+from app import changes, nodes, resilience
+from app.changes import format_token, parse_token, study_changes_logic, sync_studies
+from app.nodes import OrthancNode
+from app.sources import NativeSource
+from app.study_store import StudyStore, apply_changes
+
+
+def make_node(name, studies, changes=(), last=None):
+    node = OrthancNode(name, f"http://{name}", None, 1)
+    node.client = FakeOrthanc()
+    node.source = NativeSource(node.client)
+    set_studies(node, studies)
+    set_changes(node, changes, last)
+    return node
+
+
+def set_studies(node, studies):
+    node.client.responses["/studies"] = [{"ID": s, "Series": [], "MainDicomTags": {"StudyInstanceUID": f"uid-{s}"}}
+                                         for s in studies]
+    for s in studies:
+        node.client.responses[f"/studies/{s}"] = {"ID": s, "Series": [], "MainDicomTags": {"StudyInstanceUID": f"uid-{s}"}}
+
+
+def set_changes(node, changes, last=None):
+    changes = [{"Seq": seq, "ResourceType": "Study", "ID": study_id, "ChangeType": kind}
+               for seq, study_id, kind in changes]
+    last = last if last is not None else (changes[-1]["Seq"] if changes else 0)
+
+    def answer(params):
+        if "last" in params:
+            return {"Last": last}
+        page = [c for c in changes if c["Seq"] > params["since"]][:params["limit"]]
+        return {"Changes": page, "Last": page[-1]["Seq"] if page else params["since"],
+                "Done": len(page) < params["limit"]}
+
+    node.client.responses["/changes"] = answer
+
+
+@pytest.fixture
+def federation(monkeypatch):
+    monkeypatch.setattr(resilience, "_last_good", resilience.OrderedDict())
+    first = make_node("first", ["a1", "a2"], last=5)
+    second = make_node("second", ["b1"], last=7)
+    for module in (nodes, changes):
+        monkeypatch.setattr(module, "NODES", [first, second])
+    return first, second
+
+
+def test_token_round_trip(federation):
+    assert parse_token("first:5,second:7") == {"first": 5, "second": 7}
+    assert format_token({"second": 7, "first": 5, "gone": 1}) == "first:5,second:7"
+    with pytest.raises(ValueError):
+        parse_token("first:abc")
+
+
+def test_full_sync_lists_every_node(federation):
+    body, unavailable, age = sync_studies()
+    assert body["Reset"]
+    assert [s["_id"] for s in body["Studies"]] == ["a1", "a2", "b1"]
+    assert body["Token"] == "first:5,second:7"
+    assert unavailable == [] and age is None
+
+
+def test_node_missing_from_the_full_sync_is_resynced_next(federation):
+    first, second = federation
+    second.client.responses["/studies"] = requests.exceptions.ConnectionError("down")
+    body, unavailable, _ = sync_studies()
+    assert [s["_id"] for s in body["Studies"]] == ["a1", "a2"]
+    assert unavailable == ["second"]
+    assert body["Token"] == "first:5"
+    set_studies(second, ["b1"])
+    body, _, _ = sync_studies(body["Token"])
+    assert body["ResetNodes"] == ["second"]
+    assert [s["_id"] for s in body["Updated"]] == ["b1"]
+    assert body["Token"] == "first:5,second:7"
+
+
+def test_delta_reads_changes_since_the_token(federation):
+    first, _ = federation
+    set_studies(first, ["a1", "a2", "a3"])
+    set_changes(first, [(6, "a3", "NewStudy"), (7, "a4", "NewStudy"), (8, "a2", "Deleted")])
+    body, _, _ = sync_studies("first:5,second:7")
+    assert [s["_id"] for s in body["Updated"]] == ["a3"]
+    assert sorted(body["Deleted"]) == ["a2", "a4"]
+    assert body["ResetNodes"] == []
+    assert body["Token"] == "first:8,second:7"
+
+
+def test_node_missing_from_the_token_is_resynced_alone(federation):
+    first, second = federation
+    body, _, _ = sync_studies("first:5")
+    assert body["ResetNodes"] == ["second"]
+    assert [s["_id"] for s in body["Updated"]] == ["b1"]
+    assert "/studies" not in first.client.calls
+    assert body["Token"] == "first:5,second:7"
+
+
+def test_node_with_too_many_changes_is_resynced_alone(federation):
+    first, second = federation
+    set_changes(second, [(seq, "b1", "StableStudy") for seq in range(8, 30)])
+    body, _, _ = sync_studies("first:5,second:7")
+    assert body["ResetNodes"] == ["second"]
+    assert "/studies" not in first.client.calls
+
+
+def test_unavailable_node_keeps_its_sequence(federation):
+    first, second = federation
+    second.client.responses["/changes"] = requests.exceptions.ConnectionError("down")
+    body, unavailable, _ = sync_studies("first:5,second:3")
+    assert unavailable == ["second"]
+    assert body["Token"] == "first:5,second:3"
+
+
+def test_full_sync_falls_back_to_the_last_listing(federation, app):
+    first, second = federation
+    sync_studies()
+    for node in federation:
+        node.client.responses["/changes"] = requests.exceptions.ConnectionError("down")
+        node.client.responses["/studies"] = requests.exceptions.ConnectionError("down")
+    response = study_changes_logic()
+    assert response.headers["X-Stale-Age"] == "0"
+    assert response.get_json()["Token"] is None
+    assert len(response.get_json()["Studies"]) == 3
+
+
+def test_invalid_token_is_rejected(federation, app):
+    assert study_changes_logic("first:x")[1] == 400
+
+
+def test_store_drops_the_studies_of_resynced_nodes():
+    store = StudyStore([{"_id": "a1", "studyUID": "1", "node": "first"},
+                        {"_id": "b1", "studyUID": "2", "node": "second"},
+                        {"_id": "b2", "studyUID": "3", "node": "second"}])
+    store = apply_changes(store, {"Updated": [{"_id": "b3", "studyUID": "4", "node": "second"}],
+                                  "Deleted": [], "ResetNodes": ["second"]})
+    assert [study["_id"] for study in store.studies] == ["a1", "b3"]
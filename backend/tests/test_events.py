@@ -0,0 +1,86 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import pytest
+from flask import Flask, request
+
+from app import lti
+from app.events import EventLog
+from conftest import FakeDatabase
+
+LAUNCH = {
+    "https://purl.imsglobal.org/spec/lti/claim/message_type": "LtiResourceLinkRequest",
+    "https://purl.imsglobal.org/spec/lti/claim/custom": {"res_id": "res-1"},
+    "sub": "student",
+}
+
+
+@pytest.fixture
+def events(monkeypatch):
+    log = EventLog(FakeDatabase(), capacity=5, batch_size=2, interval=0.1)
+    monkeypatch.setattr(lti, "event_log", log)
+    monkeypatch.setattr(lti, "get_token", lambda id_token: LAUNCH)
+    monkeypatch.setattr(lti, "sessions_db", {"res-1": {"viewer_url": "http://orthanc/ohif/viewer"}})
+    return log
+
+
+def launch():
+    with Flask("tests").test_request_context("/launch", method="POST", data={"id_token": "token"}):
+        return lti.launch_logic(request)
+
+
+def recorded(log):
+    log.flush()
+    return [doc for batch in log.db.batches for doc in batch]
+
+
+def test_launch_records_denied_access(events, monkeypatch):
+    monkeypatch.setattr(lti, "enrolled", lambda nrps_url, sub, roles: False)
+    _, status = launch()
+    assert status == 403
+    [event] = recorded(events)
+    assert (event["event"], event["res_id"], event["viewer"]) == ("launch", "res-1", "ohif")
+    assert event["authorized"] is False
+    assert "error" not in event
+
+
+def test_registration_errors_deny_the_launch(events, monkeypatch):
+    monkeypatch.setattr(lti, "enrolled",
+                        lambda nrps_url, sub, roles: "Error verifying user registration : timeout")
+    _, status = launch()
+    assert status == 403
+    [event] = recorded(events)
+    assert event["authorized"] is False
+    assert event["error"] == "Error verifying user registration : timeout"
+
+
+def test_launch_records_granted_access(events, monkeypatch):
+    monkeypatch.setattr(lti, "enrolled", lambda nrps_url, sub, roles: True)
+    _, status = launch()
+    assert status == 302
+    [event] = recorded(events)
+    assert event["authorized"] is True
+    assert "error" not in event
+
+
+def test_full_buffer_drops_new_events():
+    log = EventLog(FakeDatabase(), capacity=2, batch_size=2, interval=0.1)
+    for index in range(3):
+        log.record("launch", res_id=str(index))
+    assert log.flush() == 2
+    assert [doc["res_id"] for doc in log.db.batches[0]] == ["0", "1"]
+    assert log.snapshot()["dropped"] == 1
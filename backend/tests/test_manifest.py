@@ -0,0 +1,87 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import threading
+
+import pytest
+from flask import request
+
+from app import manifest
+from app.nodes import NODES
+
+
+class FakeStream:
+    def __init__(self, payload, gate=None):
+        self.payload = payload
+        self.gate = gate
+
+    def json(self):
+        if self.gate is not None:
+            self.gate.wait(2)
+        return self.payload
+
+    def close(self):
+        pass
+
+
+def manifest_for(description):
+    return {"studies": [{"StudyDescription": description,
+                         "series": [{"instances": [{"url": "dicomweb:../../instances/i1/file"}]}]}]}
+
+
+@pytest.fixture
+def study(orthanc, monkeypatch, tmp_path):
+    monkeypatch.setattr(manifest, "MANIFEST_CACHE_DIR", str(tmp_path))
+    orthanc.responses["/studies/st1"] = {"ID": "st1", "LastUpdate": "20250101T000000"}
+    streams = []
+    monkeypatch.setattr(NODES[0].client, "stream", lambda path, headers=None: streams.pop(0))
+    return streams
+
+
+def test_manifest_is_generated_with_absolute_urls(app, study, tmp_path):
+    study.append(FakeStream(manifest_for("first")))
+    result = manifest.manifest_logic("st1", request).get_json()
+    url = result["studies"][0]["series"][0]["instances"][0]["url"]
+    assert url == "dicomweb:http://orthanc/instances/i1/file"
+    assert manifest.latest_manifest("st1") == manifest.manifest_cache_path("st1")
+
+
+def test_changed_study_serves_the_manifest_recorded_on_disk(app, orthanc, study):
+    study.append(FakeStream(manifest_for("first")))
+    manifest.manifest_logic("st1", request)
+
+    # The pointer is read from disk, as a restarted or another worker would.
+    gate = threading.Event()
+    study.append(FakeStream(manifest_for("second"), gate))
+    orthanc.responses["/studies/st1"] = {"ID": "st1", "LastUpdate": "20250102T000000"}
+    future_path = manifest.manifest_cache_path("st1")
+    result = manifest.manifest_logic("st1", request).get_json()
+    assert result["studies"][0]["StudyDescription"] == "first"
+
+    gate.set()
+    manifest.schedule_manifest("st1", future_path).result()
+    assert manifest.latest_manifest("st1") == future_path
+
+
+def test_unwritable_cache_serves_the_uncached_manifest(app, study, monkeypatch, tmp_path):
+    blocker = tmp_path / "file"
+    blocker.write_text("")
+    monkeypatch.setattr(manifest, "MANIFEST_CACHE_DIR", str(blocker / "manifests"))
+    study.extend([FakeStream(manifest_for("first")), FakeStream(manifest_for("first"))])
+    response = manifest.manifest_logic("st1", request)
+    assert response.status_code == 200
+    assert response.get_json()["studies"][0]["StudyDescription"] == "first"
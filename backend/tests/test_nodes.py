@@ -0,0 +1,76 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import threading
+
+import pytest
+
+from app import nodes
+from app.nodes import NodeBusy, NodeTimeout, OrthancNode, run_on_nodes
+from app.orthanc import list_studies
+
+
+class FakeSource:
+    def __init__(self, uids):
+        self.uids = uids
+
+    def list_studies(self, limit=None, offset=0):
+        uids = self.uids[offset:offset + limit] if limit else self.uids[offset:]
+        return [{"ID": f"id-{uid}", "MainDicomTags": {"StudyInstanceUID": uid}} for uid in uids]
+
+
+def make_node(name, timeout=1, concurrency=2):
+    return OrthancNode(name, f"http://{name}", None, timeout, concurrency=concurrency)
+
+
+def test_slow_node_does_not_delay_the_others():
+    slow, fast = make_node("slow", timeout=0.05, concurrency=1), make_node("fast")
+    release = threading.Event()
+    results, errors, _ = run_on_nodes({slow: lambda: release.wait(2), fast: lambda: "ok"})
+    assert results == {fast: "ok"}
+    assert isinstance(errors[slow], NodeTimeout)
+
+    # The timed-out task still holds the only slot of the slow node.
+    results, errors, _ = run_on_nodes({slow: lambda: "late", fast: lambda: "again"})
+    assert results == {fast: "again"}
+    assert isinstance(errors[slow], NodeBusy)
+
+    # The slot is given back once the task finishes.
+    release.set()
+    slow.executor.shutdown(wait=True)
+    assert slow.slots.acquire(blocking=False)
+
+
+@pytest.fixture
+def federation(monkeypatch):
+    first, second = make_node("first"), make_node("second")
+    first.source = FakeSource(["1", "2", "3"])
+    second.source = FakeSource(["2", "4", "5", "6"])
+    monkeypatch.setattr(nodes, "NODES", [first, second])
+    return first, second
+
+
+def test_pages_are_cut_from_the_merged_listing(federation):
+    merged = [s["studyUID"] for s in list_studies()["Studies"]]
+    assert merged == ["1", "2", "3", "4", "5", "6"]
+    pages = [[s["studyUID"] for s in list_studies(2, offset)["Studies"]] for offset in (0, 2, 4)]
+    assert pages == [["1", "2"], ["3", "4"], ["5", "6"]]
+
+
+def test_studies_record_their_node(federation):
+    studies = list_studies()["Studies"]
+    assert [s["node"] for s in studies] == ["first", "first", "first", "second", "second", "second"]
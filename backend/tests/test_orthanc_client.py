@@ -0,0 +1,105 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import threading
+import time
+
+import pytest
+import requests
+
+from app.orthanc_client import OrthancClient
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+def slow_upstream(monkeypatch, delay=0.1, error=None):
+    calls = []
+
+    def request(method, url, **kwargs):
+        calls.append((method, url, kwargs.get("params")))
+        time.sleep(delay)
+        if error is not None:
+            raise error
+        return FakeResponse({"url": url})
+
+    monkeypatch.setattr(requests, "request", request)
+    return calls
+
+
+def test_concurrent_identical_requests_share_one_call(monkeypatch):
+    calls = slow_upstream(monkeypatch)
+    client = OrthancClient("http://orthanc", None, window=0)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(client.get("/studies"))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results == [{"url": "http://orthanc/studies"}] * 5
+
+
+def test_different_parameters_are_not_coalesced(monkeypatch):
+    calls = slow_upstream(monkeypatch, delay=0)
+    client = OrthancClient("http://orthanc", None, window=10)
+    client.get("/studies", {"limit": 1})
+    client.get("/studies", {"limit": 2})
+    assert len(calls) == 2
+
+
+def test_result_is_reused_within_window(monkeypatch):
+    calls = slow_upstream(monkeypatch, delay=0)
+    client = OrthancClient("http://orthanc", None, window=0.2)
+    client.get("/studies")
+    client.get("/studies")
+    assert len(calls) == 1
+    time.sleep(0.25)
+    client.get("/studies")
+    assert len(calls) == 2
+
+
+def test_failures_are_not_reused(monkeypatch):
+    calls = slow_upstream(monkeypatch, delay=0, error=requests.exceptions.ConnectionError("down"))
+    client = OrthancClient("http://orthanc", None, window=10)
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            client.get("/studies")
+    assert len(calls) == 2
+
+
+def test_render_errors_do_not_open_the_breaker(monkeypatch):
+    def get(url, **kwargs):
+        response = requests.Response()
+        response.status_code = 500
+        return response
+
+    slow_upstream(monkeypatch, delay=0)
+    monkeypatch.setattr(requests, "get", get)
+    client = OrthancClient("http://orthanc", None, window=0)
+    for _ in range(client.breaker.failures + 1):
+        with pytest.raises(requests.exceptions.HTTPError):
+            client.get_bytes("/instances/i/rendered")
+    assert client.get("/studies") == {"url": "http://orthanc/studies"}
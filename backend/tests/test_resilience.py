@@ -0,0 +1,84 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import time
+
+import pytest
+import requests
+
+from conftest import http_error
+from app import resilience
+from app.resilience import CircuitBreaker, UpstreamUnavailable, with_last_known_good
+
+
+def fail(error):
+    def fn():
+        raise error
+    return fn
+
+
+def test_breaker_opens_after_consecutive_failures():
+    breaker = CircuitBreaker("test", failures=2, reset=10)
+    for _ in range(2):
+        with pytest.raises(requests.exceptions.ConnectionError):
+            breaker.call(fail(requests.exceptions.ConnectionError()))
+    with pytest.raises(UpstreamUnavailable):
+        breaker.call(lambda: "ok")
+
+
+def test_client_errors_do_not_open_the_breaker():
+    breaker = CircuitBreaker("test", failures=1, reset=10)
+    with pytest.raises(requests.exceptions.HTTPError):
+        breaker.call(fail(http_error(404)))
+    assert breaker.call(lambda: "ok") == "ok"
+
+
+def test_successful_trial_closes_the_breaker():
+    breaker = CircuitBreaker("test", failures=1, reset=0.05)
+    with pytest.raises(requests.exceptions.Timeout):
+        breaker.call(fail(requests.exceptions.Timeout()))
+    time.sleep(0.06)
+    assert breaker.call(lambda: "ok") == "ok"
+    assert breaker.call(lambda: "again") == "again"
+
+
+def test_unexpected_error_during_trial_releases_it():
+    breaker = CircuitBreaker("test", failures=1, reset=0.05)
+    with pytest.raises(requests.exceptions.Timeout):
+        breaker.call(fail(requests.exceptions.Timeout()))
+    time.sleep(0.06)
+    with pytest.raises(KeyError):
+        breaker.call(fail(KeyError("x")))
+    time.sleep(0.06)
+    assert breaker.call(lambda: "ok") == "ok"
+
+
+def test_last_known_good_is_served_when_upstream_fails(monkeypatch):
+    monkeypatch.setattr(resilience, "_last_good", resilience.OrderedDict())
+    assert with_last_known_good(("studies",), lambda: {"n": 1}) == ({"n": 1}, None)
+    payload, age = with_last_known_good(("studies",), fail(requests.exceptions.ConnectionError()))
+    assert payload == {"n": 1}
+    assert age is not None
+    with pytest.raises(requests.exceptions.ConnectionError):
+        with_last_known_good(("other",), fail(requests.exceptions.ConnectionError()))
+
+
+def test_last_known_good_is_bounded(monkeypatch):
+    monkeypatch.setattr(resilience, "_last_good", resilience.OrderedDict())
+    for page in range(5):
+        with_last_known_good(("studies", page), lambda: {"page": page})
+    assert list(resilience._last_good) == [("studies", 2), ("studies", 3), ("studies", 4)]
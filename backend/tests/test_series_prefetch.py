@@ -0,0 +1,52 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+
+from app.orthanc import fetch_series_batch, get_series_batch_logic
+
+
+def test_batch_uses_one_find_query(orthanc):
+    found = []
+
+    def find(payload):
+        found.append(payload["Query"]["StudyInstanceUID"])
+        return [{"ID": "s1", "ParentStudy": "st1", "MainDicomTags": {"Modality": "CT"}},
+                {"ID": "s2", "ParentStudy": "st2", "MainDicomTags": {"Modality": "MR"}}]
+
+    orthanc.responses["/tools/find"] = find
+    result = fetch_series_batch([{"_id": "st1", "studyUID": "1.1"}, {"_id": "st2", "studyUID": "1.2"}])
+    assert found == ["1.1\\1.2"]
+    assert [s["ID"] for s in result["st1"]] == ["s1"]
+    assert [s["ID"] for s in result["st2"]] == ["s2"]
+
+
+def test_indexed_studies_are_answered_locally(orthanc):
+    orthanc.responses["/tools/find"] = [{"ID": "s1", "ParentStudy": "st1", "MainDicomTags": {}}]
+    fetch_series_batch([{"_id": "st1", "studyUID": "1.1"}])
+    fetch_series_batch([{"_id": "st1", "studyUID": "1.1"}])
+    assert orthanc.calls.count("/tools/find") == 1
+
+
+def test_placeholder_uids_are_not_queried(orthanc):
+    result = fetch_series_batch([{"_id": "st1", "studyUID": "N/A"}, {"_id": "st2"}])
+    assert result == {"st1": [], "st2": []}
+    assert orthanc.calls == []
+
+
+def test_batch_endpoint_requires_studies(app):
+    response, status = get_series_batch_logic({"Studies": []})
+    assert status == 400
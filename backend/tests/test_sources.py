@@ -0,0 +1,66 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+from conftest import FakeOrthanc
+from app.nodes import NODES
+from app.sources import DicomWebSource, NativeSource, orthanc_id
+from app.warmup import warm_series
+
+SERIES_ID = "0a1b2c3d-4e5f6a7b-8c9d0e1f-2a3b4c5d-6e7f8a9b"
+
+
+def test_native_source_collects_every_modality():
+    client = FakeOrthanc({
+        "/studies/st1": {"ID": "st1", "Series": ["s1", "s2", "s3"]},
+        "/studies/st1/series": [{"MainDicomTags": {"Modality": "SM"}},
+                                {"MainDicomTags": {"Modality": "CT"}},
+                                {"MainDicomTags": {"Modality": "SM"}}],
+    })
+    assert NativeSource(client).get_study("st1")["ModalitiesInStudy"] == ["SM", "CT"]
+    assert client.calls == ["/studies/st1", "/studies/st1/series"]
+
+
+def test_native_source_skips_studies_without_series():
+    client = FakeOrthanc({"/studies/st1": {"ID": "st1", "Series": []}})
+    assert NativeSource(client).get_study("st1")["ModalitiesInStudy"] == []
+
+
+def test_dicomweb_study_lists_its_series():
+    client = FakeOrthanc({
+        "/studies/st1": {"MainDicomTags": {"StudyInstanceUID": "1.2"}},
+        "/dicom-web/studies": [{"0020000D": {"Value": ["1.2"]}, "00100020": {"Value": ["P1"]},
+                                "00080061": {"Value": ["CT", "MR"]}}],
+        "/dicom-web/series": [{"0020000D": {"Value": ["1.2"]}, "00100020": {"Value": ["P1"]},
+                               "0020000E": {"Value": ["1.2.3"]}, "00080060": {"Value": ["CT"]}}],
+    })
+    study = DicomWebSource(client).get_study("st1")
+    assert study["ID"] == "st1"
+    assert study["ModalitiesInStudy"] == ["CT", "MR"]
+    assert study["Series"] == [orthanc_id("P1", "1.2", "1.2.3")]
+
+
+def test_warm_series_reads_instances_missing_from_qido(orthanc, monkeypatch):
+    streamed = []
+
+    class Response:
+        def close(self):
+            pass
+
+    monkeypatch.setattr(NODES[0].client, "stream", lambda path, headers=None: streamed.append(path) or Response())
+    orthanc.responses[f"/series/{SERIES_ID}"] = {"ID": SERIES_ID, "Instances": ["i1", "i2"]}
+    warm_series({"ID": SERIES_ID, "MainDicomTags": {"Modality": "CT"}})
+    assert streamed == ["/instances/i1/frames/0/rendered"]
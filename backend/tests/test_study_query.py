@@ -0,0 +1,105 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import json
+
+import numpy as np
+import pytest
+
+from app.study_query import (And, DateRange, Predicate, QueryError, TextMatch, compile_condition,
+                             compile_query, query_studies_logic, run_query)
+from app.study_store import StudyStore
+
+
+@pytest.fixture
+def store():
+    return StudyStore([
+        {"_id": "a", "studyUID": "1.1", "date": "20240105", "modalities": ["CT"], "institutionName": "H1",
+         "description": "Chest CT", "PatientName": "DOE^JOHN", "is_wsi": False},
+        {"_id": "b", "studyUID": "1.2", "date": "20230210", "modalities": ["SM"], "institutionName": "H2",
+         "description": "Biopsy", "PatientName": "ROE^JANE", "is_wsi": True},
+        {"_id": "c", "studyUID": "1.3", "date": "20240620", "modalities": ["MR", "CT"], "institutionName": "H1",
+         "description": "Brain MR", "PatientName": "DOE^JANE", "is_wsi": False},
+    ])
+
+
+def query(store, where=None, sort=()):
+    predicate, sort = compile_query(json.dumps({"where": where, "sort": list(sort)}, sort_keys=True))
+    return [store.studies[row]["_id"] for row in run_query(store, predicate, sort)]
+
+
+def test_predicate_is_abstract():
+    with pytest.raises(TypeError):
+        Predicate()
+
+
+def test_field_conditions(store):
+    assert query(store, {"field": "modality", "in": ["CT"]}) == ["a", "c"]
+    assert query(store, {"field": "date", "from": "20240101"}) == ["a", "c"]
+    assert query(store, {"field": "type", "equals": "wsi"}) == ["b"]
+    assert query(store, {"field": "studyUID", "in": ["1.3", "9.9"]}) == ["c"]
+    assert query(store, {"field": "institution", "equals": "H2"}) == ["b"]
+    assert query(store, {"field": "patientName", "contains": "jane"}) == ["b", "c"]
+
+
+def test_combined_conditions(store):
+    where = {"or": [{"and": [{"field": "modality", "in": ["CT"]}, {"field": "description", "contains": "brain"}]},
+                    {"field": "type", "equals": "wsi"}]}
+    assert query(store, where) == ["b", "c"]
+
+
+def test_sorting(store):
+    assert query(store, sort=[{"field": "date", "order": "desc"}]) == ["c", "a", "b"]
+    assert query(store, sort=[{"field": "patientName"}, {"field": "date"}]) == ["c", "a", "b"]
+
+
+def test_text_predicates_only_read_candidate_rows(store):
+    read = []
+
+    class Spy(TextMatch):
+        def matches(self, value):
+            read.append(value)
+            return True
+
+    predicate = And([Spy("description", ["x"], True), DateRange(20240101, None)])
+    predicate.evaluate(store, np.ones(3, dtype=bool))
+    assert sorted(read) == ["Brain MR", "Chest CT"]
+
+
+@pytest.mark.parametrize("condition", [
+    [],
+    {"and": []},
+    {"field": "unknown", "equals": "x"},
+    {"field": "date", "from": "2024"},
+    {"field": "type", "equals": "other"},
+    {"field": "modality", "in": "CT"},
+])
+def test_malformed_conditions(condition):
+    with pytest.raises(QueryError):
+        compile_condition(condition)
+
+
+@pytest.mark.parametrize("sort", [None, "date", {"field": "date"}])
+def test_sort_must_be_a_list(app, sort):
+    with pytest.raises(QueryError):
+        compile_query(json.dumps({"where": None, "sort": sort}, sort_keys=True))
+    assert query_studies_logic({"sort": sort})[1] == 400
+
+
+def test_queries_are_compiled_once():
+    text = json.dumps({"where": {"field": "modality", "in": ["CT"]}, "sort": []}, sort_keys=True)
+    assert compile_query(text) is compile_query(text)
@@ -0,0 +1,166 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import fcntl
+import os
+import threading
+import time
+
+import pytest
+
+from app import study_store
+from app.orthanc import list_studies
+from app.study_store import StudyStore, get_study_store
+
+
+def study(study_id, date="20240115", modalities=("CT",), institution="H1", is_wsi=False):
+    return {"_id": study_id, "studyUID": f"uid-{study_id}", "date": date, "modalities": list(modalities),
+            "institutionName": institution, "is_wsi": is_wsi, "node": "main"}
+
+
+@pytest.fixture
+def fresh_state(monkeypatch):
+    monkeypatch.setattr(study_store, "_state", {"store": None, "token": None, "synced_at": None, "fresh": False,
+                                                "checked_at": 0.0, "generation": None})
+    monkeypatch.setattr(study_store, "STUDY_SNAPSHOT_DIR", "")
+
+
+def test_facets_count_every_modality_of_a_study():
+    store = StudyStore([study("a", modalities=("CT", "SM")), study("b", date="20230301", modalities=("MR",)),
+                        study("c", institution="H2", is_wsi=True, modalities=("SM",))])
+    facets = store.facets({"modality": {"SM"}})
+    assert facets["Total"] == 2
+    assert facets["Facets"]["Modality"] == {"CT": 1, "MR": 1, "SM": 2}
+    assert facets["Facets"]["Type"] == {"wsi": 1, "classic": 1}
+    assert store.facets({"date": (20240101, None)})["Total"] == 2
+
+
+def test_readers_keep_the_current_store_during_a_refresh(fresh_state, monkeypatch):
+    bodies = [{"Reset": True, "Studies": [study("a")], "Token": "main:1"}]
+    entered, release = threading.Event(), threading.Event()
+
+    def sync(since=None):
+        if since is None:
+            return bodies[0], [], None
+        entered.set()
+        release.wait(2)
+        return {"Updated": [study("b")], "Deleted": [], "ResetNodes": [], "Token": "main:2"}, [], None
+
+    monkeypatch.setattr(study_store, "sync_studies", sync)
+    first, _ = get_study_store()
+    refresher = threading.Thread(target=get_study_store)
+    refresher.start()
+    assert entered.wait(2)
+
+    start = time.monotonic()
+    store, _ = get_study_store()
+    assert store is first
+    assert time.monotonic() - start < 0.5
+
+    release.set()
+    refresher.join()
+    assert [s["_id"] for s in study_store._state["store"].studies] == ["a", "b"]
+
+
+@pytest.fixture
+def snapshots(monkeypatch, tmp_path):
+    directory = str(tmp_path / "snapshots")
+    monkeypatch.setattr(study_store, "STUDY_SNAPSHOT_DIR", directory)
+    monkeypatch.setattr(study_store, "_state", {"store": None, "token": None, "synced_at": None, "fresh": False,
+                                                "checked_at": 0.0, "generation": None})
+    study_store.SERIES_INDEX.clear()
+    yield directory
+    study_store.SERIES_INDEX.clear()
+
+
+def test_snapshot_round_trip_with_duplicate_ids(tmp_path):
+    series_index = {"a": [{"ID": "s-a"}], "b": [{"ID": "s-b"}]}
+    store = StudyStore([study("a"), study("a", date="19990101"), study("b", modalities=("MR",))])
+    store.save(str(tmp_path / "snap"), series_index)
+    loaded, series = StudyStore.load(str(tmp_path / "snap"))
+    assert [s["_id"] for s in loaded.studies] == ["a", "b"]
+    assert loaded.studies[0]["date"] == "20240115"
+    assert series.get("a") == [{"ID": "s-a"}]
+    assert series.get("b") == [{"ID": "s-b"}]
+    assert loaded.facets({})["Facets"]["Modality"] == {"CT": 1, "MR": 1}
+
+
+def test_old_snapshots_are_pruned_after_the_grace_period(snapshots, monkeypatch):
+    monkeypatch.setattr(study_store, "STUDY_SNAPSHOT_GRACE", 60)
+    os.makedirs(snapshots)
+    old, previous = "1000000000000000000-1", "1100000000000000000-1"
+    for name in (old, previous):
+        os.makedirs(os.path.join(snapshots, name))
+    os.utime(os.path.join(snapshots, previous), (time.time() - 120, time.time() - 120))
+    with study_store.snapshot_lock():
+        current = study_store.save_snapshot(StudyStore([study("a")]), "main:1")
+    # `old` was replaced by `previous` two minutes ago; `previous` only now.
+    assert sorted(os.listdir(snapshots)) == sorted(["LOCK", "CURRENT", previous, current])
+
+
+def test_lock_holder_writes_the_snapshot_that_other_workers_map(snapshots, monkeypatch):
+    calls = []
+
+    def sync(since=None):
+        calls.append(since)
+        return {"Reset": True, "Studies": [study("a"), study("b")], "Token": "main:1"}, [], None
+
+    monkeypatch.setattr(study_store, "sync_studies", sync)
+    store, age = get_study_store()
+    assert calls == [None]
+    assert isinstance(store.studies, study_store.PackedRecords)
+    assert study_store.snapshot_generation() == study_store._state["generation"]
+
+    # Another worker starting now maps the snapshot without asking Orthanc.
+    monkeypatch.setattr(study_store, "_state", {"store": None, "token": None, "synced_at": None, "fresh": False,
+                                                "checked_at": 0.0, "generation": None})
+    study_store.init_study_store()
+    assert [s["_id"] for s in study_store._state["store"].studies] == ["a", "b"]
+    assert study_store._state["token"] == "main:1"
+    assert calls == [None]
+
+
+def test_workers_without_the_lock_do_not_sync(snapshots, monkeypatch):
+    monkeypatch.setattr(study_store, "sync_studies",
+                        lambda since=None: ({"Reset": True, "Studies": [study("a")], "Token": "main:1"}, [], None))
+    first, _ = get_study_store()
+    monkeypatch.setattr(study_store, "sync_studies", lambda since=None: pytest.fail("synced without the lock"))
+    with open(os.path.join(snapshots, "LOCK"), "a") as other:
+        fcntl.flock(other, fcntl.LOCK_EX)
+        store, _ = get_study_store()
+    assert store is first
+
+
+def test_snapshot_series_survive_a_study_listing(snapshots, orthanc):
+    study_store.SERIES_INDEX["a"] = [{"ID": "s-a"}]
+    with study_store.snapshot_lock():
+        study_store.save_snapshot(StudyStore([study("a")]), "main:1")
+    study_store.SERIES_INDEX.clear()
+    study_store.init_study_store()
+    orthanc.responses["/studies"] = [{"ID": "a", "Series": [], "MainDicomTags": {"StudyInstanceUID": "uid-a"}}]
+    list_studies()
+    assert study_store.SERIES_INDEX.get("a") == [{"ID": "s-a"}]
+    with study_store.snapshot_lock():
+        study_store.save_snapshot(study_store._state["store"], "main:2")
+    _, series, _, _, _ = study_store.load_snapshot()
+    assert series.get("a") == [{"ID": "s-a"}]
+
+
+def test_snapshot_lock_is_granted_without_flock(snapshots, monkeypatch):
+    monkeypatch.setattr(study_store, "fcntl", None)
+    with study_store.snapshot_lock(blocking=False) as locked:
+        assert locked
@@ -0,0 +1,78 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import base64
+import io
+
+from PIL import Image
+
+from app.thumbnails import downscale, fetch_thumbnail, thumbnails_logic
+
+
+def image_bytes(width, height, format="PNG"):
+    output = io.BytesIO()
+    Image.new("RGB", (width, height), "white").save(output, format=format)
+    return output.getvalue()
+
+
+def series_id(n):
+    return f"{n:08x}-00000000-00000000-00000000-00000000"
+
+
+def test_downscale_keeps_the_aspect_ratio():
+    content_type, content = downscale(image_bytes(512, 256), size=64)
+    assert content_type == "image/jpeg"
+    assert Image.open(io.BytesIO(content)).size == (64, 32)
+
+
+def test_wsi_thumbnails_are_downscaled(orthanc):
+    sid = series_id(1)
+    orthanc.responses[f"/series/{sid}"] = {"ID": sid, "MainDicomTags": {"Modality": "SM"}}
+    orthanc.responses[f"/wsi/pyramids/{sid}"] = {"TilesCount": [[4, 4], [1, 1]]}
+    orthanc.responses[f"/wsi/tiles/{sid}/1/0/0"] = ("image/png", image_bytes(512, 512))
+    content_type, content = fetch_thumbnail(sid)
+    assert content_type == "image/jpeg"
+    assert Image.open(io.BytesIO(content)).size == (64, 64)
+
+
+def test_thumbnails_follow_the_series_version(orthanc):
+    sid = series_id(2)
+    rendered = "/instances/i1/rendered"
+    orthanc.responses[rendered] = ("image/jpeg", b"v1")
+    orthanc.responses[f"/series/{sid}"] = {"ID": sid, "LastUpdate": "20250101T000000", "Instances": ["i1"]}
+    assert fetch_thumbnail(sid) == ("image/jpeg", b"v1")
+    assert fetch_thumbnail(sid) == ("image/jpeg", b"v1")
+    assert orthanc.calls.count(rendered) == 1
+
+    orthanc.responses[rendered] = ("image/jpeg", b"v2")
+    orthanc.responses[f"/series/{sid}"] = {"ID": sid, "LastUpdate": "20250102T000000", "Instances": ["i1"]}
+    assert fetch_thumbnail(sid) == ("image/jpeg", b"v2")
+
+
+def test_batch_answers_null_for_unusable_series(app, orthanc):
+    sid = series_id(3)
+    orthanc.responses[f"/series/{sid}"] = {"ID": sid, "Instances": ["i3"]}
+    orthanc.responses["/instances/i3/rendered"] = ("image/jpeg", b"img")
+    result = thumbnails_logic({"Series": [sid, "../etc", series_id(4)]}).get_json()["Thumbnails"]
+    assert result[sid] == f"data:image/jpeg;base64,{base64.b64encode(b'img').decode()}"
+    assert result["../etc"] is None
+    assert result[series_id(4)] is None
+
+
+def test_batch_is_limited(app):
+    response, status = thumbnails_logic({"Series": [series_id(n) for n in range(4)]})
+    assert status == 400
@@ -0,0 +1,77 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import pytest
+
+from app.tiles import TileCache, fetch_tile
+
+SERIES_ID = "0a1b2c3d-4e5f6a7b-8c9d0e1f-2a3b4c5d-6e7f8a9b"
+
+
+@pytest.mark.parametrize("path", [
+    "/wsi/app/%2e%2e/%2e%2e/patients",
+    "/wsi/app/../../patients",
+    "/wsi/app/viewer.html/%2e%2e/%2e%2e/%2e%2e/system",
+    "/wsi/app/.hidden.js",
+    "/wsi/app/%5c..%5cpatients",
+    "/wsi/app/viewer.html%3Fx=1",
+    "/wsi/app/patients",
+])
+def test_wsi_app_rejects_paths_outside_the_viewer(client, orthanc, path):
+    assert client.get(path).status_code == 404
+    assert orthanc.calls == []
+
+
+def test_wsi_app_serves_viewer_files(client, orthanc):
+    orthanc.responses["/wsi/app/libs/viewer.js"] = ("text/javascript", b"js")
+    response = client.get("/wsi/app/libs/viewer.js")
+    assert response.data == b"js"
+
+
+def test_tiles_reject_invalid_series_ids(client, orthanc):
+    assert client.get("/wsi/tiles/%2e%2e/0/0/0").status_code == 400
+    assert client.get("/wsi/pyramids/abc").status_code == 400
+    assert orthanc.calls == []
+    with pytest.raises(ValueError):
+        fetch_tile("..", 0, 0, 0)
+
+
+def test_cache_paths_stay_in_the_cache_directory(tmp_path):
+    cache = TileCache(str(tmp_path), 1024, 64)
+    assert cache.path((SERIES_ID, 1, 2, 3)) == str(tmp_path / SERIES_ID / "1-2-3.tile")
+    with pytest.raises(ValueError):
+        cache.path(("../x", 1, 2, 3))
+
+
+def test_cache_falls_back_to_disk_and_evicts(tmp_path):
+    cache = TileCache(str(tmp_path), 100, 10)
+    cache.put((SERIES_ID, 0, 0, 0), ("image/jpeg", b"a" * 40))
+    assert cache.get((SERIES_ID, 0, 0, 0)) == ("image/jpeg", b"a" * 40)
+    for x in range(1, 4):
+        cache.put((SERIES_ID, 0, x, 0), ("image/jpeg", b"b" * 40))
+    assert cache.get((SERIES_ID, 0, 0, 0)) is None
+    assert cache.get((SERIES_ID, 0, 3, 0)) == ("image/jpeg", b"b" * 40)
+
+
+def test_tile_is_served_when_the_disk_cache_fails(client, orthanc, monkeypatch, tmp_path):
+    blocked = tmp_path / "blocked"
+    blocked.write_bytes(b"")
+    monkeypatch.setattr("app.tiles.tile_cache", TileCache(str(blocked), 1024, 64))
+    orthanc.responses[f"/wsi/tiles/{SERIES_ID}/0/1/2"] = ("image/jpeg", b"tile")
+    response = client.get(f"/wsi/tiles/{SERIES_ID}/0/1/2")
+    assert response.status_code == 200
+    assert response.data == b"tile"
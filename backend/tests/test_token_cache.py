@@ -0,0 +1,71 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import time
+
+import jwt
+import pytest
+
+from app import lti
+from app.token_cache import VerifiedTokenCache
+
+
+def test_expired_entries_are_not_returned(monkeypatch):
+    cache = VerifiedTokenCache(4)
+    cache.put("token", {"res_id": "r", "exp": time.time() + 60})
+    assert cache.get("token")["res_id"] == "r"
+    monkeypatch.setattr("app.token_cache.time.time", lambda: 2 ** 40)
+    assert cache.get("token") is None
+
+
+def test_least_recently_used_token_is_evicted():
+    cache = VerifiedTokenCache(4)
+    exp = time.time() + 60
+    for index in range(4):
+        cache.put(f"token-{index}", {"exp": exp})
+    cache.get("token-0")
+    cache.put("token-4", {"exp": exp})
+    assert cache.get("token-1") is None
+    assert all(cache.get(f"token-{index}") for index in (0, 2, 3, 4))
+
+
+def test_tokens_without_expiration_or_not_strings_are_not_cached():
+    cache = VerifiedTokenCache(4)
+    cache.put("token", {"res_id": "r"})
+    cache.put(123, {"exp": time.time() + 60})
+    assert cache.get("token") is None
+    assert cache.get(123) is None
+
+
+@pytest.fixture
+def signed(monkeypatch):
+    monkeypatch.setattr(lti, "verified_tokens", VerifiedTokenCache(4))
+    payload = {"res_id": "r", "viewer_url": "http://viewer", "description": "d", "exp": int(time.time()) + 60}
+    return jwt.encode(payload, lti.STUDENT_SIGNING_KEY, algorithm=lti.STUDENT_TOKEN_ALGORITHM)
+
+
+def test_validated_token_is_answered_from_the_cache(client, signed, monkeypatch):
+    assert client.post("/lti/validate_token", json={"token": signed}).get_json()["res_id"] == "r"
+    monkeypatch.setattr(lti.jwt, "decode", lambda *args, **kwargs: pytest.fail("token verified again"))
+    assert client.post("/lti/validate_token", json={"token": signed}).get_json()["viewer_url"] == "http://viewer"
+
+
+@pytest.mark.parametrize("token", [123, ["token"], {"token": "x"}])
+def test_token_that_is_not_a_string_is_rejected(client, signed, token):
+    response = client.post("/lti/validate_token", json={"token": token})
+    assert response.status_code == 401
+    assert response.get_json() == {"Error": "Token invalid"}
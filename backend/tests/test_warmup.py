@@ -0,0 +1,89 @@
+# This file is part of OrthanFlow.
+#
+# OrthanFlow is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# OrthanFlow is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+# Copyright (C) 2025 Florentin Botton
+
+import fcntl
+import threading
+import time
+from datetime import datetime
+
+import pytest
+
+from app import warmup
+
+
+@pytest.fixture
+def lock_path(monkeypatch, tmp_path):
+    path = str(tmp_path / "warmup.lock")
+    monkeypatch.setattr(warmup, "WARMUP_LOCK_FILE", path)
+    monkeypatch.setattr(warmup, "_scheduler_lock", None)
+    yield path
+    if warmup._scheduler_lock is not None:
+        warmup._scheduler_lock.close()
+
+
+def test_scheduler_lock_is_held_by_one_process(lock_path):
+    with open(lock_path, "a") as other:
+        fcntl.flock(other, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        assert not warmup.acquire_scheduler_lock()
+        fcntl.flock(other, fcntl.LOCK_UN)
+    assert warmup.acquire_scheduler_lock()
+    assert warmup.acquire_scheduler_lock()
+
+
+def test_scheduler_runs_without_flock(lock_path, monkeypatch):
+    monkeypatch.setattr(warmup, "fcntl", None)
+    assert warmup.acquire_scheduler_lock()
+
+
+def test_pending_sessions_are_not_queued_again(monkeypatch):
+    release = threading.Event()
+    warmed = []
+
+    def warm_session(viewer_url):
+        warmed.append(viewer_url)
+        release.wait(1)
+
+    monkeypatch.setattr(warmup, "warm_session", warm_session)
+    monkeypatch.setattr(warmup, "sessions_db", {"s1": {"viewer_url": "u1"}, "s2": {"viewer_url": "u2"}})
+    warmup.warm_all_sessions()
+    warmup.warm_all_sessions()
+    assert warmup._pending == {"u1", "u2"}
+    release.set()
+    deadline = time.monotonic() + 1
+    while warmup._pending and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert sorted(warmed) == ["u1", "u2"]
+    assert warmup.queue_session_warmup("u1")
+
+
+def test_warm_study_survives_unexpected_errors(orthanc):
+    orthanc.responses["/studies/st1"] = lambda params: {}["missing"]
+    warmup.warm_study("st1")
+    assert orthanc.calls == ["/studies/st1"]
+
+
+def test_warmup_windows_across_midnight(monkeypatch):
+    monkeypatch.setattr(warmup, "WARMUP_WINDOWS", [("22:00", "06:00")])
+    assert warmup.in_warmup_window(datetime(2025, 1, 1, 23, 30))
+    assert warmup.in_warmup_window(datetime(2025, 1, 1, 5, 0))
+    assert not warmup.in_warmup_window(datetime(2025, 1, 1, 12, 0))
+
+
+def test_viewer_url_study_ids():
+    study_id = "0a1b2c3d-4e5f6a7b-8c9d0e1f-2a3b4c5d-6e7f8a9b"
+    url = f"http://backend/studies/{study_id}/ohif-dicom-json"
+    assert warmup.studies_from_viewer_url(url) == {study_id}